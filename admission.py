@@ -0,0 +1,248 @@
+# admission.py
+import os
+import time
+import asyncio
+import logging
+import contextlib
+from collections import deque
+from typing import Dict, Any, Optional, List, Callable, Awaitable, Deque, Hashable
+
+log = logging.getLogger("admission")
+
+OnQueued = Callable[[int], Awaitable[None]]  # позиция в очереди (1 — следующий)
+
+
+def _parse_limits(spec: str) -> Dict[str, int]:
+    """'owner/model=4,owner/other=2' -> {model: limit}"""
+    out: Dict[str, int] = {}
+    for part in (spec or "").split(","):
+        name, _, val = part.strip().rpartition("=")
+        if name and val.strip().isdigit():
+            out[name.strip()] = int(val)
+    return out
+
+
+class _Ticket:
+    __slots__ = ("user", "model", "ts", "fut", "on_queued", "notified_pos", "notified_ts")
+
+    def __init__(self, user: Hashable, model: str, on_queued: Optional[OnQueued]):
+        self.user = user
+        self.model = model
+        self.ts = time.monotonic()
+        self.fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.on_queued = on_queued
+        self.notified_pos = 0
+        self.notified_ts = 0.0
+
+
+class FairScheduler:
+    """
+    Допуск вызовов Replicate: не больше global_limit одновременно и не больше лимита модели.
+    Ожидающие — по очереди на пользователя; слоты раздаются по кругу между пользователями,
+    так что один пользователь с пачкой запросов не задерживает остальных дольше, чем на один свой.
+    on_queued(pos) получает позицию при постановке в очередь и при её изменении (не чаще notify_interval).
+    """
+
+    def __init__(self, global_limit: int, model_limit: int, model_limits: Optional[Dict[str, int]] = None,
+                 notify_interval: float = 5.0):
+        self.global_limit = max(1, int(global_limit))
+        self.default_model_limit = max(1, int(model_limit))
+        self.model_limits = dict(model_limits or {})
+        self.notify_interval = notify_interval
+        self._active = 0
+        self._by_model: Dict[str, int] = {}
+        self._queues: Dict[Hashable, Deque[_Ticket]] = {}
+        self._ring: List[Hashable] = []   # пользователи с ожидающими, [0] — чья очередь следующая
+        self._notify_tasks: set = set()
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self.stats = {"admitted": 0, "queued": 0, "cancelled": 0, "max_wait_s": 0.0, "spare": 0, "spare_denied": 0}
+
+    def limit_for(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_model_limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user: Hashable, model: str, on_queued: Optional[OnQueued] = None):
+        """async with ADMISSION.slot(user_id, model): ... — вызов Replicate внутри."""
+        t = _Ticket(user, model, on_queued)
+        if not self._ring and self._fits(model):
+            self._grant(t)
+        else:
+            self.stats["queued"] += 1
+            q = self._queues.get(user)
+            if q is None:
+                q = self._queues[user] = deque()
+                self._ring.append(user)
+            q.append(t)
+            self._pump()
+            if not t.fut.done():
+                self._notify(t, force=True)
+        try:
+            await t.fut
+        except asyncio.CancelledError:
+            if t.fut.done() and not t.fut.cancelled():
+                self._release(t)  # слот выдан в момент отмены
+            else:
+                t.fut.cancel()
+                self.stats["cancelled"] += 1
+                self._pump()      # снять отменённого с головы очереди
+            raise
+        try:
+            yield
+        finally:
+            self._release(t)
+
+    @contextlib.asynccontextmanager
+    async def spare(self, model: str):
+        """
+        Дополнительный слот без ожидания (хедж): as granted — True, если свободен сейчас.
+        Есть очередь или лимит исчерпан — False: ожидающих не обгоняем.
+        """
+        if self._ring or not self._fits(model):
+            self.stats["spare_denied"] += 1
+            yield False
+            return
+        self._active += 1
+        self._by_model[model] = self._by_model.get(model, 0) + 1
+        self.stats["spare"] += 1
+        try:
+            yield True
+        finally:
+            self._free(model)
+
+    def position(self, user: Hashable) -> Optional[int]:
+        """Позиция первого ожидающего запроса пользователя или None."""
+        q = self._queues.get(user)
+        if not q:
+            return None
+        for t in q:
+            if not t.fut.done():
+                return self._position(t)
+        return None
+
+    # ---- внутреннее ----
+    def _fits(self, model: str) -> bool:
+        return self._active < self.global_limit and self._by_model.get(model, 0) < self.limit_for(model)
+
+    def _grant(self, t: _Ticket) -> None:
+        self._active += 1
+        self._by_model[t.model] = self._by_model.get(t.model, 0) + 1
+        wait = time.monotonic() - t.ts
+        self._waits.append(wait)
+        self.stats["admitted"] += 1
+        if wait > self.stats["max_wait_s"]:
+            self.stats["max_wait_s"] = round(wait, 3)
+        t.fut.set_result(None)
+
+    def _release(self, t: _Ticket) -> None:
+        self._free(t.model)
+
+    def _free(self, model: str) -> None:
+        self._active -= 1
+        n = self._by_model.get(model, 0) - 1
+        if n > 0:
+            self._by_model[model] = n
+        else:
+            self._by_model.pop(model, None)
+        self._pump()
+
+    def _pump(self) -> None:
+        granted_any = False
+        while self._ring and self._active < self.global_limit:
+            granted = False
+            for user in list(self._ring):
+                q = self._queues[user]
+                while q and q[0].fut.done():
+                    q.popleft()  # отменённые
+                if not q:
+                    self._ring.remove(user)
+                    del self._queues[user]
+                    continue
+                t = q[0]
+                if self._by_model.get(t.model, 0) >= self.limit_for(t.model):
+                    continue  # модель занята — слот достаётся следующему пользователю
+                q.popleft()
+                self._ring.remove(user)
+                if q:
+                    self._ring.append(user)  # в конец круга
+                else:
+                    del self._queues[user]
+                self._grant(t)
+                granted = granted_any = True
+                break
+            if not granted:
+                break
+        if granted_any:
+            self._notify_all()
+
+    def _position(self, t: _Ticket) -> int:
+        """Сколько запросов будет допущено раньше при обходе по кругу (без учёта лимитов моделей) + 1."""
+        q = self._queues[t.user]
+        k = sum(1 for x in q if not x.fut.done() and x.ts < t.ts)
+        ahead = k
+        mine = self._ring.index(t.user)
+        for i, user in enumerate(self._ring):
+            if user == t.user:
+                continue
+            n = sum(1 for x in self._queues[user] if not x.fut.done())
+            ahead += min(n, k + 1 if i < mine else k)
+        return ahead + 1
+
+    def _notify(self, t: _Ticket, force: bool = False) -> None:
+        if t.on_queued is None:
+            return
+        now = time.monotonic()
+        if not force and now - t.notified_ts < self.notify_interval:
+            return
+        pos = self._position(t)
+        if pos == t.notified_pos:
+            return
+        t.notified_pos, t.notified_ts = pos, now
+        task = asyncio.create_task(self._call(t.on_queued, pos))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+
+    def _notify_all(self) -> None:
+        for q in self._queues.values():
+            for t in q:
+                if t.on_queued is not None and not t.fut.done():
+                    self._notify(t)
+
+    @staticmethod
+    async def _call(cb: OnQueued, pos: int) -> None:
+        try:
+            await cb(pos)
+        except Exception as e:
+            log.debug("on_queued callback failed: %r", e)
+
+    def snapshot(self) -> Dict[str, Any]:
+        queued_by_model: Dict[str, int] = {}
+        depth = 0
+        for q in self._queues.values():
+            for t in q:
+                if not t.fut.done():
+                    depth += 1
+                    queued_by_model[t.model] = queued_by_model.get(t.model, 0) + 1
+        waits = sorted(self._waits)
+        now = time.monotonic()
+        oldest = min((t.ts for q in self._queues.values() for t in q if not t.fut.done()), default=None)
+        return {
+            **self.stats,
+            "active": self._active,
+            "global_limit": self.global_limit,
+            "active_by_model": dict(self._by_model),
+            "queue_depth": depth,
+            "queued_by_model": queued_by_model,
+            "users_waiting": len(self._ring),
+            "oldest_wait_s": round(now - oldest, 1) if oldest is not None else None,
+            "wait_avg_s": round(sum(waits) / len(waits), 3) if waits else None,
+            "wait_p95_s": round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else None,
+        }
+
+
+# один планировщик на процесс: генерации и запуски обучения (main.py)
+ADMISSION = FairScheduler(
+    global_limit=int(os.getenv("REPLICATE_MAX_INFLIGHT", "16")),
+    model_limit=int(os.getenv("REPLICATE_MODEL_MAX_INFLIGHT", "8")),
+    model_limits=_parse_limits(os.getenv("REPLICATE_MODEL_LIMITS", "")),
+    notify_interval=float(os.getenv("ADMISSION_NOTIFY_INTERVAL", "5")),
+)
@@ -0,0 +1,65 @@
+# aggregates.py
+import time
+import logging
+from typing import Dict, Any, Optional
+
+log = logging.getLogger("aggregates")
+
+
+class Aggregates:
+    """
+    Счётчики для /stats и /admin/summary, поддерживаются по дельтам из save_user.
+    На старте пересчитываются из хранилища одним агрегирующим запросом.
+    """
+
+    def __init__(self):
+        self.users = 0
+        self.balances = 0
+        self.models = 0
+        self.paid = 0
+        self.ref_total = 0.0
+        self.ref_ready = 0.0
+        self.oldest_ts: Optional[float] = None
+
+    def rebuild(self, store) -> None:
+        agg = store.summary()
+        self.users = int(agg["users"] or 0)
+        self.balances = int(agg["balances"] or 0)
+        self.models = int(agg["models"] or 0)
+        self.paid = int(agg["paid"] or 0)
+        self.ref_total = float(agg["ref_total"] or 0.0)
+        self.ref_ready = float(agg["ref_ready"] or 0.0)
+        self.oldest_ts = agg["oldest_ts"]
+        log.info("aggregates rebuilt: users=%d", self.users)
+
+    def user_created(self, row: Dict[str, Any]) -> None:
+        self.users += 1
+        ts = float(row.get("first_seen_ts") or time.time())
+        if self.oldest_ts is None or ts < self.oldest_ts:
+            self.oldest_ts = ts
+        self.user_changed({k: (None, v) for k, v in row.items()})
+
+    def user_changed(self, diff: Dict[str, tuple]) -> None:
+        """diff: поле -> (старое, новое)."""
+        for k, (old, new) in diff.items():
+            if k == "balance":
+                self.balances += int(new or 0) - int(old or 0)
+            elif k == "has_model":
+                self.models += int(bool(new)) - int(bool(old))
+            elif k == "paid_any":
+                self.paid += int(bool(new)) - int(bool(old))
+            elif k == "ref_earn_total":
+                self.ref_total += float(new or 0.0) - float(old or 0.0)
+            elif k == "ref_earn_ready":
+                self.ref_ready += float(new or 0.0) - float(old or 0.0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "users": self.users,
+            "balances": self.balances,
+            "models": self.models,
+            "paid": self.paid,
+            "ref_total": round(self.ref_total, 2),
+            "ref_ready": round(self.ref_ready, 2),
+            "oldest_ts": self.oldest_ts,
+        }
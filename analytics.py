@@ -0,0 +1,231 @@
+# analytics.py
+import copy
+import time
+import asyncio
+import logging
+from array import array
+from typing import Dict, Any, Optional, List
+
+import numpy as np
+
+from singleflight import SingleFlight
+
+log = logging.getLogger("analytics")
+
+DAY = 86400
+COLUMNS = ("_u_slot", "u_id", "u_first_seen", "u_balance", "u_paid", "u_model", "u_ref",
+           "_p_slot", "p_user", "p_created", "p_amount", "p_ok")
+
+
+def _np(col: array, dtype) -> np.ndarray:
+    # копия: array.array нельзя расширять, пока на его буфер смотрит numpy
+    return np.frombuffer(col, dtype=dtype).copy() if len(col) else np.zeros(0, dtype=dtype)
+
+
+class ColumnarSnapshot:
+    """
+    Колоночный снимок пользователей и платежей для когортной аналитики админки.
+    Хранение — упакованные array.array (слот на пользователя/платёж), запросы —
+    векторные group-by через numpy. Строится лениво при первом запросе (ensure, в потоке),
+    дальше обновляется точечно из save_user и журнала платежей; изменения, пришедшие
+    во время постройки, копятся и применяются после неё.
+    """
+
+    def __init__(self):
+        self.built = False
+        self._building = False
+        self._deltas: List[tuple] = []
+        self._flight = SingleFlight()
+        self._u_slot: Dict[int, int] = {}
+        self.u_id = array("q")
+        self.u_first_seen = array("d")
+        self.u_balance = array("q")
+        self.u_paid = array("b")
+        self.u_model = array("b")
+        self.u_ref = array("q")     # 0 — без реферера
+        self._p_slot: Dict[str, int] = {}
+        self.p_user = array("q")
+        self.p_created = array("d")
+        self.p_amount = array("d")
+        self.p_ok = array("b")      # succeeded
+
+    # ---- наполнение ----
+    async def ensure(self, store, ledger) -> None:
+        """Построить снимок, если ещё нет; параллельные первые запросы ждут одну постройку."""
+        if not self.built:
+            await self._flight.do("build", lambda: self._build(store, ledger))
+
+    async def _build(self, store, ledger) -> None:
+        if self.built:
+            return
+        t0 = time.time()
+        self._building = True
+        self._deltas = []
+        # платежи копируются на loop: журнал меняется только здесь, поток читает копию;
+        # хранилище пользователей потокобезопасно (чтения под своими блокировками)
+        recs = [copy.copy(r) for r in ledger.by_id.values()]
+        fresh = ColumnarSnapshot()  # поток пишет только в свой объект — отмена запроса ничего не портит
+        try:
+            await asyncio.to_thread(fresh._fill, store, recs, ledger)
+        except BaseException:
+            self._deltas = []
+            raise
+        finally:
+            self._building = False
+        for k in COLUMNS:
+            setattr(self, k, getattr(fresh, k))
+        self.built = True
+        deltas, self._deltas = self._deltas, []
+        for fn, args in deltas:  # синхронно на loop: новых изменений между ними не будет
+            fn(*args)
+        log.info("analytics snapshot built: %d users, %d payments (+%d live changes) in %.2fs",
+                 len(self.u_id), len(self.p_user), len(deltas), time.time() - t0)
+
+    def _fill(self, store, recs, ledger) -> None:
+        for row in store.iter_rows():
+            self.user_row(row)
+        for rec in recs:
+            self.payment(rec)
+        # холодные платежи — из архива журнала (горячие уже скопированы выше)
+        for rec in ledger.iter_archived({r.payment_id for r in recs}):
+            self.payment(rec)
+
+    def user_new(self, row: Dict[str, Any]) -> None:
+        if self._building:
+            self._deltas.append((self.user_row, (dict(row),)))
+        elif self.built:
+            self.user_row(row)
+
+    def user_row(self, row: Dict[str, Any]) -> None:
+        uid = int(row["id"])
+        i = self._u_slot.get(uid)
+        if i is None:
+            i = self._u_slot[uid] = len(self.u_id)
+            self.u_id.append(uid)
+            self.u_first_seen.append(0.0)
+            self.u_balance.append(0)
+            self.u_paid.append(0)
+            self.u_model.append(0)
+            self.u_ref.append(0)
+        self._set_user(i, row)
+
+    def user_changed(self, uid: int, diff: Dict[str, tuple]) -> None:
+        if self._building:
+            self._deltas.append((self.user_changed, (uid, dict(diff))))
+            return
+        if not self.built:
+            return
+        i = self._u_slot.get(int(uid))
+        if i is None:
+            self.user_row({"id": uid, **{k: new for k, (_, new) in diff.items()}})
+        else:
+            self._set_user(i, {k: new for k, (_, new) in diff.items()})
+
+    def _set_user(self, i: int, row: Dict[str, Any]) -> None:
+        if "first_seen_ts" in row:
+            self.u_first_seen[i] = float(row["first_seen_ts"] or 0.0)
+        if "balance" in row:
+            self.u_balance[i] = int(row["balance"] or 0)
+        if "paid_any" in row:
+            self.u_paid[i] = 1 if row["paid_any"] else 0
+        if "has_model" in row:
+            self.u_model[i] = 1 if row["has_model"] else 0
+        if "referred_by" in row:
+            self.u_ref[i] = int(row["referred_by"] or 0)
+
+    def payment(self, rec) -> None:
+        i = self._p_slot.get(rec.payment_id)
+        if i is None:
+            i = self._p_slot[rec.payment_id] = len(self.p_user)
+            self.p_user.append(int(rec.user_id or 0))
+            self.p_created.append(float(rec.created_at or 0.0))
+            self.p_amount.append(float(rec.amount or 0))
+            self.p_ok.append(0)
+        self.p_ok[i] = 1 if rec.status == "succeeded" else 0
+
+    def payment_changed(self, rec) -> None:
+        if self._building:
+            self._deltas.append((self.payment, (copy.copy(rec),)))
+        elif self.built:
+            self.payment(rec)
+
+    # ---- запросы ----
+    def _user_mask(self, first_seen: np.ndarray, since: Optional[float], until: Optional[float]) -> np.ndarray:
+        m = np.ones(len(first_seen), dtype=bool)
+        if since is not None:
+            m &= first_seen >= since
+        if until is not None:
+            m &= first_seen < until
+        return m
+
+    def conversion(self, bucket: int = DAY, since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Когорты по дню (bucket) регистрации: сколько пришло и сколько оплатило."""
+        fs = _np(self.u_first_seen, np.float64)
+        paid = _np(self.u_paid, np.int8)
+        m = self._user_mask(fs, since, until)
+        keys = (fs[m] // bucket).astype(np.int64)
+        if not len(keys):
+            return []
+        uniq, inv = np.unique(keys, return_inverse=True)
+        users = np.bincount(inv)
+        payers = np.bincount(inv, weights=paid[m]).astype(np.int64)
+        return [
+            {"bucket_ts": int(k * bucket), "users": int(u), "paid": int(p), "conversion": round(float(p) / float(u), 4)}
+            for k, u, p in zip(uniq, users, payers)
+        ]
+
+    def revenue(self, bucket: int = DAY, since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Выручка по времени оплаты (успешные платежи)."""
+        ts = _np(self.p_created, np.float64)
+        ok = _np(self.p_ok, np.int8).astype(bool)
+        amt = _np(self.p_amount, np.float64)
+        m = ok & self._user_mask(ts, since, until)
+        keys = (ts[m] // bucket).astype(np.int64)
+        if not len(keys):
+            return []
+        uniq, inv = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inv, weights=amt[m])
+        cnt = np.bincount(inv)
+        return [{"bucket_ts": int(k * bucket), "payments": int(c), "revenue": round(float(s), 2)}
+                for k, c, s in zip(uniq, cnt, sums)]
+
+    def revenue_by_ref(self, since: Optional[float] = None, until: Optional[float] = None, top: int = 100) -> List[Dict[str, Any]]:
+        """Выручка по источнику: referrer_id приглашённого плательщика (0 — органика)."""
+        uid = _np(self.u_id, np.int64)
+        ref = _np(self.u_ref, np.int64)
+        ts = _np(self.p_created, np.float64)
+        ok = _np(self.p_ok, np.int8).astype(bool)
+        m = ok & self._user_mask(ts, since, until)
+        pu = _np(self.p_user, np.int64)[m]
+        amt = _np(self.p_amount, np.float64)[m]
+        if not len(pu) or not len(uid):
+            return []
+        order = np.argsort(uid)
+        pos = np.searchsorted(uid, pu, sorter=order).clip(0, len(uid) - 1)
+        slot = order[pos]
+        known = uid[slot] == pu
+        src = np.where(known, ref[slot], 0)
+        uniq, inv = np.unique(src, return_inverse=True)
+        sums = np.bincount(inv, weights=amt)
+        cnt = np.bincount(inv)
+        # уникальные плательщики на источник: уникальные пары (источник, user_id)
+        pair_src = np.unique(np.stack([src, pu], axis=1), axis=0)[:, 0]
+        payers = np.bincount(np.searchsorted(uniq, pair_src), minlength=len(uniq))
+        idx = np.argsort(-sums)[:top]
+        return [
+            {"referrer_id": int(uniq[i]), "payments": int(cnt[i]), "payers": int(payers[i]), "revenue": round(float(sums[i]), 2)}
+            for i in idx
+        ]
+
+    def balance_distribution(self, edges: Optional[List[float]] = None) -> Dict[str, Any]:
+        bal = _np(self.u_balance, np.int64)
+        edges = edges or [0, 1, 3, 10, 20, 40, 70, 100]
+        bins = np.array(list(edges) + [np.inf], dtype=np.float64)
+        hist, _ = np.histogram(bal, bins=bins)
+        pct = np.percentile(bal, [50, 90, 99]).tolist() if len(bal) else [0, 0, 0]
+        return {
+            "bins": [{"from": edges[i], "to": (edges[i + 1] if i + 1 < len(edges) else None), "users": int(h)}
+                     for i, h in enumerate(hist)],
+            "p50": pct[0], "p90": pct[1], "p99": pct[2],
+            "total": int(bal.sum()),
+        }
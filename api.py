@@ -12,6 +12,9 @@ from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from pydantic import BaseModel, Field
 from PIL import Image, ImageDraw
 
+from versions import VERSIONS
+from outbound import REPLICATE_OUT
+
 router = APIRouter()
 log = logging.getLogger("api")
 logging.basicConfig(level=logging.INFO)
@@ -75,14 +78,17 @@ async def _resolve_trainer_version_pointer() -> str:
         )
     url = f"https://api.replicate.com/v1/models/{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}"
     headers = {"Authorization": f"Token {_require_env('REPLICATE_API_TOKEN')}"}
-    async with httpx.AsyncClient(timeout=30) as cl:
-        r = await cl.get(url, headers=headers)
-        r.raise_for_status()
-        j = r.json()
-        vid = (j.get("versions") or [{}])[0].get("id")
-        if not vid:
-            raise HTTPException(500, detail="Cannot get latest trainer version")
-        return f"{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}:{vid}"
+
+    async def fetch() -> str:
+        async with httpx.AsyncClient(timeout=30) as cl:
+            r = await REPLICATE_OUT.request("GET", url, client=cl, headers=headers)
+            r.raise_for_status()
+            j = r.json()
+            vid = (j.get("versions") or [{}])[0].get("id")
+            if not vid:
+                raise HTTPException(500, detail="Cannot get latest trainer version")
+            return f"{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}:{vid}"
+    return await VERSIONS.resolve(("trainer", f"{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}"), fetch)
 
 # ========= MODELS =========
 class TrainResp(BaseModel):
@@ -141,7 +147,7 @@ async def train(user_id: str = Form(...)):
     url = f"https://api.replicate.com/v1/models/{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}/trainings"
 
     async with httpx.AsyncClient(timeout=120) as cl:
-        r = await cl.post(url, json=payload, headers=headers)
+        r = await REPLICATE_OUT.request("POST", url, client=cl, json=payload, headers=headers)
         if r.status_code >= 400:
             log.error(f"TRAIN ERROR {r.status_code}: {r.text}")
             raise HTTPException(r.status_code, detail=r.text)
@@ -158,7 +164,7 @@ async def status(job_id: str):
         raise HTTPException(404, detail="job not found")
     headers = {"Authorization": f"Token {_require_env('REPLICATE_API_TOKEN')}"}
     async with httpx.AsyncClient(timeout=60) as cl:
-        r = await cl.get(f"https://api.replicate.com/v1/trainings/{job_id}", headers=headers)
+        r = await REPLICATE_OUT.request("GET", f"https://api.replicate.com/v1/trainings/{job_id}", client=cl, headers=headers)
 
     if r.status_code == 404:
         job = JOBS[job_id]
@@ -190,11 +196,11 @@ async def generate(req: GenReq):
     async with httpx.AsyncClient(timeout=300) as cl:
         if req.model_id:
             url = f"https://api.replicate.com/v1/models/{req.model_id}/predictions"
-            r = await cl.post(url, json=payload, headers=headers)
+            r = await REPLICATE_OUT.request("POST", url, client=cl, json=payload, headers=headers)
         else:
             infer_version = _require_env("REPLICATE_INFER_VERSION")
             payload["version"] = infer_version
-            r = await cl.post("https://api.replicate.com/v1/predictions", json=payload, headers=headers)
+            r = await REPLICATE_OUT.request("POST", "https://api.replicate.com/v1/predictions", client=cl, json=payload, headers=headers)
 
         if r.status_code >= 400:
             log.error(f"GENERATE ERROR {r.status_code}: {r.text}")
@@ -206,7 +212,7 @@ async def generate(req: GenReq):
         for _ in range(120):
             if final.get("status") in ("succeeded", "failed", "canceled"):
                 break
-            res = await cl.get(get_url, headers=headers)
+            res = await REPLICATE_OUT.request("GET", get_url, client=cl, headers=headers)
             final = res.json()
             time.sleep(1)
 
@@ -1,16 +1,23 @@
 import os
-import json
 import time
 import asyncio
 import logging
-from dataclasses import dataclass, field
+import contextvars
+from dataclasses import dataclass, field, fields
 from typing import Dict, Any, Optional, List
 
-import httpx
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from telegram.constants import ParseMode
 from telegram.ext import Application, ContextTypes, CallbackQueryHandler, MessageHandler, CommandHandler, filters
 
+from userstore import UserStore, open_user_store
+from referrals import ReferralIndex
+from timers import DeferredScheduler
+from aggregates import Aggregates
+from analytics import ColumnarSnapshot
+from dispatch import KeyedLocks, KeyedDispatcher
+from services import BackendService, HttpBackend
+
 # ================== CONFIG ==================
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
 BACKEND_ROOT = (os.getenv("BACKEND_ROOT") or "").rstrip("/")
@@ -21,7 +28,6 @@ ADMIN_ID = int((os.getenv("ADMIN_ID") or "0").strip() or "0")
 DATA_DIR = os.getenv("DATA_DIR", "/var/data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
-DB_PATH = os.path.join(DATA_DIR, "users.json")
 PHOTOS_TMP = os.path.join(DATA_DIR, "tg_tmp")
 os.makedirs(PHOTOS_TMP, exist_ok=True)
 
@@ -30,11 +36,29 @@ PRICES = {"20": 429, "40": 590, "70": 719}
 # ⚡ Акция через 24 часа после первого входа
 # 🔁 Обновлено: 60 генераций за 390 ₽
 FLASH_OFFER = {"qty": 60, "price": 390}  # 60 генераций — 390₽
+FLASH_DELAY = 24 * 3600
 
 # 🎯 Спец-офферы при исчерпании баланса
 SPECIAL1 = {"qty": 60, "price": 329, "title": "60 генераций (Спец-оффер 1)"}
 SPECIAL2 = {"qty": 100, "price": 419, "title": "100 генераций (Финальный оффер)"}
 
+# Параллельная обработка апдейтов: разные пользователи — одновременно, один — по порядку
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "50"))  # апдейтов в очереди одного пользователя
+
+# Одновременных генераций на пользователя (разные стили); повтор того же стиля не запускает вторую
+GEN_PER_USER_MAX = int(os.getenv("GEN_PER_USER_MAX", "2"))
+GEN_COST = 3  # генераций за один стиль (3 изображения)
+# изображения стиля — параллельными предсказаниями, каждое отправляется по готовности (0 — одним альбомом)
+GEN_FANOUT = (os.getenv("GEN_FANOUT", "1").strip().lower() in ("1", "true", "yes"))
+# сколько секунд пользователь ждёт стиль; дальше предсказания отменяются в Replicate, резерв возвращается
+GEN_DEADLINE = float(os.getenv("GEN_DEADLINE", "240"))
+GEN_STOP_TIMEOUT = 10.0  # на остановке: ждать возвратов резерва отменённых генераций
+
+# Ожидание обучения: общий лимит и страховочный интервал опроса (при вебхуках)
+TRAIN_WAIT_TIMEOUT = float(os.getenv("TRAIN_WAIT_TIMEOUT", "600"))
+TRAIN_SAFETY_POLL = float(os.getenv("TRAIN_SAFETY_POLL", "30"))
+
 # ================== PROMPTS ==================
 # Реализм без «пластика»: расширено — лучшее распознавание лица и правдоподобные фоны.
 # NB: структура промптов не менялась: они всё так же собираются из фрейминга, тега стиля, света, оптики и RETREAL.
@@ -255,13 +279,14 @@ logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("tg-bot")
 
 # ================== STORAGE ==================
-@dataclass
+@dataclass(slots=True)
 class UserState:
     id: int
     balance: int = 0
     has_model: bool = False
     job_id: Optional[str] = None
     model_id: Optional[str] = None
+    model_version: Optional[str] = None  # хеш версии обученной модели — генерация без запроса версий
     referred_by: Optional[int] = None
     ref_code: Optional[str] = None
     ref_earn_total: float = 0.0
@@ -274,36 +299,103 @@ class UserState:
     bought_spec1: bool = False
     bought_spec2: bool = False
     purchases: Dict[str, str] = field(default_factory=dict)  # payment_id -> "spec1"|"spec2"|...
+    # снимок значений на момент загрузки/сохранения — для записи только изменённых полей
+    _snap: Optional[tuple] = field(default=None, init=False, repr=False, compare=False)
 
-def _load_db() -> Dict[str, Any]:
-    if not os.path.exists(DB_PATH):
-        return {}
-    try:
-        with open(DB_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "UserState":
+        st = cls(**{k: row[k] for k in USER_FIELDS if k in row})
+        st._snap = st._values()
+        return st
 
-def _save_db(db: Dict[str, Any]) -> None:
-    tmp = DB_PATH + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, DB_PATH)
+    def to_row(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in USER_FIELDS}
 
-DB = _load_db()
+    def _values(self) -> tuple:
+        # purchases — единственное изменяемое на месте поле, копируем
+        return tuple(dict(v) if k == "purchases" else v for k, v in ((k, getattr(self, k)) for k in USER_FIELDS))
 
-def get_user(uid: int) -> UserState:
-    s = DB.get(str(uid))
+    def diff(self) -> Dict[str, tuple]:
+        """поле -> (старое, новое) для изменённых с последней загрузки/сохранения."""
+        cur = self._values()
+        if self._snap is None:
+            return {k: (None, cur[i]) for i, k in enumerate(USER_FIELDS)}
+        return {k: (self._snap[i], cur[i]) for i, k in enumerate(USER_FIELDS) if cur[i] != self._snap[i]}
+
+    def changes(self) -> Dict[str, Any]:
+        return {k: new for k, (_, new) in self.diff().items()}
+
+    def mark_clean(self) -> None:
+        self._snap = self._values()
+
+USER_FIELDS = tuple(f.name for f in fields(UserState) if not f.name.startswith("_"))
+
+
+class UserSession:
+    """Identity map на время одного апдейта: каждый пользователь грузится не более одного раза."""
+    __slots__ = ("users", "closed")
+
+    def __init__(self):
+        self.users: Dict[int, UserState] = {}
+        self.closed = False
+
+_SESSION: contextvars.ContextVar[Optional[UserSession]] = contextvars.ContextVar("user_session", default=None)
+
+def _active_session() -> Optional[UserSession]:
+    s = _SESSION.get()
+    # фоновые задачи наследуют контекст апдейта — после его завершения сессия закрыта
+    return s if s is not None and not s.closed else None
+
+# users.json больше не перезаписывается целиком: построчное хранилище (SQLite),
+# старый файл переносится один раз при первом старте.
+USERS: UserStore = open_user_store(DATA_DIR)
+REFS = ReferralIndex()
+REFS.load(USERS.referral_pairs())
+# персистентные таймеры по пользователям (флеш-акция и будущие промо/напоминания)
+TIMERS = DeferredScheduler(USERS)
+# счётчики для /stats и /admin/summary — O(1) на запрос
+AGG = Aggregates()
+AGG.rebuild(USERS)
+# колоночный снимок для /admin/analytics (строится лениво при первом запросе)
+COLS = ColumnarSnapshot()
+# локи на пользователя: read-modify-write баланса и покупок (апдейты, начисления, вебхуки)
+USER_LOCKS = KeyedLocks()
+
+def user_lock(uid: int):
+    """async with user_lock(uid): внутри читать состояние через get_user(uid, fresh=True)."""
+    return USER_LOCKS.hold(int(uid))
+
+def get_user(uid: int, fresh: bool = False) -> UserState:
+    """fresh=True — перечитать из хранилища (например, после начисления в другом запросе)."""
+    sess = _active_session()
+    if sess is not None and not fresh:
+        st = sess.users.get(int(uid))
+        if st is not None:
+            return st
+    s = USERS.get(uid)
     if s is None:
         st = UserState(id=uid, ref_code=f"ref_{uid}")
-        DB[str(uid)] = st.__dict__
-        _save_db(DB)
-        return st
-    return UserState(**s)
+        USERS.put(st.to_row())
+        st.mark_clean()
+        AGG.user_created(st.to_row())
+        COLS.user_new(st.to_row())
+        TIMERS.schedule("flash", uid, st.first_seen_ts + FLASH_DELAY)
+    else:
+        st = UserState.from_row(s)
+    if sess is not None:
+        sess.users[int(uid)] = st
+    return st
 
 def save_user(st: UserState) -> None:
-    DB[str(st.id)] = st.__dict__
-    _save_db(DB)
+    d = st.diff()
+    if not d:
+        return
+    USERS.update(st.id, {k: new for k, (_, new) in d.items()})
+    st.mark_clean()
+    AGG.user_changed(d)
+    COLS.user_changed(st.id, d)
+    if st.referred_by:
+        REFS.add(st.referred_by, st.id)
 
 # ================== KEYБОАРДЫ ==================
 def kb_home(has_paid: bool = False) -> InlineKeyboardMarkup:
@@ -392,6 +484,12 @@ class TgApp:
     def __init__(self):
         self.app: Optional[Application] = None
         self._bg_tasks: List[asyncio.Task] = []
+        self.dispatcher: Optional[KeyedDispatcher] = None
+        # генерации в работе: uid -> {prompt: task}; повторные нажатия не запускают новую
+        self._gens: Dict[int, Dict[str, asyncio.Task]] = {}
+        self.gen_stats = {"started": 0, "attached": 0, "capped": 0, "refunded": 0}
+        # main.py подменяет на InProcessBackend, если не задан BACKEND_MODE=http
+        self.backend: BackendService = HttpBackend(BACKEND_ROOT)
 
     @property
     def bot(self):
@@ -413,21 +511,56 @@ class TgApp:
     async def start(self):
         assert self.app
         await self.app.start()
-        self._bg_tasks.append(asyncio.create_task(self._flash_offer_scheduler()))
+        self.dispatcher = KeyedDispatcher(self.process_update, UPDATE_CONCURRENCY, UPDATE_QUEUE_MAX)
+        TIMERS.register("flash", self._on_flash_timer)
+        TIMERS.load()
+        # пользователи без таймера (база до таймеров) — доставим по расписанию; один раз, скан в потоке
+        if not TIMERS.seeded("flash"):
+            for v in await asyncio.to_thread(USERS.flash_candidates, time.time()):
+                if not TIMERS.has("flash", v["id"]):
+                    TIMERS.schedule("flash", v["id"], float(v.get("first_seen_ts") or time.time()) + FLASH_DELAY)
+            TIMERS.mark_seeded("flash")
+        TIMERS.start()
 
     async def stop(self):
         if not self.app:
             return
         for t in self._bg_tasks:
             t.cancel()
+        gens = [t for per_user in list(self._gens.values()) for t in per_user.values()]
+        for t in gens:
+            t.cancel()  # резерв баланса вернёт сама задача
+        if gens:
+            # дождаться возвратов до закрытия хранилища и HTTP-пулов
+            done, pending = await asyncio.wait(gens, timeout=GEN_STOP_TIMEOUT)
+            await asyncio.gather(*done, return_exceptions=True)
+            if pending:
+                log.warning("stop: %d generations did not finish in %.0fs", len(pending), GEN_STOP_TIMEOUT)
+        if self.dispatcher:
+            await self.dispatcher.stop()
+        await TIMERS.stop()
+        await self.backend.close()
         try: await self.app.stop()
         except Exception: pass
         try: await self.app.shutdown()
         except Exception: pass
 
+    def submit(self, update: Update) -> bool:
+        """Из вебхука: поставить апдейт в очередь его пользователя и сразу вернуть ответ Telegram."""
+        assert self.dispatcher
+        chat = update.effective_chat
+        key = update.effective_user.id if update.effective_user else (chat.id if chat else 0)
+        return self.dispatcher.submit(key, update)
+
     async def process_update(self, update: Update):
         assert self.app
-        await self.app.process_update(update)
+        sess = UserSession()
+        token = _SESSION.set(sess)
+        try:
+            await self.app.process_update(update)
+        finally:
+            sess.closed = True
+            _SESSION.reset(token)
 
     # -------------- HANDLERS --------------
     async def on_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -465,13 +598,14 @@ class TgApp:
         if not u or u.id != ADMIN_ID:
             return
         try:
-            users_count = len(DB)
-            balances = sum((DB[k].get("balance", 0) or 0) for k in DB)
-            models = sum(1 for k in DB if DB[k].get("has_model"))
-            paid = sum(1 for k in DB if DB[k].get("paid_any"))
-            ref_total = sum(float(DB[k].get("ref_earn_total", 0.0) or 0.0) for k in DB)
-            ref_ready = sum(float(DB[k].get("ref_earn_ready", 0.0) or 0.0) for k in DB)
-            oldest_ts = min((DB[k].get("first_seen_ts") or time.time()) for k in DB) if DB else time.time()
+            agg = AGG.snapshot()
+            users_count = agg["users"]
+            balances = agg["balances"]
+            models = agg["models"]
+            paid = agg["paid"]
+            ref_total = agg["ref_total"]
+            ref_ready = agg["ref_ready"]
+            oldest_ts = agg["oldest_ts"] or time.time()
             uptime_days = (time.time() - oldest_ts) / 86400.0
 
             msg = (
@@ -491,15 +625,7 @@ class TgApp:
     async def _start_payment(self, uid: int, qty: int, amount_rub: int, title: str):
         """Создаём платёж через backend, получаем ссылку и показываем пользователю."""
         try:
-            async with httpx.AsyncClient(timeout=30) as cl:
-                r = await cl.post(f"{BACKEND_ROOT}/api/pay", json={
-                    "user_id": int(uid),
-                    "qty": int(qty),
-                    "amount": int(amount_rub),
-                    "title": str(title)
-                })
-                r.raise_for_status()
-                data = r.json()
+            data = await self.backend.create_payment(uid, qty, amount_rub, title)
         except Exception as e:
             return None, f"❌ Ошибка инициализации оплаты: {e!r}"
         url = data.get("confirmation_url")
@@ -629,19 +755,27 @@ class TgApp:
                 else:
                     await q.message.reply_text("Нет доступных генераций. Пополните баланс.", reply_markup=kb_buy_or_back()); return
 
-            await q.message.reply_text("🎨 Генерируем 3 изображения… ~30–60 секунд.")
-            try:
-                imgs = await self._generate(uid, st.job_id, prompt, 3)
-            except Exception:
-                await context.bot.send_message(chat_id=uid, text="❌ Ошибка при генерации. Попробуйте ещё раз.")
-                return
-            st.balance -= 3; save_user(st)
-            media = [InputMediaPhoto(imgs[0], caption=f"Готово! Списано: 3. Остаток: <b>{st.balance}</b>", parse_mode=ParseMode.HTML)] + [InputMediaPhoto(u) for u in imgs[1:]]
-            await context.bot.send_media_group(chat_id=uid, media=media)
-            if st.gender_pref in ("men", "women"):
-                await context.bot.send_message(chat_id=uid, text="Ещё стиль?", reply_markup=kb_categories(st.gender_pref))
-            else:
-                await context.bot.send_message(chat_id=uid, text="Ещё стиль?", reply_markup=kb_gender())
+            running = self._gens.get(uid) or {}
+            if prompt in running:
+                # повторное нажатие — результат придёт от уже идущей генерации
+                self.gen_stats["attached"] += 1
+                await q.message.reply_text("⏳ Этот стиль уже генерируется — пришлём результат, как только он будет готов."); return
+            if len(running) >= GEN_PER_USER_MAX:
+                self.gen_stats["capped"] += 1
+                await q.message.reply_text(f"⏳ Уже идёт генераций: {len(running)}. Дождитесь результата и выберите следующий стиль."); return
+
+            # резерв до генерации: баланс не уходит в минус при параллельных стилях
+            async with user_lock(uid):
+                st = get_user(uid, fresh=True)
+                if st.balance < GEN_COST:
+                    await q.message.reply_text("Нет доступных генераций. Пополните баланс.", reply_markup=kb_buy_or_back()); return
+                st.balance -= GEN_COST; save_user(st)
+
+            status_msg = await q.message.reply_text("🎨 Генерируем 3 изображения… ~30–60 секунд.")
+            # генерация — вне очереди апдейтов пользователя: повторные нажатия обрабатываются сразу
+            task = asyncio.create_task(self._run_generation(uid, st.job_id, prompt, status_msg, context))
+            self._gens.setdefault(uid, {})[prompt] = task
+            self.gen_stats["started"] += 1
             return
 
         # —— спец-офферы покупки
@@ -652,8 +786,10 @@ class TgApp:
                 await q.message.reply_text(err); return
             pay_url, pid = info
             # привяжем тип покупки к payment_id, чтобы по подтверждению отметить покупку корректно
-            st.purchases[pid] = "spec1" if data.endswith("spec1") else "spec2"
-            save_user(st)
+            async with user_lock(uid):
+                st = get_user(uid, fresh=True)
+                st.purchases[pid] = "spec1" if data.endswith("spec1") else "spec2"
+                save_user(st)
             await q.message.reply_text(
                 f"🧾 К оплате: <b>{spec['price']} ₽</b>\nПакет: <b>{spec['qty']}</b> генераций.\n\n"
                 "Нажми «Оплатить», затем «✅ Я оплатил(а)» для проверки.",
@@ -668,10 +804,7 @@ class TgApp:
         if data.startswith("paycheck:"):
             payment_id = data.split(":", 1)[1]
             try:
-                async with httpx.AsyncClient(timeout=20) as cl:
-                    r = await cl.get(f"{BACKEND_ROOT}/api/pay/status", params={"payment_id": payment_id})
-                    r.raise_for_status()
-                    d = r.json()
+                d = await self.backend.payment_status(payment_id)
             except Exception:
                 await q.message.reply_text("⏳ Платёж ещё не подтверждён. Попробуйте через минуту."); return
 
@@ -679,14 +812,15 @@ class TgApp:
             if status != "succeeded":
                 await q.message.reply_text("⏳ Платёж ещё не подтверждён. Попробуйте позже."); return
 
-            # отметим, что это был спец-оффер (если да)
-            st = get_user(uid)
-            tag = (st.purchases or {}).pop(payment_id, None)
-            if tag == "spec1":
-                st.bought_spec1 = True
-            elif tag == "spec2":
-                st.bought_spec2 = True
-            save_user(st)
+            # отметим, что это был спец-оффер (если да); баланс уже начислен — перечитываем
+            async with user_lock(uid):
+                st = get_user(uid, fresh=True)
+                tag = (st.purchases or {}).pop(payment_id, None)
+                if tag == "spec1":
+                    st.bought_spec1 = True
+                elif tag == "spec2":
+                    st.bought_spec2 = True
+                save_user(st)
 
             await q.message.reply_text(
                 f"✅ Платёж подтверждён. Текущий баланс: <b>{st.balance}</b>.",
@@ -743,9 +877,12 @@ class TgApp:
 
         if data == "ref_income":
             u = get_user(uid)
+            await USERS.async_flush(timeout=2.0)  # начисление только что оплаченного — уже в базе
+            totals = USERS.accrual_totals(uid)  # журнал начислений, индекс по referrer_id
             await q.message.reply_text(
                 "📈 <b>Мои доходы</b>\n\n"
-                f"Всего начислено: <b>{u.ref_earn_total:.2f} ₽</b>\n"
+                f"Всего начислено: <b>{float(totals['commission']):.2f} ₽</b> "
+                f"(оплат приглашённых: {int(totals['payments'])})\n"
                 f"Доступно к выводу: <b>{u.ref_earn_ready:.2f} ₽</b>\n"
                 "Минимальная сумма к выводу: <b>500 ₽</b>.\n\n"
                 "Начисления поступают после каждой оплаты приглашённых пользователей.",
@@ -754,17 +891,13 @@ class TgApp:
 
         if data == "ref_list":
             refs: List[Dict[str, Any]] = []
-            for k, v in DB.items():
-                try:
-                    if int(v.get("referred_by") or 0) == uid:
-                        refs.append({
-                            "id": int(k),
-                            "paid": bool(v.get("paid_any")),
-                            "balance": int(v.get("balance") or 0),
-                            "first_seen_ts": float(v.get("first_seen_ts") or 0.0),
-                        })
-                except Exception:
-                    continue
+            for v in USERS.get_many(REFS.referees(uid)):  # O(рефералов), без скана всех пользователей
+                refs.append({
+                    "id": int(v["id"]),
+                    "paid": bool(v.get("paid_any")),
+                    "balance": int(v.get("balance") or 0),
+                    "first_seen_ts": float(v.get("first_seen_ts") or 0.0),
+                })
             refs.sort(key=lambda x: x.get("first_seen_ts") or 0, reverse=True)
 
             if not refs:
@@ -827,12 +960,7 @@ class TgApp:
         local_path = os.path.join(PHOTOS_TMP, f"{uid}_{int(time.time())}.jpg")
         await file.download_to_drive(local_path)
         try:
-            async with httpx.AsyncClient(timeout=120) as cl:
-                with open(local_path, "rb") as f:
-                    data = {"user_id": str(uid)}
-                    files = {"file": ("photo.jpg", f, "image/jpeg")}
-                    r = await cl.post(f"{BACKEND_ROOT}/api/upload_photo", data=data, files=files)
-                    r.raise_for_status()
+            await self.backend.upload_photo(uid, local_path, "photo.jpg")
         except Exception:
             pass
 
@@ -843,12 +971,9 @@ class TgApp:
             await context.bot.send_message(chat_id=uid, text="ℹ️ Модель уже обучена. Переходим к генерациям:", reply_markup=kb_gender())
             return
         try:
-            async with httpx.AsyncClient(timeout=180) as cl:
-                r = await cl.post(f"{BACKEND_ROOT}/api/train", data={"user_id": str(uid)})
-                r.raise_for_status()
-                job_id = r.json().get("job_id")
-                if not job_id:
-                    raise RuntimeError("no job_id from backend")
+            job_id = (await self.backend.start_training(uid)).get("job_id")
+            if not job_id:
+                raise RuntimeError("no job_id from backend")
         except Exception:
             await context.bot.send_message(chat_id=uid, text="❌ Не удалось запустить обучение. Попробуйте ещё раз.")
             return
@@ -856,28 +981,32 @@ class TgApp:
         st.job_id = job_id
         save_user(st)
 
-        status_url = f"{BACKEND_ROOT}/api/status/{job_id}"
-        for _ in range(300):
+        deadline = time.time() + TRAIN_WAIT_TIMEOUT
+        while time.time() < deadline:
             try:
-                async with httpx.AsyncClient(timeout=30) as cl:
-                    rr = await cl.get(status_url)
-                    rr.raise_for_status()
-                    dd = rr.json()
-                    status = (dd.get("status") or "").lower()
-                    model_id = dd.get("model_id")
-                    if model_id:
-                        st.has_model = True
-                        st.model_id = model_id
-                        save_user(st)
-                        break
-                    if status in ("failed", "canceled", "cancelled", "error"):
-                        await context.bot.send_message(chat_id=uid, text="❌ Обучение не удалось. Попробуйте ещё раз.")
-                        return
+                dd = await self.backend.training_status(job_id)
+                status = (dd.get("status") or "").lower()
+                model_id = dd.get("model_id")
+                if model_id:
+                    st.has_model = True
+                    st.model_id = model_id
+                    st.model_version = dd.get("model_version") or st.model_version
+                    save_user(st)
+                    break
+                if status in ("failed", "canceled", "cancelled", "error"):
+                    await context.bot.send_message(chat_id=uid, text="❌ Обучение не удалось. Попробуйте ещё раз.")
+                    return
             except Exception:
                 pass
-            await asyncio.sleep(2)
+            # in-process: просыпаемся по вебхуку Replicate, опрос — только страховочный
+            await self.backend.wait_job(job_id, TRAIN_SAFETY_POLL)
 
         if not st.has_model:
+            try:
+                await self.backend.cancel_job(job_id)  # не ждём — не платим за GPU
+            except Exception as e:
+                # уже завершилось/неизвестно — пользователю всё равно сообщаем о таймауте
+                log.warning(f"cancel training job {job_id} failed: {e!r}")
             await context.bot.send_message(chat_id=uid, text="❌ Время ожидания вышло. Попробуйте позже.")
             return
 
@@ -890,36 +1019,122 @@ class TgApp:
             reply_markup=kb_gender(), parse_mode=ParseMode.HTML
         )
 
-    async def _generate(self, uid: int, job_id: Optional[str], prompt: str, n: int) -> List[str]:
-        body = {"user_id": str(uid), "prompt": prompt, "num_images": n}
-        if job_id:
-            body["job_id"] = job_id
-        async with httpx.AsyncClient(timeout=240) as cl:
-            r = await cl.post(f"{BACKEND_ROOT}/api/generate", json=body)
-            r.raise_for_status()
-            data = r.json()
-            urls = data.get("images") or []
-            if not urls:
-                raise RuntimeError("empty images")
-            return urls
-
-    # ---------- FLASH OFFER SCHEDULER ----------
-    async def _flash_offer_scheduler(self):
-        """Через ~24 часа после первого входа — разовая акция 60 генераций за 390₽."""
-        while True:
-            now = time.time()
+    async def _run_generation(self, uid: int, job_id: Optional[str], prompt: str, status_msg, context: ContextTypes.DEFAULT_TYPE):
+        """Генерация с уже списанным резервом GEN_COST (по одной за изображение); недополученные возвращаются."""
+
+        async def on_queued(pos: int):
+            # сервис загружен — показать место в очереди вместо обещанных 30–60 секунд
+            await status_msg.edit_text(f"⏳ Сейчас много запросов — вы №{pos} в очереди. Генерация начнётся автоматически.")
+
+        deadline = time.time() + GEN_DEADLINE
+        got = 0        # доставлено в чат изображений — столько и списывается
+        settled = False
+        sends: List[asyncio.Task] = []
+
+        async def refund(n: int) -> UserState:
+            async with user_lock(uid):
+                st = get_user(uid, fresh=True)
+                if n > 0:
+                    st.balance += n; save_user(st)
+            if n > 0:
+                self.gen_stats["refunded"] += n
+            return st
+
+        async def settle() -> UserState:
+            """Один раз, когда отправки завершены: вернуть резерв за недоставленные изображения."""
+            nonlocal settled
+            settled = True
+            return await refund(GEN_COST - got)
+
+        async def deliver(url: str):
+            nonlocal got
+            await context.bot.send_photo(chat_id=uid, photo=url)
+            got += 1
+            if got < GEN_COST:
+                try:
+                    await status_msg.edit_text(f"🎨 Готово {got} из {GEN_COST}…")
+                except Exception:
+                    pass
+
+        async def on_image(i: int, url: Optional[str]):
+            # только запускает отправку: генерация следующих не ждёт Telegram
+            if url:
+                sends.append(asyncio.create_task(deliver(url)))
+
+        async def drain(cancel: bool) -> None:
+            if cancel:
+                for t in sends:
+                    t.cancel()
+            for r in await asyncio.gather(*sends, return_exceptions=True):
+                if isinstance(r, Exception):
+                    log.warning(f"photo delivery failed uid={uid}: {r!r}")
+
+        try:
             try:
-                for k, v in list(DB.items()):
-                    st = UserState(**v)
-                    if st.flash_sent:
-                        continue
-                    if now - (st.first_seen_ts or now) >= 24 * 3600:
-                        await self._send_flash_offer(st.id)
-                        st.flash_sent = True
-                        save_user(st)
-            except Exception:
-                pass
-            await asyncio.sleep(1800)
+                if GEN_FANOUT:
+                    await self.backend.generate_each(uid, prompt, GEN_COST, job_id, on_image=on_image,
+                                                     on_queued=on_queued, deadline=deadline)
+                    await drain(cancel=False)
+                    st = await settle()
+                    if not got:
+                        raise RuntimeError("empty images")
+                    caption = f"Готово! Списано: {got}. Остаток: <b>{st.balance}</b>"
+                    if got < GEN_COST:
+                        caption += f"\nНе удалось: {GEN_COST - got} — возвращены на баланс."
+                    await context.bot.send_message(chat_id=uid, text=caption, parse_mode=ParseMode.HTML)
+                else:
+                    imgs = (await self._generate(uid, job_id, prompt, GEN_COST, on_queued=on_queued, deadline=deadline))[:GEN_COST]
+                    got = len(imgs)
+                    st = await settle()  # недополученные — сразу; доставку альбома ниже
+                    media = [InputMediaPhoto(imgs[0], caption=f"Готово! Списано: {got}. Остаток: <b>{st.balance}</b>", parse_mode=ParseMode.HTML)] + [InputMediaPhoto(u) for u in imgs[1:]]
+                    try:
+                        await context.bot.send_media_group(chat_id=uid, media=media)
+                    except BaseException:
+                        n, got = got, 0
+                        await refund(n)  # альбом не дошёл — не списываем
+                        raise
+            except BaseException as e:
+                if not settled:
+                    await drain(cancel=True)
+                    await settle()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                if not got:
+                    await context.bot.send_message(chat_id=uid, text="❌ Ошибка при генерации. Генерации возвращены на баланс — попробуйте ещё раз.")
+                    return
+                log.warning(f"generation uid={uid} finished partially: {e!r}")
+            st = get_user(uid, fresh=True)
+            if st.gender_pref in ("men", "women"):
+                await context.bot.send_message(chat_id=uid, text="Ещё стиль?", reply_markup=kb_categories(st.gender_pref))
+            else:
+                await context.bot.send_message(chat_id=uid, text="Ещё стиль?", reply_markup=kb_gender())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"generation delivery failed uid={uid}: {e!r}")
+        finally:
+            per_user = self._gens.get(uid)
+            if per_user is not None:
+                per_user.pop(prompt, None)
+                if not per_user:
+                    self._gens.pop(uid, None)
+
+    async def _generate(self, uid: int, job_id: Optional[str], prompt: str, n: int, on_queued=None,
+                        deadline: Optional[float] = None) -> List[str]:
+        urls = await self.backend.generate(uid, prompt, n, job_id, on_queued=on_queued, deadline=deadline)
+        if not urls:
+            raise RuntimeError("empty images")
+        return urls
+
+    # ---------- FLASH OFFER ----------
+    async def _on_flash_timer(self, uid: int, payload: Dict[str, Any]):
+        """Через 24 часа после первого входа — разовая акция 60 генераций за 390₽."""
+        st = get_user(uid)
+        if st.flash_sent:
+            return
+        await self._send_flash_offer(st.id)
+        st.flash_sent = True
+        save_user(st)
 
     async def _send_flash_offer(self, uid: int):
         # клавиатура акции
@@ -0,0 +1,124 @@
+# breaker.py
+import os
+import time
+import logging
+from collections import deque
+from typing import Dict, Any, Deque
+
+log = logging.getLogger("breaker")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """
+    Размыкатель на одну модель.
+      closed    — вызовы идут; доля ошибок в окне последних window вызовов >= failure_rate
+                  (при минимум min_calls вызовах) — переход в open;
+      open      — вызовы не пропускаются open_seconds (сразу запасная модель);
+      half_open — пропускается до trials пробных вызовов: успех — closed, ошибка — снова open.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 open_seconds: float = 30.0, trials: int = 1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.trials = max(1, trials)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._results: Deque[bool] = deque(maxlen=max(window, min_calls))  # True — ошибка
+        self._trials_inflight = 0
+        self.stats = {"calls": 0, "failures": 0, "short_circuited": 0, "opened": 0}
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.stats["short_circuited"] += 1
+                return False
+            self.state = HALF_OPEN
+            self._trials_inflight = 0
+            log.info("breaker %s: half-open", self.name)
+        if self.state == HALF_OPEN:
+            if self._trials_inflight >= self.trials:
+                self.stats["short_circuited"] += 1
+                return False
+            self._trials_inflight += 1
+        self.stats["calls"] += 1
+        return True
+
+    def success(self) -> None:
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self._results.clear()
+            log.info("breaker %s: closed", self.name)
+            return
+        self._results.append(False)
+
+    def failure(self) -> None:
+        self.stats["failures"] += 1
+        if self.state == HALF_OPEN:
+            self._trip()
+            return
+        self._results.append(True)
+        n = len(self._results)
+        if n >= self.min_calls and sum(self._results) / n >= self.failure_rate:
+            self._trip()
+
+    def abandon(self) -> None:
+        """Вызов прерван без результата (отмена) — освободить пробный слот."""
+        if self.state == HALF_OPEN and self._trials_inflight > 0:
+            self._trials_inflight -= 1
+
+    def _trip(self) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._results.clear()
+        self.stats["opened"] += 1
+        log.warning("breaker %s: open for %.0fs", self.name, self.open_seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"state": self.state, **self.stats}
+        if self._results:
+            out["window_failure_rate"] = round(sum(self._results) / len(self._results), 3)
+        if self.state == OPEN:
+            out["retry_in_s"] = round(max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1)
+        return out
+
+
+class BreakerRegistry:
+    """Размыкатели по указателю модели (owner/model без версии)."""
+
+    def __init__(self, max_entries: int = 2000, **params: Any):
+        self.params = params
+        self.max_entries = max_entries
+        self._items: Dict[str, CircuitBreaker] = {}
+
+    def get(self, key: str) -> CircuitBreaker:
+        br = self._items.get(key)
+        if br is None:
+            if len(self._items) >= self.max_entries:
+                self._prune()
+            br = self._items[key] = CircuitBreaker(key, **self.params)
+        return br
+
+    def _prune(self) -> None:
+        # LoRA пользователей — по модели на пользователя; здоровые закрытые забываем
+        for k, br in list(self._items.items()):
+            if br.state == CLOSED and not any(br._results):
+                self._items.pop(k, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        not_closed = {k: br.snapshot() for k, br in self._items.items() if br.state != CLOSED}
+        return {"tracked": len(self._items), "not_closed": not_closed,
+                "opened_total": sum(br.stats["opened"] for br in self._items.values())}
+
+
+BREAKERS = BreakerRegistry(
+    window=int(os.getenv("BREAKER_WINDOW", "20")),
+    min_calls=int(os.getenv("BREAKER_MIN_CALLS", "5")),
+    failure_rate=float(os.getenv("BREAKER_FAILURE_RATE", "0.5")),
+    open_seconds=float(os.getenv("BREAKER_OPEN_SECONDS", "30")),
+    trials=int(os.getenv("BREAKER_HALF_OPEN_TRIALS", "1")),
+)
@@ -0,0 +1,104 @@
+# dispatch.py
+import asyncio
+import logging
+import contextlib
+from collections import deque
+from typing import Dict, Any, Callable, Awaitable, Deque, Hashable, List
+
+log = logging.getLogger("dispatch")
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ (user_id). Запись удаляется, когда лок никто не держит и не ждёт."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List[Any]] = {}  # key -> [lock, refs]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable):
+        ent = self._locks.get(key)
+        if ent is None:
+            ent = self._locks[key] = [asyncio.Lock(), 0]
+        ent[1] += 1
+        try:
+            async with ent[0]:
+                yield
+        finally:
+            ent[1] -= 1
+            if ent[1] == 0:
+                self._locks.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class KeyedDispatcher:
+    """
+    Обработка апдейтов: разные ключи (пользователи) — параллельно, один ключ — строго по порядку.
+    На ключ одна корутина-обработчик, которая разбирает его очередь и завершается, когда она пуста.
+    Общее число одновременно обрабатываемых элементов ограничено семафором.
+    """
+
+    def __init__(self, handler: Callable[[Any], Awaitable[None]], concurrency: int = 64, max_pending: int = 50):
+        self.handler = handler
+        self.max_pending = int(max_pending)
+        self._sem = asyncio.Semaphore(max(1, int(concurrency)))
+        self._queues: Dict[Hashable, Deque[Any]] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._closed = False
+        self.stats = {"submitted": 0, "processed": 0, "errors": 0, "dropped": 0, "active": 0}
+
+    def submit(self, key: Hashable, item: Any) -> bool:
+        """Поставить в очередь ключа. False — очередь ключа переполнена или диспетчер остановлен."""
+        if self._closed:
+            return False
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = deque()
+        if len(q) >= self.max_pending:
+            self.stats["dropped"] += 1
+            log.warning("dispatch queue full for key=%s, update dropped", key)
+            return False
+        q.append(item)
+        self.stats["submitted"] += 1
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._drain(key))
+        return True
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "keys": len(self._tasks), "pending": self.pending()}
+
+    async def _drain(self, key: Hashable) -> None:
+        q = self._queues[key]
+        try:
+            while q:
+                item = q.popleft()
+                async with self._sem:
+                    self.stats["active"] += 1
+                    try:
+                        await self.handler(item)
+                        self.stats["processed"] += 1
+                    except Exception as e:
+                        self.stats["errors"] += 1
+                        log.exception("update handler crashed (key=%s): %r", key, e)
+                    finally:
+                        self.stats["active"] -= 1
+        finally:
+            self._tasks.pop(key, None)
+            if not q:
+                self._queues.pop(key, None)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Перестать принимать и дождаться текущих очередей (не дольше timeout)."""
+        self._closed = True
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        done, rest = await asyncio.wait(tasks, timeout=timeout)
+        for t in rest:
+            t.cancel()
+        if rest:
+            log.warning("dispatch stop: %d key queues cancelled", len(rest))
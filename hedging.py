@@ -0,0 +1,109 @@
+# hedging.py
+import os
+import re
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Deque
+
+log = logging.getLogger("hedging")
+
+_FRAC = re.compile(r"(\.\d{6})\d+")
+
+
+def parse_ts(v: Any) -> Optional[float]:
+    """ISO-время Replicate ('2024-05-01T10:00:00.123456789Z') -> unix ts."""
+    if not isinstance(v, str) or not v:
+        return None
+    try:
+        s = _FRAC.sub(r"\1", v.strip()).replace("Z", "+00:00")
+        dt = datetime.fromisoformat(s)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+    except ValueError:
+        return None
+
+
+class HedgePolicy:
+    """
+    Хедж генерации при холодном старте: если предсказание не вышло из starting
+    к p95 наблюдаемого времени старта (created_at -> started_at), запускается дубль
+    той же версии (может попасть на уже поднятый инстанс); побеждает первый результат,
+    проигравший отменяется.
+    Доля хеджей ограничена max_rate от всех генераций (бюджет, как у повторов).
+    """
+
+    def __init__(self, enabled: bool = True, max_rate: float = 0.1, min_after: float = 8.0,
+                 default_after: float = 25.0, min_samples: int = 20, window: int = 200):
+        self.enabled = enabled
+        self.max_rate = max_rate
+        self.min_after = min_after
+        self.default_after = default_after
+        self.min_samples = min_samples
+        self.window = window
+        self._boots: Dict[str, Deque[float]] = {}
+        self._all: Deque[float] = deque(maxlen=window)
+        self._budget = 1.0
+        self.stats = {"generations": 0, "hedges": 0, "hedge_wins": 0, "primary_wins": 0,
+                      "both_failed": 0, "denied_by_rate": 0, "launch_failed": 0, "losers_cancelled": 0}
+
+    def observe(self, obj: Dict[str, Any]) -> None:
+        """Время старта из ответа Replicate (есть started_at — модель поднялась)."""
+        created, started = parse_ts(obj.get("created_at")), parse_ts(obj.get("started_at"))
+        if created is None or started is None or started < created:
+            return
+        boot = started - created
+        model = str(obj.get("model") or obj.get("version") or "")
+        if model:
+            dq = self._boots.get(model)
+            if dq is None:
+                if len(self._boots) > 500:
+                    self._boots.clear()
+                dq = self._boots[model] = deque(maxlen=self.window)
+            dq.append(boot)
+        self._all.append(boot)
+
+    def _p95(self, samples: Deque[float]) -> float:
+        xs = sorted(samples)
+        return xs[int(0.95 * (len(xs) - 1))]
+
+    def hedge_after(self, model: Optional[str] = None) -> float:
+        """Сколько секунд от создания ждать выхода из starting; своей модели мало замеров — общий p95."""
+        dq = self._boots.get(model or "")
+        if dq is not None and len(dq) >= self.min_samples:
+            after = self._p95(dq)
+        elif len(self._all) >= self.min_samples:
+            after = self._p95(self._all)
+        else:
+            after = self.default_after
+        return max(self.min_after, after)
+
+    def generation(self) -> None:
+        self.stats["generations"] += 1
+        self._budget = min(5.0, self._budget + self.max_rate)
+
+    def allow(self) -> bool:
+        if not self.enabled:
+            return False
+        if self._budget < 1.0:
+            self.stats["denied_by_rate"] += 1
+            return False
+        self._budget -= 1.0
+        self.stats["hedges"] += 1
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        g = self.stats["generations"]
+        return {**self.stats, "enabled": self.enabled, "max_rate": self.max_rate,
+                "hedge_rate": round(self.stats["hedges"] / g, 3) if g else None,
+                "hedge_after_s": round(self.hedge_after(), 1), "boot_samples": len(self._all)}
+
+
+HEDGE = HedgePolicy(
+    enabled=(os.getenv("HEDGE_ENABLED", "1").strip().lower() in ("1", "true", "yes")),
+    max_rate=float(os.getenv("HEDGE_MAX_RATE", "0.1")),
+    min_after=float(os.getenv("HEDGE_MIN_AFTER", "8")),
+    default_after=float(os.getenv("HEDGE_DEFAULT_AFTER", "25")),
+    min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", "20")),
+)
@@ -0,0 +1,131 @@
+# httpclients.py
+import os
+import logging
+from typing import Dict, Any, Optional
+
+import httpx
+
+log = logging.getLogger("httpclients")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401  (httpx[http2])
+        return True
+    except ImportError:
+        return False
+
+
+class ClientPool:
+    """
+    Долгоживущий httpx.AsyncClient на один апстрим: keep-alive соединения переиспользуются
+    между запросами (без нового TCP/TLS на каждый вызов). Лимиты — из env с префиксом.
+    """
+
+    def __init__(self, name: str, prefix: str, max_connections: int, max_keepalive: int,
+                 keepalive_expiry: float = 30.0, timeout: float = 60.0, trust_env: bool = False):
+        self.name = name
+        self.max_connections = _env_int(f"{prefix}_HTTP_MAX_CONN", max_connections)
+        self.max_keepalive = _env_int(f"{prefix}_HTTP_KEEPALIVE", max_keepalive)
+        self.keepalive_expiry = float(os.getenv(f"{prefix}_HTTP_KEEPALIVE_EXPIRY", str(keepalive_expiry)))
+        self.timeout = timeout
+        self.trust_env = trust_env
+        self.http2 = (os.getenv(f"{prefix}_HTTP2", "0").strip().lower() in ("1", "true", "yes"))
+        if self.http2 and not _h2_available():
+            log.warning("%s: HTTP/2 requested but package h2 is not installed — using HTTP/1.1", name)
+            self.http2 = False
+        self._client: Optional[httpx.AsyncClient] = None
+        self.stats = {"requests": 0, "responses": 0, "opened": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # создаётся в startup; лениво — для вызовов вне жизненного цикла приложения (скрипты, тесты)
+        if self._client is None or self._client.is_closed:
+            self.start()
+        return self._client
+
+    def start(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            return
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_keepalive,
+                                keepalive_expiry=self.keepalive_expiry),
+            http2=self.http2,
+            trust_env=self.trust_env,
+            event_hooks={"request": [self._on_request], "response": [self._on_response]},
+        )
+        self.stats["opened"] += 1
+        log.info("%s pool: max_conn=%d keepalive=%d http2=%s", self.name, self.max_connections, self.max_keepalive, self.http2)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self.stats["requests"] += 1
+
+    async def _on_response(self, response: httpx.Response) -> None:
+        self.stats["responses"] += 1
+
+    def _pool_state(self) -> Optional[Dict[str, int]]:
+        """
+        Соединения пула httpcore. Это приватные атрибуты (_transport._pool, _requests):
+        доступ только через getattr с умолчаниями; несовместимая версия — None, а не ошибка.
+        """
+        try:
+            pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+            conns = getattr(pool, "connections", None)
+            if conns is None:
+                return None
+            conns = list(conns)
+            idle = sum(1 for c in conns if callable(getattr(c, "is_idle", None)) and c.is_idle())
+            # httpcore держит очередь запросов пула; без назначенного соединения — ждут свободного слота
+            waiting = sum(1 for r in (getattr(pool, "_requests", None) or []) if getattr(r, "connection", object()) is None)
+        except Exception as e:
+            log.debug("%s pool state unavailable: %r", self.name, e)
+            return None
+        return {"connections": len(conns), "active": len(conns) - idle, "idle": idle, "waiting": waiting}
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {**self.stats, "max_connections": self.max_connections,
+                               "max_keepalive": self.max_keepalive, "http2": self.http2}
+        st = self._pool_state()
+        if st is None:
+            out.update({"connections": None, "active": None, "idle": None, "waiting": None, "utilization": None})
+            return out
+        out.update(st)
+        out["utilization"] = round(st["active"] / self.max_connections, 3) if self.max_connections else None
+        return out
+
+
+# один пул на апстрим, на всё время жизни приложения
+REPLICATE_HTTP = ClientPool("replicate", "REPLICATE", max_connections=50, max_keepalive=20, timeout=180.0)
+YOOKASSA_HTTP = ClientPool("yookassa", "YOOKASSA", max_connections=20, max_keepalive=10, timeout=20.0, trust_env=True)
+POOLS = (REPLICATE_HTTP, YOOKASSA_HTTP)
+
+
+def start_all() -> None:
+    for p in POOLS:
+        p.start()
+
+
+async def close_all() -> None:
+    for p in POOLS:
+        try:
+            await p.close()
+        except Exception as e:
+            log.warning("%s pool close failed: %r", p.name, e)
+
+
+def snapshot_all() -> Dict[str, Any]:
+    return {p.name: p.snapshot() for p in POOLS}
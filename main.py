@@ -1,15 +1,31 @@
 # main.py
-import os, io, zipfile, uuid, time, logging, asyncio, base64, json, smtplib
+import os, io, csv, zipfile, uuid, time, logging, asyncio, base64, json, smtplib, contextlib
 from typing import Dict, Any, Optional, List, Tuple
 
 import httpx
 from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form, Response
+from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from telegram import Update
 from telegram.error import TelegramError
 from email.message import EmailMessage
 
-from bot import tg_app, get_user, save_user, DB  # добавил DB для админки
+from bot import tg_app, get_user, save_user, user_lock, USERS, REFS, AGG, COLS  # USERS — хранилище пользователей для админки
+from referrals import make_accrual
+from payledger import PaymentLedger
+import httpclients
+from services import InProcessBackend
+from versions import VERSIONS
+from singleflight import SingleFlight
+from replicate_hooks import WatchRegistry, verify_signature, TERMINAL
+from poller import StatusPoller
+from httpclients import REPLICATE_HTTP
+from admission import ADMISSION, OnQueued
+import outbound
+from outbound import REPLICATE_OUT, YOOKASSA_OUT
+from breaker import BREAKERS
+from hedging import HEDGE, parse_ts
+from mirror import MIRROR
 
 # ---------- ENV ----------
 BOT_TOKEN = (os.getenv("BOT_TOKEN") or "").strip()
@@ -18,6 +34,15 @@ WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "hook").strip()
 BACKEND_ROOT = (os.getenv("BACKEND_ROOT") or "").rstrip("/")
 
 REPLICATE_API_TOKEN = (os.getenv("REPLICATE_API_TOKEN") or "").strip()
+REPLICATE_API_BASE = (os.getenv("REPLICATE_API_BASE") or "https://api.replicate.com").rstrip("/")
+
+# вебхуки Replicate вместо частого опроса; без адреса/секрета — опрос раз в 2 с, как раньше
+REPLICATE_WEBHOOK_URL = (os.getenv("REPLICATE_WEBHOOK_URL") or (f"{PUBLIC_URL}/replicate/webhook" if PUBLIC_URL else "")).strip()
+REPLICATE_WEBHOOK_SECRET = (os.getenv("REPLICATE_WEBHOOK_SECRET") or "").strip()
+REPLICATE_SAFETY_POLL = float(os.getenv("REPLICATE_SAFETY_POLL", "15"))  # страховочный опрос при вебхуках
+REPLICATE_GEN_TIMEOUT = float(os.getenv("REPLICATE_GEN_TIMEOUT", "120"))
+# синхронный режим: create держится открытым до результата (Prefer: wait=N, 1..60 с); 0 — выключен
+REPLICATE_PREFER_WAIT = max(0, min(60, int(os.getenv("REPLICATE_PREFER_WAIT", "30"))))
 
 # тренер
 REPLICATE_TRAIN_OWNER = os.getenv("REPLICATE_TRAIN_OWNER", "replicate").strip()
@@ -65,33 +90,42 @@ BASE_DIR = os.getenv("DATA_DIR", "/var/data")
 DATA_DIR = BASE_DIR
 USERS_DIR = os.path.join(DATA_DIR, "users")
 UPLOADS_DIR = os.path.join(DATA_DIR, "uploads")
-PAY_DB_PATH = os.path.join(DATA_DIR, "payments.json")
+PAY_DB_PATH = os.path.join(DATA_DIR, "payments.json")  # legacy, переносится в журнал при первом старте
 os.makedirs(USERS_DIR, exist_ok=True)
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
-def _pay_db_load() -> Dict[str, Any]:
-    if not os.path.exists(PAY_DB_PATH):
-        return {}
-    try:
-        with open(PAY_DB_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
-
-def _pay_db_save(db: Dict[str, Any]) -> None:
-    tmp = PAY_DB_PATH + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, PAY_DB_PATH)
-
 app.mount("/uploads", StaticFiles(directory=UPLOADS_DIR), name="uploads")
 
 jobs: Dict[str, Dict[str, Any]] = {}
-PAYMENTS: Dict[str, Any] = _pay_db_load()  # payment_id -> info
+_job_by_training: Dict[str, str] = {}  # training_id -> job_id (для вебхуков)
+# ожидающие финала предсказаний/тренировок; будит /replicate/webhook
+HOOKS = WatchRegistry()
+
+def _hooks_enabled() -> bool:
+    return bool(REPLICATE_WEBHOOK_URL and REPLICATE_WEBHOOK_SECRET)
+
+def _webhook_fields() -> Dict[str, Any]:
+    if not _hooks_enabled():
+        return {}
+    return {"webhook": REPLICATE_WEBHOOK_URL, "webhook_events_filter": ["completed"]}
+# Журнал платежей (дозапись событий + индексы) вместо перезаписи payments.json целиком
+# холодные платежи (не менялись PAY_HOT_DAYS) живут только в таблице payments users.sqlite3
+PAYMENTS = PaymentLedger(DATA_DIR, compact_every=int(os.getenv("PAY_COMPACT_EVERY", "5000")),
+                         flush_interval=float(os.getenv("PAY_FLUSH_INTERVAL", "0.5")),
+                         archive=USERS.inner, hot_days=float(os.getenv("PAY_HOT_DAYS", "7")))
+PAYMENTS.migrate_from_json(PAY_DB_PATH)
+PAYMENTS.listeners.append(COLS.payment_changed)
 
 # ============ TG WEBHOOK ============
 @app.on_event("startup")
 async def startup_event():
+    # пулы соединений к Replicate/YooKassa — на всё время жизни приложения
+    httpclients.start_all()
+    await _load_replicate_webhook_secret()
+    # при вебхуках опрос — только страховочный
+    POLLER.floor = REPLICATE_SAFETY_POLL if _hooks_enabled() else 0.0
+    POLLER.start()
+    await asyncio.to_thread(MIRROR.load)
     await tg_app.initialize()
     await tg_app.start()
     if PUBLIC_URL:
@@ -105,6 +139,19 @@ async def startup_event():
     else:
         log.warning("PUBLIC_URL не задан — вебхук не настроен.")
 
+async def _load_replicate_webhook_secret():
+    """Секрет подписи вебхуков: из ENV или GET /v1/webhooks/default/secret."""
+    global REPLICATE_WEBHOOK_SECRET
+    if REPLICATE_WEBHOOK_SECRET or not (REPLICATE_WEBHOOK_URL and REPLICATE_API_TOKEN):
+        return
+    try:
+        r = await REPLICATE_OUT.request("GET", f"{REPLICATE_API_BASE}/v1/webhooks/default/secret",
+                                        headers={"Authorization": f"Token {REPLICATE_API_TOKEN}"}, timeout=15)
+        r.raise_for_status()
+        REPLICATE_WEBHOOK_SECRET = (r.json().get("key") or "").strip()
+    except Exception as e:
+        log.warning(f"replicate webhook secret fetch failed — polling only: {e!r}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     try:
@@ -113,6 +160,14 @@ async def shutdown_event():
         pass
     await tg_app.stop()
     log.info("🛑 Telegram application stopped")
+    # отмены предсказаний в Replicate, запущенные остановленными генерациями, — до закрытия пулов
+    if _BG_TASKS:
+        await asyncio.wait(list(_BG_TASKS), timeout=10)
+    await POLLER.stop()
+    # досбросить отложенные записи
+    await asyncio.to_thread(PAYMENTS.close)
+    await asyncio.to_thread(USERS.close)
+    await httpclients.close_all()
 
 @app.get("/")
 async def root():
@@ -174,6 +229,24 @@ async def debug_stats():
             "jobs_by_status": by_status,
             "sizes": sizes,
             "payments_total": len(PAYMENTS),
+            "writers": {
+                "users": {**USERS.wb.stats, "pending": USERS.wb.pending_count()},
+                "payments": {**PAYMENTS.wb.stats, "pending": PAYMENTS.wb.pending_count()},
+            },
+            "updates": tg_app.dispatcher.snapshot() if tg_app.dispatcher else None,
+            "http_pools": httpclients.snapshot_all(),
+            "outbound": outbound.snapshot_all(),
+            "version_cache": VERSIONS.snapshot(),
+            "replicate_hooks": {**HOOKS.snapshot(), "enabled": _hooks_enabled()},
+            "replicate_poller": POLLER.snapshot(),
+            "generation": _gen_stats(),
+            "hedging": HEDGE.snapshot(),
+            "mirror": MIRROR.snapshot(),
+            "cancellations": {**CANCEL_STATS, "seconds": round(CANCEL_STATS["seconds"], 1)},
+            "gen_singleflight": {**GEN_FLIGHT.stats, "bot": {**tg_app.gen_stats, "running": sum(len(v) for v in tg_app._gens.values())}},
+            "admission": ADMISSION.snapshot(),
+            "breakers": {**BREAKERS.snapshot(),
+                         "gen_model": BREAKERS.get(_split_model_and_version(REPLICATE_GEN_MODEL)[0]).snapshot()},
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"stats_error: {e!r}")
@@ -204,11 +277,9 @@ async def webhook(secret: str, request: Request):
         raise HTTPException(status_code=403, detail="forbidden")
     data = await request.json()
     update = Update.de_json(data, tg_app.bot)
-    try:
-        await tg_app.process_update(update)
-    except Exception as e:
-        log.exception(f"process_update crashed: {e!r}")
-        return {"ok": False, "error": "handler crashed"}
+    # обработка идёт в очереди пользователя; вебхук отвечает сразу, не дожидаясь генераций
+    if not tg_app.submit(update):
+        return {"ok": False, "error": "queue full"}
     return {"ok": True}
 
 # ============ HELPERS ============
@@ -331,44 +402,42 @@ async def call_replicate_training(images_zip_url: str, user_id: str) -> Dict[str
         "images_zip": images_zip_url,
         "steps": TRAIN_STEPS_DEFAULT,
     }
+    hook = _webhook_fields()
 
     DESTINATION_MODEL = "romamamedov437-sys/user-6064931063-lora"
 
     urls_and_payloads: List[Dict[str, Any]] = []
-    p1: Dict[str, Any] = {"version": version_pointer, "input": dict(base_input), "destination": DESTINATION_MODEL}
-    urls_and_payloads.append({"url": "https://api.replicate.com/v1/trainings", "payload": p1})
-    p2: Dict[str, Any] = {"version": version_pointer, "input": dict(base_input), "destination": DESTINATION_MODEL}
-    urls_and_payloads.append({"url": f"https://api.replicate.com/v1/models/{owner}/{model}/trainings", "payload": p2})
-    p3: Dict[str, Any] = {"input": dict(base_input), "destination": DESTINATION_MODEL}
-    urls_and_payloads.append({"url": f"https://api.replicate.com/v1/models/{owner}/{model}/versions/{version_hash}/trainings", "payload": p3})
-
-    async with httpx.AsyncClient(timeout=180) as cl:
-        for attempt, item in enumerate(urls_and_payloads, 1):
-            try:
-                r = await cl.post(item["url"], headers=headers, json=item["payload"])
-                if r.status_code >= 400:
-                    log.error("Replicate TRAIN attempt %d failed %s: %s", attempt, r.status_code, r.text)
-                r.raise_for_status()
-                return r.json()
-            except httpx.HTTPStatusError as e:
-                last_code = e.response.status_code
-                if last_code == 404:
-                    continue
-                raise HTTPException(status_code=500, detail=f"replicate train failed ({last_code}): {e.response.text}")
-            except Exception:
-                continue
+    p1: Dict[str, Any] = {"version": version_pointer, "input": dict(base_input), "destination": DESTINATION_MODEL, **hook}
+    urls_and_payloads.append({"url": f"{REPLICATE_API_BASE}/v1/trainings", "payload": p1})
+    p2: Dict[str, Any] = {"version": version_pointer, "input": dict(base_input), "destination": DESTINATION_MODEL, **hook}
+    urls_and_payloads.append({"url": f"{REPLICATE_API_BASE}/v1/models/{owner}/{model}/trainings", "payload": p2})
+    p3: Dict[str, Any] = {"input": dict(base_input), "destination": DESTINATION_MODEL, **hook}
+    urls_and_payloads.append({"url": f"{REPLICATE_API_BASE}/v1/models/{owner}/{model}/versions/{version_hash}/trainings", "payload": p3})
+
+    # 404 — следующий вариант URL; 429/503/обрыв соединения повторяет REPLICATE_OUT, прочее — сразу ошибка
+    for attempt, item in enumerate(urls_and_payloads, 1):
+        try:
+            r = await REPLICATE_OUT.request("POST", item["url"], headers=headers, json=item["payload"], timeout=180)
+        except httpx.TransportError as e:
+            raise HTTPException(status_code=502, detail=f"replicate train request failed: {e!r}")
+        if r.status_code == 404:
+            log.warning("Replicate TRAIN attempt %d: 404 at %s", attempt, item["url"])
+            continue
+        if r.status_code >= 400:
+            log.error("Replicate TRAIN attempt %d failed %s: %s", attempt, r.status_code, r.text)
+            raise HTTPException(status_code=500, detail=f"replicate train failed ({r.status_code}): {r.text}")
+        return r.json()
 
     raise HTTPException(status_code=500, detail=f"replicate train failed (exhausted urls)")
 
 async def get_replicate_training_status(training_id: str) -> Dict[str, Any]:
     if not REPLICATE_API_TOKEN:
         raise HTTPException(status_code=500, detail="REPLICATE_API_TOKEN not set")
-    url = f"https://api.replicate.com/v1/trainings/{training_id}"
+    url = f"{REPLICATE_API_BASE}/v1/trainings/{training_id}"
     headers = {"Authorization": f"Token {REPLICATE_API_TOKEN}"}
-    async with httpx.AsyncClient(timeout=60) as cl:
-        r = await cl.get(url, headers=headers)
-        r.raise_for_status()
-        return r.json()
+    r = await REPLICATE_OUT.request("GET", url, headers=headers, timeout=60)
+    r.raise_for_status()
+    return r.json()
 
 # ------------- ГЕНЕРАЦИЯ -------------
 def _split_model_and_version(model_path: str) -> Tuple[str, Optional[str]]:
@@ -379,21 +448,33 @@ def _split_model_and_version(model_path: str) -> Tuple[str, Optional[str]]:
     return model_path, None
 
 async def _get_latest_version_hash(client: httpx.AsyncClient, model_name: str, headers: Dict[str, str]) -> str:
-    url = f"https://api.replicate.com/v1/models/{model_name}/versions"
-    r = await client.get(url, headers=headers)
-    r.raise_for_status()
-    data = r.json()
-    results = data.get("results") or []
-    if not results:
-        raise HTTPException(status_code=500, detail=f"No versions found for model '{model_name}'")
-    return results[0].get("id") or results[0].get("version")
-
-async def _post_prediction_via_version(client: httpx.AsyncClient, version_hash: str, prompt: str, num_images: int, headers: Dict[str, str]) -> Dict[str, Any]:
+    async def fetch() -> str:
+        url = f"{REPLICATE_API_BASE}/v1/models/{model_name}/versions"
+        r = await REPLICATE_OUT.request("GET", url, client=client, headers=headers)
+        r.raise_for_status()
+        data = r.json()
+        results = data.get("results") or []
+        if not results:
+            raise HTTPException(status_code=500, detail=f"No versions found for model '{model_name}'")
+        return results[0].get("id") or results[0].get("version")
+    # TTL-кэш + single-flight: GET /versions не на каждую генерацию
+    return await VERSIONS.resolve(("latest", model_name), fetch)
+
+async def _post_prediction_via_version(client: httpx.AsyncClient, version_hash: str, prompt: str, num_images: int, headers: Dict[str, str],
+                                       prefer_wait: bool = True) -> Dict[str, Any]:
     body: Dict[str, Any] = {
         "version": version_hash,
-        "input": {"prompt": prompt, "num_outputs": int(num_images or 1)}
+        "input": {"prompt": prompt, "num_outputs": int(num_images or 1)},
+        **_webhook_fields(),
     }
-    r = await client.post("https://api.replicate.com/v1/predictions", headers=headers, json=body)
+    timeout: Any = None
+    if REPLICATE_PREFER_WAIT and prefer_wait:
+        # короткие модели (schnell/dev) отдают результат прямо в ответе на create
+        headers = {**headers, "Prefer": f"wait={REPLICATE_PREFER_WAIT}"}
+        timeout = httpx.Timeout(REPLICATE_PREFER_WAIT + 15.0, connect=15.0)
+    # создание не идемпотентно: повтор только если запрос заведомо не принят (429/503/нет соединения)
+    r = await REPLICATE_OUT.request("POST", f"{REPLICATE_API_BASE}/v1/predictions", client=client,
+                                    headers=headers, json=body, **({"timeout": timeout} if timeout else {}))
     r.raise_for_status()
     return r.json()
 
@@ -415,41 +496,286 @@ async def call_replicate_generate(prompt: str, model_id: Optional[str], num_imag
     base_model = (model_id or REPLICATE_GEN_MODEL or FLUX_FAST_MODEL).strip()
     headers = {"Authorization": f"Token {REPLICATE_API_TOKEN}", "Content-Type": "application/json"}
 
-    async with httpx.AsyncClient(timeout=180) as cl:
+    cl = REPLICATE_HTTP.client
+    t0 = time.time()
+    data = None
+    # размыкатель на модель: при серии ошибок основной модели сразу идём в запасную.
+    # Ошибкой модели считаются 5xx/сеть и финал failed; 429 и прочие 4xx — не её вина (abandon).
+    # Итог основной модели фиксируется по финалу предсказания, до него br_open = True
+    br = BREAKERS.get(_split_model_and_version(base_model)[0])
+    br_open = False
+    used_model = base_model
+    if base_model == FLUX_FAST_MODEL or br.allow():
         try:
             _, version_hash = await _resolve_model_and_version(cl, base_model, headers)
             data = await _post_prediction_via_version(cl, version_hash, prompt, int(num_images or 1), headers)
+            br_open = True
         except httpx.HTTPStatusError as e:
+            if e.response is not None and e.response.status_code >= 500:
+                br.failure()
+            else:
+                br.abandon()
             log.warning("Primary model '%s' failed (%s). Trying fallback '%s'", base_model, e.response.status_code if e.response else "?", FLUX_FAST_MODEL)
-            _, version_hash = await _resolve_model_and_version(cl, FLUX_FAST_MODEL, headers)
-            data = await _post_prediction_via_version(cl, version_hash, prompt, int(num_images or 1), headers)
-
-        prediction_url = data["urls"]["get"]
-        outputs: List[str] = []
-        for _ in range(60):
-            rr = await cl.get(prediction_url, headers=headers)
-            rr.raise_for_status()
-            dd = rr.json()
-            status = dd.get("status")
-            if status == "succeeded":
-                outs = dd.get("output") or []
-                outputs = [str(x) for x in (outs if isinstance(outs, list) else [outs])]
-                break
-            elif status in ("failed", "canceled", "cancelled", "error"):
-                err = dd.get("error") or status
-                raise HTTPException(status_code=500, detail=f"replicate generation failed: {err}")
-            await asyncio.sleep(2)
+        except httpx.TransportError:
+            br.failure()
+            raise
+        except BaseException:
+            br.abandon()
+            raise
+    else:
+        log.info("Primary model '%s' breaker %s — using fallback '%s'", base_model, br.state, FLUX_FAST_MODEL)
+    if data is None:
+        used_model = FLUX_FAST_MODEL
+        _, version_hash = await _resolve_model_and_version(cl, FLUX_FAST_MODEL, headers)
+        data = await _post_prediction_via_version(cl, version_hash, prompt, int(num_images or 1), headers)
+    try:
+        return await _finish_generation(cl, data, version_hash, used_model, prompt, num_images, headers, t0,
+                                        br if br_open else None)
+    except BaseException:
+        if br_open:
+            br.abandon()  # итог не получен (отмена, таймаут) — модель не виновата, пробный слот свободен
+        raise
+
+async def _finish_generation(cl: httpx.AsyncClient, data: Dict[str, Any], version_hash: str, used_model: str,
+                             prompt: str, num_images: int, headers: Dict[str, str], t0: float, br) -> List[str]:
+    """Дождаться финала созданного предсказания; br — размыкатель основной модели, ждущий итога."""
+
+    prediction_id = data.get("id")
+    if not prediction_id:
+        raise HTTPException(status_code=500, detail="no prediction id from replicate")
+    outputs: List[str] = []
+    dd: Optional[Dict[str, Any]] = data
+    deadline = time.time() + REPLICATE_GEN_TIMEOUT
+    # готово в ответе на create (Prefer: wait) — синхронный путь; иначе ждём опросчик/вебхук
+    path = "sync" if (data.get("status") or "").lower() in TERMINAL else "async"
+    _gen_count(path, prefer_wait=bool(REPLICATE_PREFER_WAIT))
+    HEDGE.generation()
+    if path == "sync":
+        HEDGE.observe(data)
+    else:
+        POLLER.track("prediction", prediction_id, initial=data)
+        try:
+            dd = await _wait_prediction(cl, prediction_id, data, prompt, int(num_images or 1), headers,
+                                        started=t0, deadline=deadline,
+                                        model_key=_split_model_and_version(used_model)[0], version_hash=version_hash)
+        except asyncio.CancelledError:
+            # результат больше никому не нужен (дедлайн вызывающего, разрыв соединения) — не платим за GPU
+            _spawn(_cancel_replicate("prediction", prediction_id, "cancelled", started=t0))
+            raise
+    if dd is not None:
+        status = dd.get("status")
+        if status == "succeeded":
+            if br is not None:
+                br.success()
+            outs = dd.get("output") or []
+            outputs = [str(x) for x in (outs if isinstance(outs, list) else [outs])]
+        elif status in ("failed", "canceled", "cancelled", "error"):
+            if br is not None:
+                if status in ("failed", "error"):
+                    br.failure()
+                else:
+                    br.abandon()
+            err = dd.get("error") or status
+            raise HTTPException(status_code=500, detail=f"replicate generation failed: {err}")
+    elif br is not None:
+        br.abandon()  # не дождались финала
+    GEN_STATS[f"{path}_seconds"] += time.time() - t0
     return outputs
 
+async def _wait_prediction(cl: httpx.AsyncClient, prediction_id: str, data: Dict[str, Any], prompt: str, num_images: int,
+                           headers: Dict[str, str], started: float, deadline: float, model_key: str,
+                           version_hash: str) -> Optional[Dict[str, Any]]:
+    """
+    Финальное состояние (вебхук/опросчик) или None по таймауту; застряло в starting дольше p95 — хедж:
+    дубль той же версии (LoRA пользователя — та же), на свободном слоте ADMISSION.
+    """
+    if HEDGE.enabled:
+        left = min(deadline, started + HEDGE.hedge_after(data.get("model"))) - time.time()
+        dd = await HOOKS.wait(prediction_id, left) if left > 0 else HOOKS.peek(prediction_id)
+        if dd is not None:
+            return dd
+        status = ((POLLER.get(prediction_id) or data).get("status") or "").lower()
+        if time.time() < deadline and status in ("", "starting"):
+            # хедж не обгоняет очередь и не выходит за лимиты: нет свободного слота — ждём основное
+            async with ADMISSION.spare(model_key) as granted:
+                if granted and HEDGE.allow():
+                    hedge_id = await _launch_hedge(cl, version_hash, prompt, num_images, headers)
+                    if hedge_id:
+                        return await _race_predictions(prediction_id, hedge_id, deadline, started)
+    left = deadline - time.time()
+    dd = await HOOKS.wait(prediction_id, left) if left > 0 else None
+    if dd is None:
+        _spawn(_cancel_replicate("prediction", prediction_id, "timeout", started=started))
+    return dd
+
+async def _launch_hedge(cl: httpx.AsyncClient, version_hash: str, prompt: str, num_images: int,
+                        headers: Dict[str, str]) -> Optional[str]:
+    try:
+        # без Prefer: wait — гонка с основным предсказанием начинается сразу
+        hd = await _post_prediction_via_version(cl, version_hash, prompt, num_images, headers, prefer_wait=False)
+    except Exception as e:
+        HEDGE.stats["launch_failed"] += 1
+        log.warning(f"hedge launch failed: {e!r}")
+        return None
+    hid = hd.get("id")
+    if not hid:
+        HEDGE.stats["launch_failed"] += 1
+        return None
+    if (hd.get("status") or "").lower() in TERMINAL:
+        HOOKS.resolve(hid, hd)
+    else:
+        POLLER.track("prediction", hid, initial=hd)
+    log.info(f"hedge {hid} launched on version {version_hash}")
+    return hid
+
+async def _race_predictions(primary_id: str, hedge_id: str, deadline: float, started: float) -> Optional[Dict[str, Any]]:
+    """Первый успешный результат из двух; проигравший отменяется в Replicate."""
+    left = max(0.0, deadline - time.time())
+    waits = {asyncio.create_task(HOOKS.wait(primary_id, left)): primary_id,
+             asyncio.create_task(HOOKS.wait(hedge_id, left)): hedge_id}
+    winner, result = None, None
+    try:
+        while waits and winner is None:
+            done, _ = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                rid = waits.pop(t)
+                dd = t.result()
+                if dd is None:
+                    continue
+                result = dd
+                if (dd.get("status") or "").lower() == "succeeded":
+                    winner = rid
+                    break
+    except asyncio.CancelledError:
+        _spawn(_cancel_replicate("prediction", hedge_id, "cancelled"))  # основное отменит вызывающий
+        raise
+    finally:
+        for t in waits:
+            t.cancel()
+    if winner is None:
+        if result is not None:
+            HEDGE.stats["both_failed"] += 1
+        for rid in (primary_id, hedge_id):  # завершённые — только снять с опроса
+            _spawn(_cancel_replicate("prediction", rid, "timeout", started=started))
+        return result
+    HEDGE.stats["hedge_wins" if winner == hedge_id else "primary_wins"] += 1
+    loser = primary_id if winner == hedge_id else hedge_id
+    if not POLLER.is_terminal(loser) and HOOKS.peek(loser) is None:
+        HEDGE.stats["losers_cancelled"] += 1
+        _spawn(_cancel_replicate("prediction", loser, "hedge_loser", started=started))
+    return result
+
+# отмены в Replicate: seconds — сколько отменённые успели проработать (оплаченное впустую время)
+CANCEL_STATS: Dict[str, Any] = {"predictions": 0, "trainings": 0, "seconds": 0.0, "failed": 0,
+                                "deadline_expired": 0, "disconnects": 0, "reasons": {}}
+_CANCELLED: Dict[str, float] = {}
+
+async def _cancel_replicate(kind: str, rid: str, reason: str, started: Optional[float] = None) -> None:
+    """Отменить ненужное предсказание/тренировку в Replicate — не платить за GPU. Повторная отмена id — no-op."""
+    POLLER.untrack(rid)
+    if rid in _CANCELLED or POLLER.is_terminal(rid) or HOOKS.peek(rid) is not None:
+        return
+    now = time.time()
+    _CANCELLED[rid] = now
+    if len(_CANCELLED) > 5000:
+        for k, ts in list(_CANCELLED.items()):
+            if now - ts > 3600:
+                _CANCELLED.pop(k, None)
+    path = "trainings" if kind == "training" else "predictions"
+    try:
+        r = await REPLICATE_OUT.request("POST", f"{REPLICATE_API_BASE}/v1/{path}/{rid}/cancel",
+                                        headers={"Authorization": f"Token {REPLICATE_API_TOKEN}"}, timeout=15)
+        if r.status_code >= 400:
+            CANCEL_STATS["failed"] += 1
+            log.warning(f"cancel {kind} {rid}: {r.status_code} {r.text}")
+            return
+    except Exception as e:
+        CANCEL_STATS["failed"] += 1
+        log.warning(f"cancel {kind} {rid} failed: {e!r}")
+        return
+    created = parse_ts((POLLER.get(rid) or {}).get("created_at")) or started
+    CANCEL_STATS[f"{kind}s"] += 1
+    CANCEL_STATS["reasons"][reason] = CANCEL_STATS["reasons"].get(reason, 0) + 1
+    if created:
+        CANCEL_STATS["seconds"] += max(0.0, now - created)
+    log.info(f"cancelled {kind} {rid} ({reason})")
+
+async def _with_deadline(coro, deadline: Optional[float]):
+    """Дедлайн вызывающего -> отмена корутины; отмена доходит до Replicate (см. _cancel_replicate)."""
+    if deadline is None:
+        return await coro
+    left = deadline - time.time()
+    if left <= 0:
+        coro.close()
+        CANCEL_STATS["deadline_expired"] += 1
+        raise HTTPException(status_code=504, detail="deadline exceeded")
+    try:
+        return await asyncio.wait_for(coro, timeout=left)
+    except asyncio.TimeoutError:
+        CANCEL_STATS["deadline_expired"] += 1
+        raise HTTPException(status_code=504, detail="deadline exceeded")
+
+def _deadline_from_request(request: Request) -> Optional[float]:
+    """X-Request-Timeout: сколько секунд у вызывающего осталось (относительное — без расхождения часов)."""
+    v = (request.headers.get("x-request-timeout") or "").strip()
+    try:
+        return time.time() + float(v) if v else None
+    except ValueError:
+        return None
+
+async def _until_disconnect(request: Request, coro):
+    """Выполнить, но отменить, если клиент разорвал соединение."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=1.0)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                CANCEL_STATS["disconnects"] += 1
+                task.cancel()
+                raise HTTPException(status_code=499, detail="client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
+_BG_TASKS: set = set()
+
+def _spawn(coro) -> None:
+    t = asyncio.create_task(coro)
+    _BG_TASKS.add(t)
+    t.add_done_callback(_BG_TASKS.discard)
+
+# счётчики путей генерации: sync — результат в ответе на create, async — через опросчик/вебхук
+GEN_STATS: Dict[str, float] = {"sync": 0, "async": 0, "async_after_wait": 0, "sync_seconds": 0.0, "async_seconds": 0.0}
+
+def _gen_count(path: str, prefer_wait: bool) -> None:
+    GEN_STATS[path] += 1
+    if path == "async" and prefer_wait:
+        GEN_STATS["async_after_wait"] += 1  # бюджет ожидания исчерпан
+
+def _gen_stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = {"prefer_wait": REPLICATE_PREFER_WAIT, **GEN_STATS}
+    for p in ("sync", "async"):
+        out[f"{p}_avg_s"] = round(GEN_STATS[f"{p}_seconds"] / GEN_STATS[p], 2) if GEN_STATS[p] else None
+        out[f"{p}_seconds"] = round(GEN_STATS[f"{p}_seconds"], 1)
+    total = GEN_STATS["sync"] + GEN_STATS["async"]
+    out["sync_share"] = round(GEN_STATS["sync"] / total, 3) if total else None
+    return out
+
 # ============ API ============
-@app.post("/api/upload_photo")
-async def api_upload_photo(user_id: str = Form(...), file: UploadFile = File(...)):
+def save_user_photo(user_id: str, filename: str, content: bytes) -> str:
     pdir = user_photos_dir(user_id)
-    name = f"{int(time.time())}_{uuid.uuid4().hex[:8]}_{file.filename}"
+    name = f"{int(time.time())}_{uuid.uuid4().hex[:8]}_{filename}"
     path = os.path.join(pdir, name)
     with open(path, "wb") as f:
-        f.write(await file.read())
+        f.write(content)
     log.info(f"UPLOAD user={user_id} -> {path}")
+    return path
+
+@app.post("/api/upload_photo")
+async def api_upload_photo(user_id: str = Form(...), file: UploadFile = File(...)):
+    path = save_user_photo(user_id, file.filename, await file.read())
     return {"ok": True, "path": path}
 
 @app.get("/api/debug/has_photos/{user_id}")
@@ -468,8 +794,18 @@ def _rub(v: int) -> Dict[str, str]:
     return {"value": f"{v:.2f}", "currency": "RUB"}
 
 def _pay_store(payment_id: str, payload: Dict[str, Any]):
-    PAYMENTS[payment_id] = payload
-    _pay_db_save(PAYMENTS)
+    try:
+        amount = int(float(payload.get("amount") or 0))
+    except Exception:
+        amount = 0
+    PAYMENTS.create(
+        payment_id,
+        user_id=int(payload.get("user_id") or 0),
+        qty=int(payload.get("qty") or 0),
+        amount=amount,
+        status=str(payload.get("status") or "pending").lower(),
+        created_at=payload.get("created_at"),
+    )
 
 async def _notify_user_credit(user_id: int, qty: int, amount: int):
     try:
@@ -481,34 +817,70 @@ async def _notify_user_credit(user_id: int, qty: int, amount: int):
     except Exception as e:
         log.warning(f"notify user failed: {e!r}")
 
-def _credit_if_needed_from_meta(payment_id: str, meta: Dict[str, Any], amount_value: Any = None):
-    """Начисляет генерации, если ещё не было, на основе metadata/локального стейта."""
-    stored = PAYMENTS.get(payment_id) or {}
-    if stored.get("status") == "succeeded":
-        return  # уже начисляли
-    user_id = int(meta.get("user_id") or stored.get("user_id") or 0)
-    qty = int(meta.get("qty") or stored.get("qty") or 0)
+# начисление ждёт fsync не дольше этого; дольше — 503, YooKassa повторит вебхук
+PAY_SYNC_TIMEOUT = float(os.getenv("PAY_SYNC_TIMEOUT", "10"))
+_CREDITING: set = set()  # payment_id, начисляемые прямо сейчас (между проверкой и записью есть await)
+
+async def _credit_if_needed_from_meta(payment_id: str, meta: Dict[str, Any], amount_value: Any = None):
+    """
+    Начисляет генерации, если ещё не было, на основе metadata/локального стейта.
+    Порядок: баланс, начисление рефереру и отметка credited платежа — одной транзакцией users.db
+    (она и есть ключ идемпотентности); после её fsync — событие credited в журнал платежей.
+    """
+    rec = PAYMENTS.get(payment_id)
+    if (rec is not None and rec.credited) or payment_id in _CREDITING:
+        return  # уже начисляли / начисляет параллельный вызов
+    user_id = int(meta.get("user_id") or (rec.user_id if rec else 0) or 0)
+    qty = int(meta.get("qty") or (rec.qty if rec else 0) or 0)
     try:
-        amount = int(float(amount_value)) if amount_value is not None else int(stored.get("amount") or 0)
+        amount = int(float(amount_value)) if amount_value is not None else int(rec.amount if rec else 0)
     except Exception:
-        amount = int(stored.get("amount") or 0)
-    if user_id and qty:
-        st = get_user(user_id)
-        st.balance += qty
-        st.paid_any = True
-        save_user(st)
-        # реферальные
-        if st.referred_by:
-            ref = get_user(st.referred_by)
-            ref_gain = round(amount * 0.20, 2)
-            ref.ref_earn_total += ref_gain
-            ref.ref_earn_ready += ref_gain
-            save_user(ref)
-        PAYMENTS[payment_id] = {**stored, "status": "succeeded"}
-        _pay_db_save(PAYMENTS)
+        amount = int(rec.amount if rec else 0)
+    if not (user_id and qty):
+        return
+    if rec is None:
+        PAYMENTS.create(payment_id, user_id, qty, amount, status="succeeded")
+    applied = False
+    _CREDITING.add(payment_id)
+    try:
+        if not (USERS.get_payment(payment_id) or {}).get("credited"):
+            await _apply_credit(payment_id, user_id, qty, amount)
+            applied = True
+        # начисление — критичная запись: ждём fsync, не блокируя event loop (и не бесконечно)
+        if not await USERS.async_sync(timeout=PAY_SYNC_TIMEOUT):
+            raise HTTPException(status_code=503, detail="credit is not durable yet, retry")
+        PAYMENTS.mark_credited(payment_id)
+        if not await PAYMENTS.sync(timeout=PAY_SYNC_TIMEOUT):
+            raise HTTPException(status_code=503, detail="payment ledger is not durable yet, retry")
+    finally:
+        _CREDITING.discard(payment_id)
+    if applied:
         asyncio.create_task(_notify_user_credit(user_id, qty, amount))
 
-# принимает JSON/FORM + таймауты/ретраи/прокси
+async def _apply_credit(payment_id: str, user_id: int, qty: int, amount: int) -> None:
+    async with user_lock(user_id):
+        st = get_user(user_id, fresh=True)
+        ref_id = st.referred_by if st.referred_by and st.referred_by != user_id else None
+        async with (user_lock(ref_id) if ref_id else contextlib.nullcontext()):
+            ref = get_user(ref_id, fresh=True) if ref_id else None
+            # без await внутри: одна пачка write-behind — одна транзакция SQLite
+            with USERS.atomic():
+                st.balance += qty
+                st.paid_any = True
+                save_user(st)
+                if ref is not None:
+                    acc = make_accrual(payment_id, ref_id, user_id, amount)
+                    USERS.add_accrual(acc)  # журнал: одна запись на payment_id
+                    ref.ref_earn_total += acc["commission"]
+                    ref.ref_earn_ready += acc["commission"]
+                    save_user(ref)
+                rec = PAYMENTS.get(payment_id)
+                now = time.time()
+                USERS.put_payment({"payment_id": payment_id, "user_id": user_id, "qty": qty,
+                                   "amount": amount, "status": "succeeded", "credited": True,
+                                   "created_at": rec.created_at if rec is not None else now, "updated_at": now})
+
+# принимает JSON/FORM; таймауты/ретраи — YOOKASSA_OUT
 @app.post("/api/pay")
 async def api_pay_create(request: Request):
     """
@@ -535,8 +907,12 @@ async def api_pay_create(request: Request):
         amount = int(float(amount_raw))
     except Exception:
         amount = int(amount_raw or 0)
-    title = (str(body.get("title") or "").strip()) or f"{qty} генераций"
-    receipt_email = (body.get("email") or RECEIPTS_BCC_EMAIL).strip()
+    return await pay_create(user_id, qty, amount, str(body.get("title") or ""), body.get("email"))
+
+async def pay_create(user_id: int, qty: int, amount: int, title: str = "", email: Optional[str] = None) -> Dict[str, Any]:
+    """Ядро создания платежа (HTTP-эндпоинт и бот в том же процессе)."""
+    title = (str(title or "").strip()) or f"{qty} генераций"
+    receipt_email = (email or RECEIPTS_BCC_EMAIL).strip()
 
     if not (user_id and qty and amount):
         raise HTTPException(400, "invalid payment params")
@@ -572,49 +948,47 @@ async def api_pay_create(request: Request):
     }
 
     timeout = httpx.Timeout(connect=15.0, read=120.0, write=30.0, pool=10.0)
-    last_err = None
     url = f"{YOOKASSA_API_BASE}/v3/payments"
 
-    for attempt in range(3):
-        try:
-            async with httpx.AsyncClient(timeout=timeout, http2=False, trust_env=True) as cl:
-                r = await cl.post(url, headers=headers, json=payload)
-                if r.status_code >= 400:
-                    raise HTTPException(r.status_code, f"yookassa create failed: {r.text}")
-                data = r.json()
-                payment_id = data.get("id")
-                confirmation_url = (data.get("confirmation") or {}).get("confirmation_url")
-                if not payment_id or not confirmation_url:
-                    raise HTTPException(500, "yookassa response invalid")
-                _pay_store(payment_id, {
-                    "user_id": user_id,
-                    "qty": qty,
-                    "amount": amount,
-                    "status": "pending",
-                    "created_at": time.time(),
-                })
-                return {"payment_id": payment_id, "confirmation_url": confirmation_url}
-        except (httpx.ReadTimeout, httpx.ConnectTimeout, httpx.RequestError) as e:
-            last_err = e
-            wait = 1.5 * (attempt + 1)
-            log.warning(f"YooKassa create timeout (try {attempt+1}/3), retry in {wait}s: {e!r}")
-            await asyncio.sleep(wait)
-
-    raise HTTPException(status_code=504, detail=f"yookassa create timeout: {last_err!r}")
+    try:
+        # Idempotence-Key общий на все попытки — повтор после таймаута не создаст второй платёж
+        r = await YOOKASSA_OUT.request("POST", url, idempotent=True, headers=headers, json=payload, timeout=timeout)
+    except httpx.TransportError as e:
+        raise HTTPException(status_code=504, detail=f"yookassa create timeout: {e!r}")
+    if r.status_code >= 400:
+        raise HTTPException(r.status_code, f"yookassa create failed: {r.text}")
+    data = r.json()
+    payment_id = data.get("id")
+    confirmation_url = (data.get("confirmation") or {}).get("confirmation_url")
+    if not payment_id or not confirmation_url:
+        raise HTTPException(500, "yookassa response invalid")
+    _pay_store(payment_id, {
+        "user_id": user_id,
+        "qty": qty,
+        "amount": amount,
+        "status": "pending",
+        "created_at": time.time(),
+    })
+    return {"payment_id": payment_id, "confirmation_url": confirmation_url}
 
 @app.get("/api/pay/status")
 async def api_pay_status(payment_id: str):
+    return await pay_status(payment_id)
+
+async def pay_status(payment_id: str) -> Dict[str, Any]:
+    """Статус из YooKassa; при succeeded — идемпотентное начисление."""
     headers = {"Authorization": _yk_auth_header()}
-    async with httpx.AsyncClient(timeout=20, http2=False, trust_env=True) as cl:
-        r = await cl.get(f"{YOOKASSA_API_BASE}/v3/payments/{payment_id}", headers=headers)
-        if r.status_code >= 400:
-            raise HTTPException(r.status_code, f"yookassa status failed: {r.text}")
-        data = r.json()
+    r = await YOOKASSA_OUT.request("GET", f"{YOOKASSA_API_BASE}/v3/payments/{payment_id}", headers=headers, timeout=20)
+    if r.status_code >= 400:
+        raise HTTPException(r.status_code, f"yookassa status failed: {r.text}")
+    data = r.json()
     status = data.get("status")
     meta = (data.get("metadata") or {})
+    if status:
+        PAYMENTS.set_status(payment_id, status)
     if status == "succeeded":
         amount_value = (data.get("amount") or {}).get("value")
-        _credit_if_needed_from_meta(payment_id, meta, amount_value)
+        await _credit_if_needed_from_meta(payment_id, meta, amount_value)
     return {"payment_id": payment_id, "status": status}
 
 # 🔔 Вебхук от YooKassa (авто-зачисление по событию payment.succeeded)
@@ -637,7 +1011,7 @@ async def yookassa_webhook(request: Request):
     if not payment_id:
         raise HTTPException(status_code=400, detail="no payment id in webhook")
 
-    # сохраняем запись если её не было
+    # сохраняем запись если её не было, иначе — событие смены статуса
     if payment_id not in PAYMENTS:
         _pay_store(payment_id, {
             "user_id": meta.get("user_id"),
@@ -646,21 +1020,28 @@ async def yookassa_webhook(request: Request):
             "status": status,
             "created_at": time.time(),
         })
+    elif status:
+        PAYMENTS.set_status(payment_id, status)
 
     if event == "payment.succeeded" or status == "succeeded":
-        _credit_if_needed_from_meta(payment_id, meta, amount_value)
+        await _credit_if_needed_from_meta(payment_id, meta, amount_value)
 
     return {"ok": True}
 
 # ============ TRAIN/STATUS/GENERATE ============
 @app.post("/api/train")
 async def api_train(user_id: str = Form(...)):
+    return await train_start(user_id)
+
+async def train_start(user_id: str) -> Dict[str, Any]:
     if count_user_photos(user_id) == 0:
         raise HTTPException(status_code=400, detail="no photos uploaded")
     zip_path = build_zip_of_user_photos(user_id)
     zip_url = public_url_for_zip(zip_path)
 
-    train = await call_replicate_training(zip_url, str(user_id))
+    # запуск обучения — через общий допуск к Replicate (слот держится только на время создания)
+    async with ADMISSION.slot(str(user_id), f"{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}"):
+        train = await call_replicate_training(zip_url, str(user_id))
     training_id = train.get("id") or train.get("uuid")
     if not training_id:
         raise HTTPException(status_code=500, detail="no training_id from replicate")
@@ -671,33 +1052,123 @@ async def api_train(user_id: str = Form(...)):
         "progress": 5,
         "user_id": user_id,
         "training_id": training_id,
-        "model_id": None
+        "model_id": None,
+        "created_ts": time.time(),
     }
+    _job_by_training[training_id] = job_id
+    POLLER.track("training", training_id, initial=train)
     log.info(f"TRAIN started job={job_id} training_id={training_id} user={user_id}")
     return {"job_id": job_id, "status": "started"}
 
+@app.post("/api/cancel/{job_id}")
+async def api_cancel(job_id: str):
+    return await job_cancel(job_id)
+
+async def job_cancel(job_id: str) -> Dict[str, Any]:
+    """Отменить тренировку (ожидание у бота истекло) — Replicate перестаёт считать GPU-время."""
+    j = jobs.get(job_id)
+    if not j:
+        raise HTTPException(status_code=404, detail="job not found")
+    training_id = j.get("training_id")
+    if training_id and (j.get("status") or "").lower() not in TERMINAL:
+        await _cancel_replicate("training", training_id, "deadline", started=j.get("created_ts"))
+        j["status"] = "canceled"
+    return {"job_id": job_id, "status": j.get("status")}
+
 @app.get("/api/status/{job_id}")
 async def api_status(job_id: str):
+    return await job_status(job_id)
+
+async def job_status(job_id: str) -> Dict[str, Any]:
     j = jobs.get(job_id)
     if not j:
         raise HTTPException(status_code=404, detail="job not found")
 
     training_id = j.get("training_id")
-    if training_id:
-        try:
-            st = await get_replicate_training_status(training_id)
-            state = st.get("status") or st.get("state")
-            out = st.get("output") or {}
-            model = out.get("version") or out.get("model") or out.get("id") or st.get("destination")
-            if state:
-                j["status"] = state
-                j["progress"] = _pct_from_replicate_status(state)
-            if model:
-                j["model_id"] = model
-        except Exception as e:
-            logging.getLogger("web").warning(f"status fetch failed for {job_id}: {e!r}")
+    # состояние j обновляет общий опросчик/вебхук; чтение не ходит в Replicate
+    if training_id and (j.get("status") or "").lower() not in TERMINAL:
+        POLLER.track("training", training_id)
+
+    return {"job_id": job_id, "status": j.get("status"), "progress": j.get("progress", 0),
+            "model_id": j.get("model_id"), "model_version": j.get("model_version")}
+
+async def _apply_training_state(j: Dict[str, Any], st: Dict[str, Any]) -> None:
+    state = st.get("status") or st.get("state")
+    out = st.get("output") or {}
+    model = out.get("version") or out.get("model") or out.get("id") or st.get("destination")
+    if model and "/" not in model and st.get("destination"):
+        model = f"{st['destination']}:{model}"  # output.version — голый хеш версии
+    if state:
+        j["status"] = state
+        j["progress"] = _pct_from_replicate_status(state)
+    if model:
+        j["model_id"] = model
+    if j.get("model_id") and not j.get("model_version") and (state or "").lower() == "succeeded":
+        # версия обычно уже в output.version; иначе — свежий запрос: в кэше может быть версия до обучения
+        j["model_version"] = await _pin_model_version(j["model_id"], fresh=True)
+
+async def job_wait(job_id: str, timeout: float) -> None:
+    """Ждать изменения состояния job: вебхук будит сразу, иначе — страховочный таймаут."""
+    j = jobs.get(job_id)
+    training_id = (j or {}).get("training_id")
+    if not training_id:
+        await asyncio.sleep(min(timeout, 2.0))
+        return
+    if (j.get("status") or "").lower() in TERMINAL:
+        return
+    POLLER.track("training", training_id)
+    await HOOKS.wait(training_id, timeout)
+
+@app.post("/replicate/webhook")
+async def replicate_webhook(request: Request):
+    body = await request.body()
+    if not REPLICATE_WEBHOOK_SECRET or not verify_signature(REPLICATE_WEBHOOK_SECRET, request.headers, body):
+        raise HTTPException(status_code=403, detail="bad signature")
+    try:
+        obj = json.loads(body)
+    except Exception:
+        raise HTTPException(status_code=400, detail="bad json")
+    rid = obj.get("id")
+    if not rid:
+        raise HTTPException(status_code=400, detail="no id")
+    log.info(f"Replicate webhook: id={rid} status={obj.get('status')}")
+    await POLLER.publish(rid, obj, source="webhook")
+    return {"ok": True}
 
-    return {"job_id": job_id, "status": j.get("status"), "progress": j.get("progress", 0), "model_id": j.get("model_id")}
+async def _fetch_replicate_state(kind: str, rid: str) -> Dict[str, Any]:
+    if kind == "training":
+        return await get_replicate_training_status(rid)
+    r = await REPLICATE_OUT.request("GET", f"{REPLICATE_API_BASE}/v1/predictions/{rid}",
+                                    headers={"Authorization": f"Token {REPLICATE_API_TOKEN}"}, timeout=30)
+    r.raise_for_status()
+    return r.json()
+
+async def _on_replicate_state(kind: str, rid: str, obj: Dict[str, Any]) -> None:
+    """Новое состояние (опрос/вебхук): обновить job и разбудить ожидающих финала."""
+    if kind == "prediction":
+        HEDGE.observe(obj)  # время холодного старта для порога хеджа
+    job_id = _job_by_training.get(rid)
+    if job_id and job_id in jobs:
+        await _apply_training_state(jobs[job_id], obj)
+    if (obj.get("status") or "").lower() in TERMINAL:
+        HOOKS.resolve(rid, obj)
+
+# один опросчик на все незавершённые id; вебхуки публикуют туда же
+POLLER = StatusPoller(_fetch_replicate_state, _on_replicate_state)
+
+async def _pin_model_version(model_id: str, fresh: bool = False) -> Optional[str]:
+    """Хеш версии обученной модели: из 'owner/model:hash' или последняя версия destination (fresh — мимо кэша)."""
+    model_wo_ver, ver = _split_model_and_version(model_id)
+    if ver:
+        return ver
+    if fresh:
+        VERSIONS.invalidate(("latest", model_wo_ver))
+    headers = {"Authorization": f"Token {REPLICATE_API_TOKEN}"}
+    try:
+        return await _get_latest_version_hash(REPLICATE_HTTP.client, model_wo_ver, headers)
+    except Exception as e:
+        log.warning(f"cannot pin version for {model_id}: {e!r}")
+        return None
 
 @app.post("/api/ggenerate")
 async def api_generate_alias(request: Request,
@@ -723,9 +1194,62 @@ async def api_generate(
         num_images = body.get("num_images", 1)
         job_id = body.get("job_id")
 
+    deadline = _deadline_from_request(request)
+    urls = await _until_disconnect(request, generate_images(user_id, prompt, int(num_images or 1), job_id, deadline=deadline))
+    return {"images": urls}
+
+@app.get("/api/queue/{user_id}")
+async def api_queue(user_id: str):
+    """Позиция пользователя в очереди к Replicate (для клиентов без in-process уведомлений)."""
+    return {"user_id": user_id, "position": ADMISSION.position(str(user_id))}
+
+async def generate_images(user_id: Optional[str], prompt: Optional[str], num_images: int = 1,
+                          job_id: Optional[str] = None, on_queued: Optional[OnQueued] = None,
+                          deadline: Optional[float] = None) -> List[str]:
+    if not prompt:
+        raise HTTPException(status_code=400, detail="prompt is required")
+    # тот же запрос пользователя, пока идёт генерация (повторное нажатие, ретрай клиента), ждёт её результат
+    # у каждого ожидающего свой дедлайн; общая генерация отменяется, только когда ждать её некому
+    key = (str(user_id or ""), prompt, int(num_images or 1), job_id or "")
+    timeout = None if deadline is None else deadline - time.time()
+    try:
+        return await GEN_FLIGHT.share(key, lambda: _generate_images(user_id, prompt, num_images, job_id, on_queued),
+                                      timeout=timeout)
+    except asyncio.TimeoutError:
+        CANCEL_STATS["deadline_expired"] += 1
+        raise HTTPException(status_code=504, detail="deadline exceeded")
+
+GEN_FLIGHT = SingleFlight()
+
+async def generate_fanout(user_id: Optional[str], prompt: Optional[str], num_images: int = 1, job_id: Optional[str] = None,
+                          on_image=None, on_queued: Optional[OnQueued] = None,
+                          deadline: Optional[float] = None) -> List[Optional[str]]:
+    """
+    N изображений — N параллельных предсказаний по одному (каждое через ADMISSION, в пределах его лимитов).
+    on_image(i, url|None) — сразу по готовности каждого; результат — url или None по слотам.
+    """
     if not prompt:
         raise HTTPException(status_code=400, detail="prompt is required")
+    n = max(1, int(num_images or 1))
+    results: List[Optional[str]] = [None] * n
+
+    async def one(i: int) -> None:
+        try:
+            urls = await _with_deadline(_generate_images(user_id, prompt, 1, job_id, on_queued if i == 0 else None), deadline)
+            results[i] = urls[0] if urls else None
+        except Exception as e:
+            log.warning(f"fanout part {i+1}/{n} failed: {e!r}")
+        if on_image is not None:
+            try:
+                await on_image(i, results[i])
+            except Exception as e:
+                log.warning(f"fanout on_image failed: {e!r}")
+
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return results
 
+async def _generate_images(user_id: Optional[str], prompt: str, num_images: int, job_id: Optional[str],
+                           on_queued: Optional[OnQueued]) -> List[str]:
     # 1) если есть job -> берём модель из jobs
     model_id = None
     if job_id and job_id in jobs:
@@ -737,11 +1261,52 @@ async def api_generate(
             st = get_user(int(user_id))
             if st and getattr(st, "model_id", None):
                 model_id = st.model_id
+                if st.model_version:
+                    # закреплённая версия — сразу POST /predictions, без запроса версий
+                    model_id = f"{_split_model_and_version(st.model_id)[0]}:{st.model_version}"
+                else:
+                    ver = await _pin_model_version(st.model_id, fresh=True)
+                    if ver:
+                        async with user_lock(int(user_id)):
+                            st = get_user(int(user_id), fresh=True)
+                            st.model_version = ver
+                            save_user(st)
+                        model_id = f"{_split_model_and_version(st.model_id)[0]}:{ver}"
         except Exception:
             pass
 
-    urls = await call_replicate_generate(prompt=prompt, model_id=(model_id or None), num_images=int(num_images or 1))
-    return {"images": urls}
+    # слот на всё время предсказания: лимиты по моделям и очередь по кругу между пользователями
+    model_key = _split_model_and_version(model_id or REPLICATE_GEN_MODEL or FLUX_FAST_MODEL)[0]
+    async with ADMISSION.slot(str(user_id or "anon"), model_key, on_queued=on_queued):
+        urls = await call_replicate_generate(prompt=prompt, model_id=(model_id or None), num_images=int(num_images or 1))
+    # копия у себя (уже без слота) — в фоне; ждать её до MIRROR_WAIT сек (по умолчанию 0 — не ждать)
+    return await MIRROR.localize(urls, PUBLIC_URL)
+
+# 🖼 зеркало результатов: имя = sha256 содержимого, файл не меняется — кэшируется навсегда
+@app.get("/outputs/{name}")
+async def outputs_file(name: str, request: Request):
+    if not MIRROR.valid_name(name):
+        raise HTTPException(status_code=404, detail="not found")
+    path = MIRROR.path_for(name)
+    if not await asyncio.to_thread(os.path.isfile, path):
+        raise HTTPException(status_code=404, detail="not found")
+    MIRROR.touch(name)
+    etag = f'"{name.split(".", 1)[0]}"'
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers)
+
+# ============ BOT → BACKEND ============
+# бот в том же процессе зовёт ядро напрямую; BACKEND_MODE=http — через BACKEND_ROOT (раздельный деплой)
+BACKEND_MODE = (os.getenv("BACKEND_MODE") or "inprocess").strip().lower()
+if BACKEND_MODE != "http":
+    tg_app.backend = InProcessBackend(
+        pay_create=pay_create, pay_status=pay_status, save_photo=save_user_photo,
+        train_start=train_start, job_status=job_status, job_wait=job_wait, job_cancel=job_cancel, generate=generate_images,
+        generate_fanout=generate_fanout,
+    )
+log.info(f"bot backend mode: {BACKEND_MODE}")
 
 # ============ ADMIN API ============
 def _admin_check(request: Request):
@@ -753,12 +1318,13 @@ def _admin_check(request: Request):
 async def admin_summary(request: Request):
     _admin_check(request)
     try:
-        users_count = len(DB)
-        balances = sum(int((DB[k].get("balance") or 0)) for k in DB)
-        models = sum(1 for k in DB if DB[k].get("has_model"))
-        paid_any = sum(1 for k in DB if DB[k].get("paid_any"))
+        agg = AGG.snapshot()  # поддерживается по дельтам, без проходов по базе
+        users_count = agg["users"]
+        balances = agg["balances"]
+        models = agg["models"]
+        paid_any = agg["paid"]
         payments_total = len(PAYMENTS)
-        payments_succeeded = sum(1 for p in PAYMENTS.values() if (p.get("status") == "succeeded"))
+        payments_succeeded = PAYMENTS.status_counts.get("succeeded", 0)
         return {
             "ok": True,
             "users": users_count,
@@ -771,37 +1337,160 @@ async def admin_summary(request: Request):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"admin_summary_error: {e!r}")
 
+# ---- пагинация/экспорт ----
+ADMIN_EXPORT_PAGE = 500
+
+def _encode_cursor(ts: float, key: Any) -> str:
+    raw = json.dumps([ts, key], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[Tuple[float, Any]]:
+    if not cursor:
+        return None
+    try:
+        ts, key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(ts), key
+    except Exception:
+        raise HTTPException(status_code=400, detail="bad cursor")
+
+def _opt_float(v: Optional[str]) -> Optional[float]:
+    if v in (None, ""):
+        return None
+    try:
+        return float(v)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"bad number: {v}")
+
+def _payment_item(rec) -> Dict[str, Any]:
+    return {
+        "payment_id": rec.payment_id,
+        "user_id": rec.user_id,
+        "qty": rec.qty,
+        "amount": rec.amount,
+        "status": rec.status,
+        "created_at": rec.created_at,
+    }
+
+def _user_item(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": int(row["id"]),
+        "balance": int(row.get("balance") or 0),
+        "has_model": bool(row.get("has_model")),
+        "paid_any": bool(row.get("paid_any")),
+        "ref_earn_total": float(row.get("ref_earn_total") or 0.0),
+        "ref_earn_ready": float(row.get("ref_earn_ready") or 0.0),
+        "first_seen_ts": float(row.get("first_seen_ts") or 0.0),
+    }
+
+def _export_response(pages, fmt: str, fields: List[str], name: str) -> StreamingResponse:
+    """pages — async-генератор списков строк; отдаём NDJSON/CSV построчно, память ограничена страницей."""
+    async def body():
+        if fmt == "csv":
+            buf = io.StringIO()
+            w = csv.DictWriter(buf, fieldnames=fields)
+            w.writeheader()
+            yield buf.getvalue()
+        async for items in pages:
+            if fmt == "csv":
+                buf = io.StringIO()
+                w = csv.DictWriter(buf, fieldnames=fields)
+                w.writerows(items)
+                yield buf.getvalue()
+            else:
+                yield "".join(json.dumps(it, ensure_ascii=False) + "\n" for it in items)
+    media = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    ext = "csv" if fmt == "csv" else "ndjson"
+    return StreamingResponse(body(), media_type=media,
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{ext}"'})
+
 @app.get("/admin/payments")
-async def admin_payments(request: Request):
+async def admin_payments(request: Request, limit: int = 500, cursor: Optional[str] = None,
+                         status: Optional[str] = None, since: Optional[str] = None,
+                         until: Optional[str] = None, format: str = "json"):
     _admin_check(request)
-    # Возвращаем короткий список платежей
-    out = []
-    for pid, info in PAYMENTS.items():
-        out.append({
-            "payment_id": pid,
-            "user_id": info.get("user_id"),
-            "qty": info.get("qty"),
-            "amount": info.get("amount"),
-            "status": info.get("status"),
-            "created_at": info.get("created_at"),
-        })
-    out.sort(key=lambda x: x.get("created_at") or 0, reverse=True)
-    return {"ok": True, "items": out[:500]}
+    # Keyset по (created_at, payment_id), новые сверху; format=ndjson|csv — потоковый экспорт всего
+    after = _decode_cursor(cursor)
+    t_since, t_until = _opt_float(since), _opt_float(until)
+    status = (status or "").lower() or None
+    if format in ("ndjson", "csv"):
+        async def pages():
+            cur = after
+            while True:
+                recs = PAYMENTS.page(cur, ADMIN_EXPORT_PAGE, status, t_since, t_until)
+                if not recs:
+                    return
+                yield [_payment_item(r) for r in recs]
+                cur = (recs[-1].created_at, recs[-1].payment_id)
+                await asyncio.sleep(0)  # отдать цикл другим запросам между страницами
+        fields = ["payment_id", "user_id", "qty", "amount", "status", "created_at"]
+        return _export_response(pages(), format, fields, "payments")
+    limit = max(1, min(int(limit), 1000))
+    recs = PAYMENTS.page(after, limit, status, t_since, t_until)
+    nxt = _encode_cursor(recs[-1].created_at, recs[-1].payment_id) if len(recs) == limit else None
+    return {"ok": True, "items": [_payment_item(r) for r in recs], "next_cursor": nxt}
 
 @app.get("/admin/users")
-async def admin_users(request: Request):
+async def admin_users(request: Request, limit: int = 1000, cursor: Optional[str] = None,
+                      paid: bool = False, since: Optional[str] = None,
+                      until: Optional[str] = None, format: str = "json"):
     _admin_check(request)
-    # Сводка по пользователям
-    items = []
-    for uid, row in DB.items():
-        items.append({
-            "id": int(uid),
-            "balance": int(row.get("balance") or 0),
-            "has_model": bool(row.get("has_model")),
-            "paid_any": bool(row.get("paid_any")),
-            "ref_earn_total": float(row.get("ref_earn_total") or 0.0),
-            "ref_earn_ready": float(row.get("ref_earn_ready") or 0.0),
-            "first_seen_ts": float(row.get("first_seen_ts") or 0.0),
-        })
-    items.sort(key=lambda x: x.get("first_seen_ts") or 0, reverse=True)
-    return {"ok": True, "items": items[:1000]}
+    # Keyset по (first_seen_ts, id), новые сверху; запросы к SQLite — вне event loop
+    after = _decode_cursor(cursor)
+    t_since, t_until = _opt_float(since), _opt_float(until)
+    if format in ("ndjson", "csv"):
+        async def pages():
+            cur = after
+            while True:
+                rows = await asyncio.to_thread(USERS.page_users, cur, ADMIN_EXPORT_PAGE, paid, t_since, t_until)
+                if not rows:
+                    return
+                yield [_user_item(r) for r in rows]
+                cur = (float(rows[-1].get("first_seen_ts") or 0.0), int(rows[-1]["id"]))
+        fields = ["id", "balance", "has_model", "paid_any", "ref_earn_total", "ref_earn_ready", "first_seen_ts"]
+        return _export_response(pages(), format, fields, "users")
+    limit = max(1, min(int(limit), 1000))
+    rows = await asyncio.to_thread(USERS.page_users, after, limit, paid, t_since, t_until)
+    items = [_user_item(r) for r in rows]
+    nxt = _encode_cursor(items[-1]["first_seen_ts"], items[-1]["id"]) if len(items) == limit else None
+    return {"ok": True, "items": items, "next_cursor": nxt}
+
+@app.get("/admin/referrals/{user_id}")
+async def admin_referrals(user_id: int, request: Request):
+    _admin_check(request)
+    # Аудит: рефералы из индекса + журнал начислений по оплатам (только чтение — get_user создал бы пользователя)
+    row = USERS.get(user_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="user not found")
+    await USERS.async_flush(timeout=2.0)  # журнал читается из базы — сбросить ещё не записанное
+    totals = USERS.accrual_totals(user_id)
+    return {
+        "ok": True,
+        "user_id": user_id,
+        "referees": REFS.referees(user_id),
+        "accruals": USERS.accruals(user_id),
+        "totals": totals,
+        "ref_earn_total": row.get("ref_earn_total") or 0.0,
+        "ref_earn_ready": row.get("ref_earn_ready") or 0.0,
+        "consistent": abs(float(totals["commission"]) - float(row.get("ref_earn_total") or 0.0)) < 0.01,
+    }
+
+@app.get("/admin/analytics")
+async def admin_analytics(request: Request, q: str = "conversion", bucket: int = 86400,
+                          since: Optional[str] = None, until: Optional[str] = None, top: int = 100):
+    _admin_check(request)
+    # Когортные запросы по колоночному снимку (numpy group-by), без циклов по пользователям
+    await COLS.ensure(USERS, PAYMENTS)
+    t_since, t_until = _opt_float(since), _opt_float(until)
+    bucket = max(60, int(bucket))
+    t0 = time.perf_counter()
+    if q == "conversion":
+        data: Any = COLS.conversion(bucket, t_since, t_until)
+    elif q == "revenue":
+        data = COLS.revenue(bucket, t_since, t_until)
+    elif q == "revenue_by_ref":
+        data = COLS.revenue_by_ref(t_since, t_until, top=max(1, int(top)))
+    elif q == "balance":
+        data = COLS.balance_distribution()
+    else:
+        raise HTTPException(status_code=400, detail="q must be conversion|revenue|revenue_by_ref|balance")
+    return {"ok": True, "q": q, "data": data, "ms": round((time.perf_counter() - t0) * 1000, 2)}
@@ -0,0 +1,227 @@
+# mirror.py
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import mimetypes
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+from urllib.parse import urlparse
+
+from httpclients import REPLICATE_HTTP
+from singleflight import SingleFlight
+
+log = logging.getLogger("mirror")
+
+NAME_RE = re.compile(r"^[0-9a-f]{64}\.(png|jpg|jpeg|webp)$")
+EXTS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+MAX_FILE_BYTES = 50 * 1024 * 1024
+TOUCH_EVERY = 3600.0  # mtime — порядок LRU между рестартами; обновляем не чаще раза в час
+
+
+class OutputMirror:
+    """
+    Локальная копия результатов Replicate: файл по sha256 содержимого (одинаковые — один файл),
+    раздаётся с нашего домена. Ссылки Replicate живут недолго и CDN бывает медленным — Telegram
+    получает нашу ссылку. Общий объём ограничен max_bytes: вытесняются давно не запрошенные (LRU).
+    """
+
+    def __init__(self, root: str, max_bytes: int, wait: float, enabled: bool = True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.wait = wait
+        self.enabled = enabled
+        self.total = 0
+        self._lru: "OrderedDict[str, int]" = OrderedDict()     # name -> size, в конце — недавние
+        self._by_url: "OrderedDict[str, str]" = OrderedDict()  # url Replicate -> name
+        self._touched: Dict[str, float] = {}
+        self._flight = SingleFlight()
+        self._tasks: set = set()
+        # имя между вычислением и записью — вытеснение его пропускает;
+        # имя, чей файл удаляется в потоке, — запись ждёт конца удаления
+        self._storing: Dict[str, int] = {}
+        self._removing: Dict[str, asyncio.Future] = {}
+        self.stats = {"downloads": 0, "dedup": 0, "failures": 0, "hits": 0, "evicted": 0, "served_local": 0}
+
+    # ---- файлы ----
+    def path_for(self, name: str) -> str:
+        return os.path.join(self.root, name[:2], name)
+
+    def valid_name(self, name: str) -> bool:
+        return bool(NAME_RE.match(name or ""))
+
+    def load(self) -> None:
+        """Скан каталога при старте (в потоке): порядок LRU — по mtime."""
+        os.makedirs(self.root, exist_ok=True)
+        items: List[Tuple[float, str, int]] = []
+        for dirpath, _, files in os.walk(self.root):
+            for fn in files:
+                if not self.valid_name(fn):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, fn))
+                except OSError:
+                    continue
+                items.append((st.st_mtime, fn, st.st_size))
+        items.sort()
+        self._lru = OrderedDict((fn, size) for _, fn, size in items)
+        self.total = sum(size for _, _, size in items)
+        log.info("mirror: %d files, %.1f MB", len(self._lru), self.total / 1e6)
+
+    def _store(self, name: str, data: bytes) -> bool:
+        """Записать атомарно; False — такой файл уже есть."""
+        path = self.path_for(name)
+        if os.path.exists(path):
+            os.utime(path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return True
+
+    @staticmethod
+    def _remove(paths: List[str]) -> None:
+        for p in paths:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    # ---- загрузка ----
+    def lookup(self, url: str) -> Optional[str]:
+        name = self._by_url.get(url)
+        return name if name is not None and name in self._lru else None
+
+    async def fetch(self, url: str) -> Optional[str]:
+        """Имя локального файла для url (скачивает при необходимости) или None."""
+        name = self.lookup(url)
+        if name is not None:
+            self.stats["hits"] += 1
+            return name
+        return await self._flight.do(url, lambda: self._download(url))
+
+    async def _download(self, url: str) -> Optional[str]:
+        try:
+            async with REPLICATE_HTTP.client.stream("GET", url, timeout=60, follow_redirects=True) as r:
+                r.raise_for_status()
+                ctype = (r.headers.get("content-type") or "").split(";")[0].strip().lower()
+                chunks: List[bytes] = []
+                size = 0
+                async for chunk in r.aiter_bytes():
+                    size += len(chunk)
+                    if size > MAX_FILE_BYTES:
+                        raise ValueError("output too large")
+                    chunks.append(chunk)
+            data = b"".join(chunks)
+        except Exception as e:
+            self.stats["failures"] += 1
+            log.warning("mirror download %s failed: %r", url, e)
+            return None
+        ext = EXTS.get(ctype) or os.path.splitext(urlparse(url).path)[1].lower() or mimetypes.guess_extension(ctype) or ".png"
+        if ext not in (".png", ".jpg", ".jpeg", ".webp"):
+            ext = ".png"
+        name = hashlib.sha256(data).hexdigest() + ext
+        self._storing[name] = self._storing.get(name, 0) + 1
+        try:
+            removal = self._removing.get(name)
+            if removal is not None:
+                await asyncio.shield(removal)  # иначе найдём файл, который сейчас удалят
+            created = await asyncio.to_thread(self._store, name, data)
+        finally:
+            n = self._storing.pop(name) - 1
+            if n > 0:
+                self._storing[name] = n
+        self.stats["downloads"] += 1
+        if not created:
+            self.stats["dedup"] += 1
+        if name not in self._lru:
+            self.total += len(data)  # новый файл или уже вытесненный из индекса
+        self._lru[name] = self._lru.get(name, len(data))
+        self._lru.move_to_end(name)
+        self._by_url[url] = name
+        if len(self._by_url) > 20000:
+            self._by_url.popitem(last=False)
+        if self.total > self.max_bytes:
+            await self._evict()
+        return name
+
+    async def _evict(self) -> None:
+        """Снять самые давние до 90% лимита; файлы удаляются в потоке. Записываемые сейчас не трогаем."""
+        names: List[str] = []
+        target = int(self.max_bytes * 0.9)
+        for name in list(self._lru):
+            if self.total <= target:
+                break
+            if name in self._storing or name in self._removing:
+                continue
+            self.total -= self._lru.pop(name)
+            self._touched.pop(name, None)
+            names.append(name)
+        self.stats["evicted"] += len(names)
+        if not names:
+            return
+        # задача, а не просто await: отмена вызывающего не снимает пометку, пока поток ещё удаляет
+        task = asyncio.ensure_future(asyncio.to_thread(self._remove, [self.path_for(n) for n in names]))
+        for name in names:
+            self._removing[name] = task
+        task.add_done_callback(lambda t: [self._removing.pop(n, None) for n in names if self._removing.get(n) is t])
+        await asyncio.shield(task)
+
+    def touch(self, name: str) -> None:
+        """Обращение к файлу (раздача): в конец LRU."""
+        if name in self._lru:
+            self._lru.move_to_end(name)
+            now = time.time()
+            if now - self._touched.get(name, 0.0) > TOUCH_EVERY:
+                self._touched[name] = now
+                try:
+                    os.utime(self.path_for(name))
+                except OSError:
+                    pass
+
+    async def localize(self, urls: List[str], public_base: str) -> List[str]:
+        """
+        Запустить зеркалирование и подождать до wait секунд: готовые — нашей ссылкой,
+        остальные — ссылкой Replicate (загрузка продолжается в фоне).
+        wait=0 (по умолчанию) — не ждать: ответ не задерживается, копия нужна для повторных
+        запросов и раздачи после истечения ссылок Replicate.
+        """
+        if not self.enabled or not urls:
+            return urls
+        tasks = []
+        for u in urls:
+            t = asyncio.ensure_future(self.fetch(u))
+            self._tasks.add(t)
+            t.add_done_callback(self._tasks.discard)
+            tasks.append(t)
+        if not public_base:
+            return urls  # раздавать не с чего — только копия
+        if self.wait > 0:
+            await asyncio.wait(tasks, timeout=self.wait)
+        else:
+            await asyncio.sleep(0)  # уже скачанные (lookup) успевают завершиться без ожидания сети
+        out: List[str] = []
+        for u, t in zip(urls, tasks):
+            name = t.result() if t.done() and not t.cancelled() and t.exception() is None else None
+            if name:
+                self.stats["served_local"] += 1
+                out.append(f"{public_base}/outputs/{name}")
+            else:
+                out.append(u)
+        return out
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "enabled": self.enabled, "files": len(self._lru),
+                "bytes": self.total, "max_bytes": self.max_bytes, "pending": len(self._tasks)}
+
+
+MIRROR = OutputMirror(
+    root=os.path.join(os.getenv("DATA_DIR", "/var/data"), "outputs"),
+    max_bytes=int(float(os.getenv("MIRROR_MAX_MB", "2048")) * 1024 * 1024),
+    wait=float(os.getenv("MIRROR_WAIT", "0")),
+    enabled=(os.getenv("MIRROR_ENABLED", "1").strip().lower() in ("1", "true", "yes")),
+)
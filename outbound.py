@@ -0,0 +1,181 @@
+# outbound.py
+import os
+import time
+import random
+import asyncio
+import logging
+import email.utils
+from typing import Dict, Any, Optional
+
+import httpx
+
+from httpclients import ClientPool, REPLICATE_HTTP, YOOKASSA_HTTP
+
+log = logging.getLogger("outbound")
+
+# ответы, после которых повтор безопасен для любого запроса (запрос не выполнялся)
+RETRY_ALWAYS = (429, 503)
+# повтор только для идемпотентных запросов (GET или POST с Idempotence-Key)
+RETRY_IDEMPOTENT = (500, 502, 504)
+# ошибки до отправки запроса — повтор безопасен всегда
+SAFE_TRANSPORT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class RetryBudget:
+    """Повторы не больше ratio от первичных запросов (+ небольшой запас): при сбое апстрима не умножаем нагрузку."""
+
+    def __init__(self, ratio: float = 0.2, reserve: float = 10.0):
+        self.ratio = ratio
+        self.cap = reserve
+        self.tokens = reserve
+
+    def deposit(self) -> None:
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class TokenBucket:
+    """
+    rate запросов/с с запасом burst; общий на все корутины процесса.
+    pause(sec) — апстрим прислал Retry-After: все ждут, а не бьют в него параллельно.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = max(0.01, float(rate))
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> float:
+        """Дождаться токена; вернуть время ожидания."""
+        t0 = time.monotonic()
+        async with self._lock:  # ждущие обслуживаются по порядку
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return time.monotonic() - t0
+                await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+def retry_after_seconds(resp: httpx.Response) -> Optional[float]:
+    """Retry-After: секунды или HTTP-дата."""
+    v = (resp.headers.get("retry-after") or "").strip()
+    if not v:
+        return None
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(v).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class OutboundPolicy:
+    """
+    Единая политика исходящих запросов к апстриму: token bucket, Retry-After,
+    экспоненциальная задержка с джиттером, бюджет повторов, классификация ошибок.
+    Возвращает последний ответ (статус проверяет вызывающий) или бросает последнюю сетевую ошибку.
+    Неидемпотентный запрос (POST без ключа идемпотентности) повторяется только если он
+    заведомо не выполнен: ошибка соединения, 429, 503.
+    """
+
+    def __init__(self, name: str, prefix: str, pool: ClientPool, rate: float, burst: float,
+                 max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 20.0):
+        self.name = name
+        self.pool = pool
+        self.bucket = TokenBucket(float(os.getenv(f"{prefix}_RATE", str(rate))),
+                                  float(os.getenv(f"{prefix}_BURST", str(burst))))
+        self.max_attempts = int(os.getenv(f"{prefix}_MAX_ATTEMPTS", str(max_attempts)))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = RetryBudget(float(os.getenv(f"{prefix}_RETRY_RATIO", "0.2")))
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "retry_after": 0,
+                      "budget_exhausted": 0, "fatal": 0, "throttle_wait_s": 0.0}
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _retryable(self, status: int, idempotent: bool) -> bool:
+        return status in RETRY_ALWAYS or (idempotent and status in RETRY_IDEMPOTENT)
+
+    async def request(self, method: str, url: str, *, idempotent: Optional[bool] = None,
+                      client: Optional[httpx.AsyncClient] = None, **kw: Any) -> httpx.Response:
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD", "DELETE")
+        cl = client or self.pool.client
+        self.stats["requests"] += 1
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            waited = await self.bucket.acquire()
+            if waited > 0.001:
+                self.stats["throttled"] += 1
+                self.stats["throttle_wait_s"] += waited
+            try:
+                resp = await cl.request(method, url, **kw)
+            except httpx.TransportError as e:
+                safe = isinstance(e, SAFE_TRANSPORT) or (idempotent and isinstance(e, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)))
+                if not safe or not self._may_retry(attempt):
+                    self.stats["fatal"] += 1
+                    raise
+                delay = self._backoff(attempt)
+                log.warning("%s %s %s: %r — retry %d in %.1fs", self.name, method, url, e, attempt + 1, delay)
+            else:
+                if not self._retryable(resp.status_code, idempotent):
+                    if resp.status_code >= 400:
+                        self.stats["fatal"] += 1
+                    return resp
+                ra = retry_after_seconds(resp)
+                if ra is not None:
+                    self.stats["retry_after"] += 1
+                    self.bucket.pause(min(ra, self.max_delay * 3))  # притормозить всех, не только этот запрос
+                if not self._may_retry(attempt):
+                    return resp
+                delay = max(ra or 0.0, self._backoff(attempt))
+                log.warning("%s %s %s: HTTP %d — retry %d in %.1fs", self.name, method, url, resp.status_code, attempt + 1, delay)
+                await resp.aclose()
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    def _may_retry(self, attempt: int) -> bool:
+        if attempt + 1 >= self.max_attempts:
+            return False
+        if not self.budget.withdraw():
+            self.stats["budget_exhausted"] += 1
+            return False
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        b = self.bucket
+        return {**self.stats, "throttle_wait_s": round(self.stats["throttle_wait_s"], 2),
+                "rate": b.rate, "burst": b.burst, "budget": round(self.budget.tokens, 2),
+                "paused_for_s": round(max(0.0, b.paused_until - time.monotonic()), 1)}
+
+
+# лимиты по умолчанию ниже квот апстримов; переопределяются <PREFIX>_RATE/_BURST
+REPLICATE_OUT = OutboundPolicy("replicate", "REPLICATE", REPLICATE_HTTP, rate=8, burst=20)
+YOOKASSA_OUT = OutboundPolicy("yookassa", "YOOKASSA", YOOKASSA_HTTP, rate=5, burst=10)
+POLICIES = (REPLICATE_OUT, YOOKASSA_OUT)
+
+
+def snapshot_all() -> Dict[str, Any]:
+    return {p.name: p.snapshot() for p in POLICIES}
@@ -0,0 +1,362 @@
+# payledger.py
+import os
+import json
+import time
+import bisect
+import logging
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple, Callable, Iterator, Set
+
+from writebehind import WriteBehind
+
+log = logging.getLogger("payledger")
+
+# События платежа: created → pending → succeeded → credited (+ canceled/failed)
+EVENTS = ("created", "pending", "succeeded", "canceled", "failed", "credited")
+
+
+class PayRecord:
+    __slots__ = ("payment_id", "user_id", "qty", "amount", "status", "created_at", "updated_at", "credited")
+
+    def __init__(self, payment_id: str, user_id: int = 0, qty: int = 0, amount: int = 0,
+                 status: str = "created", created_at: float = 0.0, updated_at: float = 0.0, credited: bool = False):
+        self.payment_id = payment_id
+        self.user_id = user_id
+        self.qty = qty
+        self.amount = amount
+        self.status = status
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.credited = credited
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_row(cls, d: Dict[str, Any]) -> "PayRecord":
+        return cls(**{k: d[k] for k in cls.__slots__ if k in d and d[k] is not None})
+
+
+class PaymentLedger:
+    """
+    Журнал платежей: payments.log (JSONL, только дозапись) + payments.snap.json.
+    Состояние восстанавливается из снапшота и хвоста журнала; раз в compact_every
+    событий снапшот переписывается и журнал усекается (собирается и пишется потоком-писателем).
+    Индексы: payment_id → запись, user_id → [payment_id], created_at (отсортирован).
+
+    С archive (таблица payments в users.sqlite3) в памяти только горячие платежи — изменённые
+    за последние hot_days; при compaction поток-писатель выгружает все записи в архив (fsync),
+    и лишь после этого холодные уходят из индексов и снапшота. Чтения (get, идемпотентность
+    начислений, страницы админки) дополняются архивом по индексу, событие по холодному
+    платежу поднимает его обратно в память. status_counts — по всем платежам.
+    Без archive индексы держат всё (~300 байт на платёж).
+    """
+
+    def __init__(self, data_dir: str, compact_every: int = 5000, flush_interval: float = 0.5,
+                 archive=None, hot_days: float = 7.0):
+        self.log_path = os.path.join(data_dir, "payments.log")
+        self.snap_path = os.path.join(data_dir, "payments.snap.json")
+        self.compact_every = int(compact_every)
+        self.archive = archive
+        self.hot_secs = float(hot_days) * 86400
+        self.by_id: Dict[str, PayRecord] = {}
+        self.by_user: Dict[int, List[str]] = {}
+        self.by_created: List[Tuple[float, str]] = []
+        self.status_counts: Dict[str, int] = {}
+        self._archived: deque = deque()  # (payment_id, updated_at) уже в архиве — поток-писатель → loop
+        self._seq = 0
+        self._since_compact = 0
+        self.listeners: List[Callable[[PayRecord], None]] = []  # зовутся после каждого живого события
+        self.wb = WriteBehind("payments", self._flush, interval=flush_interval)
+        self._recover()
+
+    # ---- чтение ----
+    def __len__(self) -> int:
+        return sum(self.status_counts.values())
+
+    def __contains__(self, payment_id: str) -> bool:
+        return self.get(payment_id) is not None
+
+    def get(self, payment_id: str) -> Optional[PayRecord]:
+        rec = self.by_id.get(payment_id)
+        if rec is None and self.archive is not None:
+            row = self.archive.get_payment(payment_id)
+            if row is not None:
+                rec = PayRecord.from_row(row)  # копия из архива, в индексы не попадает
+        return rec
+
+    def for_user(self, user_id: int) -> List[PayRecord]:
+        out = [self.by_id[p] for p in self.by_user.get(int(user_id), [])]
+        if self.archive is not None:
+            hot = set(self.by_user.get(int(user_id), []))
+            out += [PayRecord.from_row(r) for r in self.archive.user_payments(int(user_id))
+                    if r["payment_id"] not in hot]
+            out.sort(key=lambda r: (r.created_at, r.payment_id))
+        return out
+
+    def page(self, after: Optional[Tuple[float, str]], limit: int, status: Optional[str] = None,
+             since: Optional[float] = None, until: Optional[float] = None) -> List[PayRecord]:
+        """Keyset-страница по (created_at, payment_id) по убыванию; after — последний ключ прошлой страницы."""
+        out = self._page_hot(after, limit, status, since, until)
+        if self.archive is None:
+            return out
+        # архив: свежие версии горячих платежей — в памяти, их строки архива пропускаем
+        cold: List[PayRecord] = []
+        cur = after
+        while len(cold) < limit:
+            rows = self.archive.page_payments(cur, limit, status, since, until)
+            cold += [PayRecord.from_row(r) for r in rows if r["payment_id"] not in self.by_id]
+            if len(rows) < limit:
+                break
+            cur = (rows[-1]["created_at"], rows[-1]["payment_id"])
+        out += cold
+        out.sort(key=lambda r: (r.created_at, r.payment_id), reverse=True)
+        return out[:limit]
+
+    def iter_archived(self, skip: Set[str]) -> Iterator[PayRecord]:
+        """Платежи из архива, кроме skip (горячие копируются на loop отдельно). Читает диск — из потока."""
+        if self.archive is None:
+            return
+        for r in self.archive.iter_payments():
+            if r["payment_id"] not in skip:
+                yield PayRecord.from_row(r)
+
+    def _page_hot(self, after: Optional[Tuple[float, str]], limit: int, status: Optional[str],
+                  since: Optional[float], until: Optional[float]) -> List[PayRecord]:
+        hi = len(self.by_created)
+        if after is not None:
+            hi = bisect.bisect_left(self.by_created, (float(after[0]), str(after[1])))
+        if until is not None:
+            hi = min(hi, bisect.bisect_left(self.by_created, (float(until), "")))
+        out: List[PayRecord] = []
+        i = hi - 1
+        while i >= 0 and len(out) < limit:
+            ts, pid = self.by_created[i]
+            if since is not None and ts < since:
+                break
+            rec = self.by_id[pid]
+            if status is None or rec.status == status:
+                out.append(rec)
+            i -= 1
+        return out
+
+    # ---- запись ----
+    def create(self, payment_id: str, user_id: int, qty: int, amount: int,
+               status: str = "pending", created_at: Optional[float] = None) -> PayRecord:
+        now = time.time()
+        if payment_id not in self:
+            self._emit({"ev": "created", "pid": payment_id, "user_id": int(user_id or 0), "qty": int(qty or 0),
+                        "amount": int(amount or 0), "created_at": float(created_at or now)})
+        if status and status in EVENTS and status != "created":
+            self.set_status(payment_id, status)
+        return self.by_id.get(payment_id) or self.get(payment_id)
+
+    def set_status(self, payment_id: str, status: str) -> None:
+        rec = self.get(payment_id)
+        if rec is None or rec.status == status or status not in EVENTS or status == "credited":
+            return
+        self._emit({"ev": status, "pid": payment_id})
+
+    def mark_credited(self, payment_id: str) -> bool:
+        """Идемпотентно: True — только для вызова, который действительно начисляет."""
+        rec = self.get(payment_id)
+        if rec is None or rec.credited:
+            return False
+        if rec.status != "succeeded":
+            self._emit({"ev": "succeeded", "pid": payment_id})
+        self._emit({"ev": "credited", "pid": payment_id})
+        return True
+
+    async def sync(self, timeout: Optional[float] = None) -> bool:
+        return await self.wb.abarrier(durable=True, timeout=timeout)
+
+    def close(self) -> None:
+        self.wb.close()
+
+    # ---- внутреннее ----
+    def _emit(self, ev: Dict[str, Any]) -> None:
+        self._seq += 1
+        ev["seq"] = self._seq
+        ev.setdefault("ts", time.time())
+        rec = self._apply(ev)
+        if rec is not None:
+            for fn in self.listeners:
+                try:
+                    fn(rec)
+                except Exception as e:
+                    log.warning("ledger listener failed: %r", e)
+        self.wb.put(("ev", self._seq), json.dumps(ev, ensure_ascii=False, separators=(",", ":")))
+        self._since_compact += 1
+        if self._since_compact >= self.compact_every:
+            self._since_compact = 0
+            self._evict()
+            # на loop — только копия списка ссылок; словари и JSON собирает поток-писатель.
+            # Запись может успеть получить события новее seq — они же останутся в хвосте журнала,
+            # а повтор события при восстановлении идемпотентен (_apply)
+            self.wb.put(("snap", self._seq), list(self.by_id.values()))
+
+    def _evict(self) -> None:
+        """Убрать из индексов холодные записи, которые поток-писатель уже выгрузил в архив."""
+        gone = set()
+        while self._archived:
+            pid, upd = self._archived.popleft()
+            rec = self.by_id.get(pid)
+            if rec is not None and rec.updated_at == upd:  # после выгрузки не менялась
+                gone.add(pid)
+        if not gone:
+            return
+        for pid in gone:
+            rec = self.by_id.pop(pid)
+            ids = self.by_user.get(rec.user_id)
+            if ids is not None:
+                ids.remove(pid)
+                if not ids:
+                    del self.by_user[rec.user_id]
+        self.by_created = [k for k in self.by_created if k[1] not in gone]
+
+    def _apply(self, ev: Dict[str, Any]) -> Optional[PayRecord]:
+        pid = ev["pid"]
+        kind = ev["ev"]
+        rec = self.by_id.get(pid)
+        if rec is None and self.archive is not None:
+            row = self.archive.get_payment(pid)
+            if row is not None:  # холодный платёж снова меняется — обратно в память (уже посчитан)
+                rec = PayRecord.from_row(row)
+                self._index(rec, count=False)
+        if rec is None:
+            if kind != "created":
+                return None
+            rec = PayRecord(pid, int(ev.get("user_id") or 0), int(ev.get("qty") or 0), int(ev.get("amount") or 0),
+                            "created", float(ev.get("created_at") or ev.get("ts") or 0.0))
+            self._index(rec)
+        if kind == "credited":
+            rec.credited = True
+        elif kind != "created":
+            self._count(rec.status, -1)
+            rec.status = kind
+            self._count(kind, +1)
+        rec.updated_at = float(ev.get("ts") or rec.updated_at)
+        return rec
+
+    def _index(self, rec: PayRecord, count: bool = True) -> None:
+        self.by_id[rec.payment_id] = rec
+        self.by_user.setdefault(rec.user_id, []).append(rec.payment_id)
+        key = (rec.created_at, rec.payment_id)
+        if not self.by_created or self.by_created[-1] <= key:
+            self.by_created.append(key)
+        else:
+            bisect.insort(self.by_created, key)
+        if count:
+            self._count(rec.status, +1)
+
+    def _count(self, status: str, d: int) -> None:
+        self.status_counts[status] = self.status_counts.get(status, 0) + d
+
+    def _load_record(self, d: Dict[str, Any]) -> None:
+        rec = PayRecord(**{k: d.get(k) for k in PayRecord.__slots__ if k in d})
+        self._index(rec)
+
+    def _recover(self) -> None:
+        snap_seq = 0
+        if os.path.exists(self.snap_path):
+            with open(self.snap_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+            snap_seq = int(snap.get("seq") or 0)
+            for d in snap.get("items") or []:
+                self._load_record(d)
+        self._seq = snap_seq
+        replayed = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ev = json.loads(line)
+                    except Exception:
+                        continue  # оборванная последняя строка после падения
+                    seq = int(ev.get("seq") or 0)
+                    if seq <= snap_seq:
+                        continue
+                    self._apply(ev)
+                    self._seq = max(self._seq, seq)
+                    replayed += 1
+        self._since_compact = replayed
+        if self.archive is not None:
+            # счётчики — по архиву, с поправкой на горячие записи (в памяти версия свежее)
+            counts = self.archive.payment_status_counts()
+            for rec in self.by_id.values():
+                row = self.archive.get_payment(rec.payment_id)
+                if row is not None:
+                    counts[row["status"]] = counts.get(row["status"], 0) - 1
+                counts[rec.status] = counts.get(rec.status, 0) + 1
+            self.status_counts = {k: v for k, v in counts.items() if v}
+        log.info("payments ledger: %d payments (%d in memory), %d events replayed",
+                 len(self), len(self.by_id), replayed)
+
+    def migrate_from_json(self, json_path: str) -> int:
+        """Разовый перенос payments.json. status=succeeded там означал «уже начислено»."""
+        if len(self) or not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f) or {}
+        except Exception as e:
+            log.error("payments.json migration failed: %r", e)
+            return 0
+        items = sorted(data.items(), key=lambda kv: float((kv[1] or {}).get("created_at") or 0))
+        for pid, p in items:
+            p = p or {}
+            status = str(p.get("status") or "pending").lower()
+            try:
+                amount = int(float(p.get("amount") or 0))
+            except Exception:
+                amount = 0
+            self.create(pid, int(p.get("user_id") or 0), int(p.get("qty") or 0), amount,
+                        status=status, created_at=float(p.get("created_at") or 0) or None)
+            if status == "succeeded":
+                self.mark_credited(pid)
+        self.wb.barrier(durable=True)
+        os.replace(json_path, json_path + ".migrated")
+        log.info("migrated %d payments from %s", len(items), json_path)
+        return len(items)
+
+    def _flush(self, batch: Dict[Any, Any], durable: bool) -> None:
+        """Поток-писатель: дозапись событий по порядку, затем (если есть) снапшот + усечение журнала."""
+        keys = sorted(batch.keys(), key=lambda k: (k[1], k[0] == "snap"))
+        lines = [batch[k] for k in keys if k[0] == "ev"]
+        snaps = [(k[1], batch[k]) for k in keys if k[0] == "snap"]
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            if lines:
+                f.write("\n".join(lines) + "\n")
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        if snaps:
+            upto, recs = snaps[-1]
+            items = [r.to_dict() for r in recs]
+            cold: List[Tuple[str, float]] = []
+            if self.archive is not None:
+                # сначала всё — в архив (fsync), и только потом холодные пропадают из снапшота
+                self.archive.put_payments(items, durable=True)
+                edge = time.time() - self.hot_secs
+                cold = [(d["payment_id"], d["updated_at"]) for d in items if d["updated_at"] < edge]
+                items = [d for d in items if d["updated_at"] >= edge]
+            snap = {"seq": upto, "items": items}
+            tmp = self.snap_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snap, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snap_path)
+            # в журнале оставляем только события новее снапшота
+            tmp = self.log_path + ".tmp"
+            with open(self.log_path, "r", encoding="utf-8") as src, open(tmp, "w", encoding="utf-8") as dst:
+                for line in src:
+                    try:
+                        if int(json.loads(line).get("seq") or 0) > upto:
+                            dst.write(line)
+                    except Exception:
+                        continue
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp, self.log_path)
+            self._archived.extend(cold)  # из индексов их уберёт loop при следующем compaction
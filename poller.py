@@ -0,0 +1,222 @@
+# poller.py
+import time
+import heapq
+import asyncio
+import logging
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable
+
+from replicate_hooks import TERMINAL
+
+log = logging.getLogger("poller")
+
+Fetch = Callable[[str, str], Awaitable[Dict[str, Any]]]            # (kind, id) -> объект Replicate
+OnUpdate = Callable[[str, str, Dict[str, Any]], Awaitable[None]]   # (kind, id, объект)
+
+# ответы, после которых повторять опрос бессмысленно (id не найден, нет доступа);
+# 408/429 — временные, их ретраит политика исходящих запросов
+FATAL_STATUSES = frozenset(range(400, 500)) - {408, 429}
+
+# ожидаемая длительность по виду, пока нет своей статистики (сек)
+DEFAULT_EXPECTED = {"prediction": 20.0, "training": 600.0}
+
+
+class StatusPoller:
+    """
+    Единственный источник опроса Replicate: все незавершённые предсказания/тренировки.
+    На id — один опрос за раз с адаптивным интервалом по состоянию:
+      starting (холодный старт)        — редко, ~expected/10;
+      processing                       — чаще по мере приближения к ожидаемому финалу;
+      дольше ожидаемого               — постепенно реже.
+    Результаты (опрос и вебхуки) публикуются в общий кэш; читатели (api_status, ожидающие)
+    смотрят в кэш, так что число запросов к API не зависит от числа читателей.
+    floor > 0 — минимальный интервал (когда есть вебхуки, опрос лишь страховка).
+    id с окончательной ошибкой (4xx) или max_errors ошибок подряд снимается с опроса:
+    публикуется как failed, ожидающие получают ошибку, а не ждут до своего таймаута.
+    """
+
+    def __init__(self, fetch: Fetch, on_update: OnUpdate, min_interval: float = 1.0, max_interval: float = 30.0,
+                 max_errors: int = 20):
+        self.fetch = fetch
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_errors = max_errors
+        self.floor = 0.0
+        self._tracked: Dict[str, Tuple[str, float, int]] = {}   # id -> (kind, started_ts, seq)
+        self._heap: List[Tuple[float, int, str]] = []
+        self._cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._errors: Dict[str, int] = {}
+        self._expected: Dict[str, float] = dict(DEFAULT_EXPECTED)
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+        self.stats = {"polls": 0, "webhooks": 0, "errors": 0, "finished": 0, "abandoned": 0}
+
+    # ---- регистрация ----
+    def track(self, kind: str, rid: str, initial: Optional[Dict[str, Any]] = None) -> None:
+        """initial — ответ на создание: тогда первый опрос по расписанию, иначе сразу."""
+        if rid in self._tracked or self.is_terminal(rid):
+            return
+        self._seq += 1
+        self._tracked[rid] = (kind, time.time(), self._seq)
+        if initial:
+            self._cache[rid] = (time.time(), initial)
+            self._next_due(rid)
+        else:
+            self._schedule(rid, time.time())
+        if self._task is None:
+            self.start()
+
+    def untrack(self, rid: str) -> None:
+        """Перестать опрашивать (ожидающий сдался по таймауту)."""
+        self._tracked.pop(rid, None)
+        self._errors.pop(rid, None)
+
+    def tracking(self, rid: str) -> bool:
+        return rid in self._tracked
+
+    def get(self, rid: str) -> Optional[Dict[str, Any]]:
+        ent = self._cache.get(rid)
+        return ent[1] if ent else None
+
+    def is_terminal(self, rid: str) -> bool:
+        obj = self.get(rid)
+        return bool(obj) and (obj.get("status") or "").lower() in TERMINAL
+
+    async def publish(self, rid: str, obj: Dict[str, Any], source: str = "poll") -> None:
+        """Новое состояние из опроса или вебхука."""
+        if source == "webhook":
+            self.stats["webhooks"] += 1
+        if self.is_terminal(rid):
+            return  # дубль финала (вебхук после опроса и наоборот)
+        self._cache[rid] = (time.time(), obj)
+        ent = self._tracked.get(rid)
+        kind = ent[0] if ent else ("training" if obj.get("destination") or "/trainings/" in str((obj.get("urls") or {}).get("get")) else "prediction")
+        status = (obj.get("status") or "").lower()
+        if status in TERMINAL:
+            self.stats["finished"] += 1
+            if ent is not None:
+                self._tracked.pop(rid, None)
+                self._errors.pop(rid, None)
+                if status == "succeeded":
+                    dur = time.time() - ent[1]
+                    self._expected[kind] = 0.8 * self._expected.get(kind, dur) + 0.2 * dur
+            self._trim_cache()
+        try:
+            await self.on_update(kind, rid, obj)
+        except Exception as e:
+            log.warning("poller on_update %s failed: %r", rid, e)
+
+    # ---- расписание ----
+    def interval(self, kind: str, status: str, elapsed: float) -> float:
+        expected = self._expected.get(kind, 30.0)
+        if status in ("", "starting", "queued"):
+            iv = expected / 10
+        elif elapsed < expected:
+            iv = (expected - elapsed) / 3
+        else:
+            iv = self.min_interval + (elapsed - expected) / 5
+        return max(self.floor, min(self.max_interval, max(self.min_interval, iv)))
+
+    def _schedule(self, rid: str, due: float) -> None:
+        ent = self._tracked.get(rid)
+        if ent is None:
+            return
+        heapq.heappush(self._heap, (due, ent[2], rid))
+        if self._heap[0][2] == rid:
+            self._wake.set()
+
+    def _next_due(self, rid: str) -> None:
+        ent = self._tracked.get(rid)
+        if ent is None:
+            return
+        kind, started, seq = ent
+        obj = self.get(rid) or {}
+        iv = self.interval(kind, (obj.get("status") or "").lower(), time.time() - started)
+        errs = self._errors.get(rid, 0)
+        if errs:
+            iv = min(self.max_interval, iv * (2 ** min(errs, 5)))
+        # новый seq — старые записи кучи отбрасываются при извлечении
+        self._seq += 1
+        self._tracked[rid] = (kind, started, self._seq)
+        self._schedule(rid, time.time() + iv)
+
+    def _trim_cache(self) -> None:
+        if len(self._cache) <= 5000:
+            return
+        now = time.time()
+        for k, (ts, obj) in list(self._cache.items()):
+            if k not in self._tracked and now - ts > 3600:
+                self._cache.pop(k, None)
+
+    # ---- цикл ----
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        for t in list(self._inflight):
+            t.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            now = time.time()
+            due: List[str] = []
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, rid = heapq.heappop(self._heap)
+                ent = self._tracked.get(rid)
+                if ent and ent[2] == seq:
+                    due.append(rid)
+            for rid in due:
+                # опросы идут параллельно; следующий срок ставится по завершении опроса
+                t = asyncio.create_task(self._poll(rid))
+                self._inflight.add(t)
+                t.add_done_callback(self._inflight.discard)
+            timeout = (self._heap[0][0] - now) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, rid: str) -> None:
+        ent = self._tracked.get(rid)
+        if ent is None:
+            return
+        self.stats["polls"] += 1
+        try:
+            obj = await self.fetch(ent[0], rid)
+            self._errors.pop(rid, None)
+            await self.publish(rid, obj)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            errs = self._errors[rid] = self._errors.get(rid, 0) + 1
+            code = getattr(getattr(e, "response", None), "status_code", None)
+            log.warning("poll %s %s failed: %r", ent[0], rid, e)
+            if code in FATAL_STATUSES or errs >= self.max_errors:
+                await self._abandon(rid, f"poll failed: HTTP {code}" if code else f"poll failed {errs} times: {e!r}")
+                return
+        self._next_due(rid)
+
+    async def _abandon(self, rid: str, reason: str) -> None:
+        """Снять id с опроса и разбудить ожидающих ошибкой (синтетический финал failed)."""
+        self.stats["abandoned"] += 1
+        log.error("poller: giving up on %s — %s", rid, reason)
+        await self.publish(rid, {"id": rid, "status": "failed", "error": reason})
+
+    def snapshot(self) -> Dict[str, Any]:
+        by_kind: Dict[str, int] = {}
+        for kind, _, _ in self._tracked.values():
+            by_kind[kind] = by_kind.get(kind, 0) + 1
+        return {**self.stats, "tracked": by_kind, "floor": self.floor,
+                "expected": {k: round(v, 1) for k, v in self._expected.items()}}
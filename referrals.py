@@ -0,0 +1,48 @@
+# referrals.py
+import time
+import logging
+from typing import Dict, Any, Set, List, Iterable, Tuple
+
+log = logging.getLogger("referrals")
+
+REF_RATE = 0.20  # 20% с оплат приглашённых
+
+
+def commission(amount: float) -> float:
+    return round(float(amount or 0) * REF_RATE, 2)
+
+
+def make_accrual(payment_id: str, referrer_id: int, referee_id: int, amount: int) -> Dict[str, Any]:
+    """Строка журнала начислений: кто, за кого, с какой оплаты и сколько."""
+    return {
+        "payment_id": str(payment_id),
+        "referrer_id": int(referrer_id),
+        "referee_id": int(referee_id),
+        "amount": int(amount or 0),
+        "rate": REF_RATE,
+        "commission": commission(amount),
+        "ts": time.time(),
+    }
+
+
+class ReferralIndex:
+    """Индекс referrer → {referee}. Строится из хранилища на старте, дальше поддерживается в save_user."""
+
+    def __init__(self):
+        self._by_referrer: Dict[int, Set[int]] = {}
+
+    def load(self, pairs: Iterable[Tuple[int, int]]) -> None:
+        n = 0
+        for referrer, referee in pairs:
+            self.add(referrer, referee)
+            n += 1
+        log.info("referral index: %d links, %d referrers", n, len(self._by_referrer))
+
+    def add(self, referrer: int, referee: int) -> None:
+        self._by_referrer.setdefault(int(referrer), set()).add(int(referee))
+
+    def referees(self, referrer: int) -> List[int]:
+        return list(self._by_referrer.get(int(referrer), ()))
+
+    def count(self, referrer: int) -> int:
+        return len(self._by_referrer.get(int(referrer), ()))
@@ -1,10 +1,15 @@
 import os
+import time
+import asyncio
 import logging
 import tempfile
 from typing import Optional, Dict, Any
 
 import replicate
 import httpx
+from replicate.exceptions import ModelError
+
+from versions import VERSIONS
 
 # ========= ENV =========
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
@@ -15,12 +20,59 @@ REPLICATE_TRAIN_VERSION = (os.getenv("REPLICATE_TRAIN_VERSION") or "").strip()
 
 REPLICATE_GEN_MODEL = os.getenv("REPLICATE_GEN_MODEL", "black-forest-labs/FLUX.1-schnell").strip()
 REPLICATE_GEN_VERSION = os.getenv("REPLICATE_GEN_VERSION", "latest").strip()
+# предел ожидания результата предсказания (сек); по истечении предсказание отменяется
+REPLICATE_SDK_TIMEOUT = float(os.getenv("REPLICATE_SDK_TIMEOUT", "300"))
 
 log = logging.getLogger("replicate_api")
 
 # SDK клиент
 client = replicate.Client(api_token=REPLICATE_API_TOKEN) if REPLICATE_API_TOKEN else None
 
+TERMINAL = ("succeeded", "failed", "canceled")
+SDK_STATS = {"runs": 0, "succeeded": 0, "failed": 0, "timeouts": 0, "cancelled": 0}
+
+
+async def _cancel_prediction(prediction_id: str) -> None:
+    try:
+        await client.predictions.async_cancel(prediction_id)
+    except Exception as e:
+        log.warning("prediction %s cancel failed: %r", prediction_id, e)
+
+
+async def _run_prediction(model_pointer: str, inputs: Dict[str, Any], timeout: Optional[float] = None) -> Any:
+    """
+    Аналог client.run на асинхронном клиенте SDK (httpx.AsyncClient): создание и опрос
+    не блокируют цикл событий. По таймауту или отмене корутины предсказание отменяется
+    и на стороне Replicate, чтобы не жечь GPU впустую.
+    """
+    SDK_STATS["runs"] += 1
+    if ":" in model_pointer:
+        prediction = await client.predictions.async_create(version=model_pointer.split(":", 1)[1], input=inputs)
+    else:
+        owner, _, name = model_pointer.partition("/")
+        prediction = await client.models.predictions.async_create(model=(owner, name), input=inputs)
+
+    deadline = time.monotonic() + (timeout or REPLICATE_SDK_TIMEOUT)
+    try:
+        while prediction.status not in TERMINAL:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                SDK_STATS["timeouts"] += 1
+                raise asyncio.TimeoutError(f"prediction {prediction.id} not finished in time")
+            await asyncio.sleep(min(client.poll_interval, left))
+            await prediction.async_reload()
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            SDK_STATS["cancelled"] += 1
+        await asyncio.shield(_cancel_prediction(prediction.id))
+        raise
+
+    if prediction.status != "succeeded":
+        SDK_STATS["failed"] += 1
+        raise ModelError(prediction.error or prediction.status)
+    SDK_STATS["succeeded"] += 1
+    return prediction.output
+
 
 # ---------- авто-определение latest версии тренера ----------
 async def _get_latest_trainer_version_id() -> Optional[str]:
@@ -41,21 +93,23 @@ async def _get_latest_trainer_version_id() -> Optional[str]:
     url = f"https://api.replicate.com/v1/models/{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}"
     headers = {"Authorization": f"Token {REPLICATE_API_TOKEN}"}
 
-    try:
+    async def fetch() -> str:
         async with httpx.AsyncClient(timeout=30) as cl:
             r = await cl.get(url, headers=headers)
             if r.status_code != 200:
                 log.error("trainer-model fetch %s: %s", r.status_code, r.text)
-                return None
+                r.raise_for_status()
             j = r.json() or {}
             versions = j.get("versions") or []
-            if not versions:
-                return None
-            latest = versions[0]
+            latest = versions[0] if versions else {}
             vid = latest.get("id") or latest.get("version")
             if not vid:
-                return None
+                raise RuntimeError("no trainer versions")
             return f"{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}:{vid}"
+
+    # общий с main/api кэш версий: ошибка кэшируется на negative TTL
+    try:
+        return await VERSIONS.resolve(("trainer", f"{REPLICATE_TRAIN_OWNER}/{REPLICATE_TRAIN_MODEL}"), fetch)
     except Exception as e:
         log.error("latest-trainer-version error: %r", e)
         return None
@@ -72,7 +126,7 @@ async def generate_image(prompt: str) -> Optional[str]:
             if REPLICATE_GEN_VERSION == "latest"
             else f"{REPLICATE_GEN_MODEL}:{REPLICATE_GEN_VERSION}"
         )
-        output = client.run(model_pointer, input={"prompt": prompt})
+        output = await _run_prediction(model_pointer, {"prompt": prompt})
         return output[0] if output else None
     except Exception as e:
         print(f"Ошибка генерации: {e}")
@@ -93,8 +147,10 @@ async def start_training(photo) -> Optional[str]:
         if not trainer_version:
             raise RuntimeError("Не удалось получить версию тренера")
 
-        training = client.trainings.create(
-            version=trainer_version,
+        model, _, version_id = trainer_version.partition(":")
+        training = await client.trainings.async_create(
+            model=model,
+            version=version_id,
             input={"instance_prompt": "photo of person", "images": [tmp.name]},
         )
         return training.id
@@ -115,7 +171,7 @@ async def generate_image_verbose(prompt: str) -> Dict[str, Any]:
             if REPLICATE_GEN_VERSION == "latest"
             else f"{REPLICATE_GEN_MODEL}:{REPLICATE_GEN_VERSION}"
         )
-        output = client.run(model_pointer, input={"prompt": prompt})
+        output = await _run_prediction(model_pointer, {"prompt": prompt})
         return {"ok": True, "images": output}
     except Exception as e:
         return {"ok": False, "where": "sdk", "error": repr(e)}
@@ -205,7 +261,7 @@ async def generate_with_model_version(model_pointer: str, prompt: str, **extra_i
         inputs = {"prompt": prompt}
         if extra_input:
             inputs.update(extra_input)
-        output = client.run(model_pointer, input=inputs)
+        output = await _run_prediction(model_pointer, inputs)
         return {"ok": True, "images": output}
     except Exception as e:
         return {"ok": False, "where": "sdk", "error": repr(e)}
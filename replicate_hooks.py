@@ -0,0 +1,106 @@
+# replicate_hooks.py
+import time
+import hmac
+import base64
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Any, Optional, List, Tuple
+
+log = logging.getLogger("replicate_hooks")
+
+TERMINAL = ("succeeded", "failed", "canceled", "cancelled", "error")
+SIGNATURE_TOLERANCE = 300  # сек, защита от повторов старых запросов
+
+
+def verify_signature(secret: str, headers: Dict[str, str], body: bytes, now: Optional[float] = None) -> bool:
+    """
+    Подпись вебхука Replicate (схема Standard Webhooks):
+    base64(HMAC-SHA256(key, f"{webhook-id}.{webhook-timestamp}.{body}")), key = base64 часть после "whsec_".
+    В webhook-signature может быть несколько подписей "v1,<sig>" через пробел (ротация ключа).
+    """
+    wid = headers.get("webhook-id") or ""
+    ts = headers.get("webhook-timestamp") or ""
+    sigs = headers.get("webhook-signature") or ""
+    if not (secret and wid and ts and sigs):
+        return False
+    try:
+        if abs((now or time.time()) - int(ts)) > SIGNATURE_TOLERANCE:
+            return False
+        key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    except Exception:
+        return False
+    signed = f"{wid}.{ts}.".encode("utf-8") + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode("ascii")
+    for part in sigs.split():
+        _, _, sig = part.partition(",")
+        if sig and hmac.compare_digest(sig, expected):
+            return True
+    return False
+
+
+def sign(secret: str, wid: str, ts: int, body: bytes) -> str:
+    """Для локального фейкового Replicate/проверок: значение заголовка webhook-signature."""
+    key = base64.b64decode(secret.split("_", 1)[1] if secret.startswith("whsec_") else secret)
+    return "v1," + base64.b64encode(hmac.new(key, f"{wid}.{ts}.".encode("utf-8") + body, hashlib.sha256).digest()).decode("ascii")
+
+
+class WatchRegistry:
+    """
+    Ожидание финального состояния предсказаний/тренировок по id.
+    Вебхук вызывает resolve(); ожидающие корутины просыпаются сразу.
+    Если вебхук пришёл раньше, чем кто-то начал ждать, результат держится early_ttl секунд.
+    """
+
+    def __init__(self, early_ttl: float = 600.0):
+        self.early_ttl = early_ttl
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._early: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self.stats = {"resolved": 0, "woken": 0, "early": 0, "timeouts": 0}
+
+    def peek(self, rid: str) -> Optional[Dict[str, Any]]:
+        ent = self._early.get(rid)
+        return ent[1] if ent else None
+
+    async def wait(self, rid: str, timeout: Optional[float]) -> Optional[Dict[str, Any]]:
+        """Финальный payload или None по таймауту (тогда вызывающий один раз опрашивает API)."""
+        early = self.peek(rid)
+        if early is not None:
+            return early
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(rid, []).append(fut)
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            return None
+        finally:
+            lst = self._waiters.get(rid)
+            if lst is not None:
+                if fut in lst:
+                    lst.remove(fut)
+                if not lst:
+                    self._waiters.pop(rid, None)
+
+    def resolve(self, rid: str, payload: Dict[str, Any]) -> int:
+        """Разбудить ожидающих; вернуть их число."""
+        self.stats["resolved"] += 1
+        now = time.time()
+        self._early[rid] = (now, payload)
+        if len(self._early) > 1000:
+            for k, (ts, _) in list(self._early.items()):
+                if now - ts > self.early_ttl:
+                    self._early.pop(k, None)
+        woken = 0
+        for fut in self._waiters.pop(rid, []):
+            if not fut.done():
+                fut.set_result(payload)
+                woken += 1
+        if woken:
+            self.stats["woken"] += woken
+        else:
+            self.stats["early"] += 1
+        return woken
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "waiting": sum(len(v) for v in self._waiters.values()), "held": len(self._early)}
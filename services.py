@@ -0,0 +1,214 @@
+# services.py
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Any, Optional, List, Callable, Awaitable
+
+import httpx
+
+log = logging.getLogger("services")
+
+
+class BackendService(ABC):
+    """
+    Что боту нужно от бэкенда: оплата, загрузка фото, обучение, генерация.
+    InProcessBackend — прямые вызовы в том же процессе (по умолчанию),
+    HttpBackend — через BACKEND_ROOT/api/... для раздельного деплоя (BACKEND_MODE=http).
+    """
+
+    @abstractmethod
+    async def create_payment(self, user_id: int, qty: int, amount: int, title: str) -> Dict[str, Any]:
+        """-> {payment_id, confirmation_url}"""
+
+    @abstractmethod
+    async def payment_status(self, payment_id: str) -> Dict[str, Any]:
+        """-> {payment_id, status}; при succeeded начисление уже выполнено."""
+
+    @abstractmethod
+    async def upload_photo(self, user_id: int, local_path: str, filename: str = "photo.jpg") -> None:
+        ...
+
+    @abstractmethod
+    async def start_training(self, user_id: int) -> Dict[str, Any]:
+        """-> {job_id, status}"""
+
+    @abstractmethod
+    async def training_status(self, job_id: str) -> Dict[str, Any]:
+        """-> {job_id, status, progress, model_id}"""
+
+    async def wait_job(self, job_id: str, timeout: float) -> None:
+        """Пауза между опросами статуса: по умолчанию 2 с; in-process — до вебхука Replicate."""
+        await asyncio.sleep(min(timeout, 2.0))
+
+    @abstractmethod
+    async def generate(self, user_id: int, prompt: str, num_images: int, job_id: Optional[str] = None,
+                       on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                       deadline: Optional[float] = None) -> List[str]:
+        """
+        on_queued(pos) — если запрос ждёт в очереди к Replicate (только in-process).
+        deadline — unix ts, после которого результат не нужен: бэкенд отменяет предсказания в Replicate.
+        """
+
+    async def generate_each(self, user_id: int, prompt: str, num_images: int, job_id: Optional[str] = None,
+                            on_image: Optional[Callable[[int, Optional[str]], Awaitable[None]]] = None,
+                            on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                            deadline: Optional[float] = None) -> List[Optional[str]]:
+        """
+        По изображению на слот: on_image(i, url|None) вызывается ровно num_images раз, по мере готовности.
+        По умолчанию — одно предсказание на все изображения; in-process — параллельные предсказания.
+        """
+        n = max(1, int(num_images or 1))
+        try:
+            urls: List[Optional[str]] = list(await self.generate(user_id, prompt, n, job_id, on_queued=on_queued,
+                                                                 deadline=deadline))[:n]
+        except Exception as e:
+            log.warning("generate failed: %r", e)
+            urls = []
+        urls += [None] * (n - len(urls))
+        if on_image is not None:
+            for i, u in enumerate(urls):
+                await on_image(i, u)
+        return urls
+
+    async def cancel_job(self, job_id: str) -> None:
+        """Обучение больше не ждём — отменить его в Replicate."""
+
+    async def close(self) -> None:
+        pass
+
+
+class InProcessBackend(BackendService):
+    """Вызывает ядро main.py напрямую: без сериализации, сетевого стека и второго цикла FastAPI."""
+
+    def __init__(self, *,
+                 pay_create: Callable[..., Awaitable[Dict[str, Any]]],
+                 pay_status: Callable[[str], Awaitable[Dict[str, Any]]],
+                 save_photo: Callable[[str, str, bytes], str],
+                 train_start: Callable[[str], Awaitable[Dict[str, Any]]],
+                 job_status: Callable[[str], Awaitable[Dict[str, Any]]],
+                 job_wait: Callable[[str, float], Awaitable[None]],
+                 generate: Callable[..., Awaitable[List[str]]],
+                 generate_fanout: Optional[Callable[..., Awaitable[List[Optional[str]]]]] = None,
+                 job_cancel: Optional[Callable[[str], Awaitable[Dict[str, Any]]]] = None):
+        self._pay_create = pay_create
+        self._pay_status = pay_status
+        self._save_photo = save_photo
+        self._train_start = train_start
+        self._job_status = job_status
+        self._job_wait = job_wait
+        self._generate = generate
+        self._generate_fanout = generate_fanout
+        self._job_cancel = job_cancel
+
+    async def create_payment(self, user_id: int, qty: int, amount: int, title: str) -> Dict[str, Any]:
+        return await self._pay_create(int(user_id), int(qty), int(amount), str(title))
+
+    async def payment_status(self, payment_id: str) -> Dict[str, Any]:
+        return await self._pay_status(payment_id)
+
+    async def upload_photo(self, user_id: int, local_path: str, filename: str = "photo.jpg") -> None:
+        def _copy() -> str:
+            with open(local_path, "rb") as f:
+                return self._save_photo(str(user_id), filename, f.read())
+        await asyncio.to_thread(_copy)
+
+    async def start_training(self, user_id: int) -> Dict[str, Any]:
+        return await self._train_start(str(user_id))
+
+    async def training_status(self, job_id: str) -> Dict[str, Any]:
+        return await self._job_status(job_id)
+
+    async def wait_job(self, job_id: str, timeout: float) -> None:
+        await self._job_wait(job_id, timeout)
+
+    async def cancel_job(self, job_id: str) -> None:
+        if self._job_cancel is not None:
+            await self._job_cancel(job_id)
+
+    async def generate(self, user_id: int, prompt: str, num_images: int, job_id: Optional[str] = None,
+                       on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                       deadline: Optional[float] = None) -> List[str]:
+        return await self._generate(user_id=str(user_id), prompt=prompt, num_images=int(num_images or 1),
+                                    job_id=job_id, on_queued=on_queued, deadline=deadline)
+
+    async def generate_each(self, user_id: int, prompt: str, num_images: int, job_id: Optional[str] = None,
+                            on_image: Optional[Callable[[int, Optional[str]], Awaitable[None]]] = None,
+                            on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                            deadline: Optional[float] = None) -> List[Optional[str]]:
+        if self._generate_fanout is None:
+            return await super().generate_each(user_id, prompt, num_images, job_id, on_image=on_image,
+                                               on_queued=on_queued, deadline=deadline)
+        return await self._generate_fanout(user_id=str(user_id), prompt=prompt, num_images=int(num_images or 1),
+                                           job_id=job_id, on_image=on_image, on_queued=on_queued, deadline=deadline)
+
+
+class HttpBackend(BackendService):
+    """Бэкенд в отдельном сервисе: те же операции через его HTTP API, один клиент на всё время жизни."""
+
+    def __init__(self, root: str):
+        self.root = (root or "").rstrip("/")
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.root, timeout=30)
+        return self._client
+
+    async def create_payment(self, user_id: int, qty: int, amount: int, title: str) -> Dict[str, Any]:
+        r = await self.client.post("/api/pay", json={
+            "user_id": int(user_id), "qty": int(qty), "amount": int(amount), "title": str(title)
+        }, timeout=30)
+        r.raise_for_status()
+        return r.json()
+
+    async def payment_status(self, payment_id: str) -> Dict[str, Any]:
+        r = await self.client.get("/api/pay/status", params={"payment_id": payment_id}, timeout=20)
+        r.raise_for_status()
+        return r.json()
+
+    async def upload_photo(self, user_id: int, local_path: str, filename: str = "photo.jpg") -> None:
+        with open(local_path, "rb") as f:
+            files = {"file": (filename, f, "image/jpeg")}
+            r = await self.client.post("/api/upload_photo", data={"user_id": str(user_id)}, files=files, timeout=120)
+            r.raise_for_status()
+
+    async def start_training(self, user_id: int) -> Dict[str, Any]:
+        r = await self.client.post("/api/train", data={"user_id": str(user_id)}, timeout=180)
+        r.raise_for_status()
+        return r.json()
+
+    async def training_status(self, job_id: str) -> Dict[str, Any]:
+        r = await self.client.get(f"/api/status/{job_id}", timeout=30)
+        r.raise_for_status()
+        return r.json()
+
+    async def cancel_job(self, job_id: str) -> None:
+        try:
+            r = await self.client.post(f"/api/cancel/{job_id}", timeout=20)
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            log.warning("cancel job %s failed: %r", job_id, e)
+
+    async def generate(self, user_id: int, prompt: str, num_images: int, job_id: Optional[str] = None,
+                       on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+                       deadline: Optional[float] = None) -> List[str]:
+        body: Dict[str, Any] = {"user_id": str(user_id), "prompt": prompt, "num_images": int(num_images or 1)}
+        if job_id:
+            body["job_id"] = job_id
+        timeout, headers = 240.0, {}
+        if deadline is not None:
+            # остаток, а не абсолютное время — часы сервисов могут расходиться;
+            # наш таймаут чуть длиннее, чтобы бэкенд успел ответить 504 и отменить предсказание сам
+            left = max(1.0, deadline - time.time())
+            headers["X-Request-Timeout"] = f"{left:.1f}"
+            timeout = left + 10
+        r = await self.client.post("/api/generate", json=body, headers=headers, timeout=timeout)
+        r.raise_for_status()
+        return r.json().get("images") or []
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,71 @@
+# singleflight.py
+import asyncio
+from typing import Dict, Any, Hashable, Callable, Awaitable, Optional
+
+
+class SingleFlight:
+    """Один запрос на ключ: параллельные вызовы с тем же ключом ждут результат первого."""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    def inflight(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.stats["calls"] += 1
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.stats["shared"] += 1
+            # shield: отмена одного ожидающего не отменяет общий запрос
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            res = await fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            if not fut.done():
+                fut.set_exception(e)
+            fut.exception()  # помечаем как полученное — без "exception was never retrieved"
+            raise
+        else:
+            fut.set_result(res)
+            return res
+        finally:
+            self._inflight.pop(key, None)
+
+    async def share(self, key: Hashable, fn: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        """
+        Как do(), но общий запрос — отдельная задача: у каждого ожидающего свой timeout
+        (asyncio.TimeoutError), уход одного не отменяет результат для остальных.
+        Задача отменяется, когда ожидающих не осталось.
+        """
+        self.stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.stats["shared"] += 1
+        self._waiters[key] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        finally:
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if self._waiters[key] <= 0:
+                    task.cancel()
+
+    def _forget(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            self._inflight.pop(key, None)
+            self._waiters.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # результат забрали ожидающие (или они ушли) — без "never retrieved"
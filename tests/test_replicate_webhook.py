@@ -0,0 +1,78 @@
+# tests/test_replicate_webhook.py
+import os
+import json
+import time
+import asyncio
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="webhook-test-"))
+
+import httpx
+import pytest
+
+import main
+from replicate_hooks import sign
+
+SECRET = "whsec_dGVzdC1zZWNyZXQ="  # base64("test-secret")
+
+
+@pytest.fixture(autouse=True)
+def webhook_secret(monkeypatch):
+    monkeypatch.setattr(main, "REPLICATE_WEBHOOK_SECRET", SECRET)
+
+
+async def _post(body: bytes, ts: int = None, sent: bytes = None) -> httpx.Response:
+    """Подписывает body, отправляет sent (по умолчанию тот же body)."""
+    ts = int(time.time()) if ts is None else ts
+    headers = {"webhook-id": "msg_1", "webhook-timestamp": str(ts),
+               "webhook-signature": sign(SECRET, "msg_1", ts, body), "content-type": "application/json"}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as cl:
+        return await cl.post("/replicate/webhook", content=body if sent is None else sent, headers=headers)
+
+
+def test_signed_webhook_wakes_waiter_and_updates_training_job():
+    main.jobs["job-1"] = {"job_id": "job-1", "training_id": "tr-1", "status": "processing"}
+    main._job_by_training["tr-1"] = "job-1"
+    body = json.dumps({"id": "tr-1", "status": "succeeded", "destination": "me/model",
+                       "output": {"version": "me/model:abc123"}}).encode()
+
+    async def run():
+        waiter = asyncio.create_task(main.HOOKS.wait("tr-1", 5))
+        await asyncio.sleep(0)
+        r = await _post(body)
+        return r, await waiter
+
+    r, got = asyncio.run(run())
+    assert r.status_code == 200
+    assert got["status"] == "succeeded"
+    j = main.jobs["job-1"]
+    assert j["status"] == "succeeded"
+    assert (j["model_id"], j["model_version"]) == ("me/model:abc123", "abc123")
+
+
+def test_tampered_body_is_rejected():
+    body = json.dumps({"id": "pr-2", "status": "succeeded"}).encode()
+    r = asyncio.run(_post(body, sent=body.replace(b"pr-2", b"pr-3")))
+    assert r.status_code == 403
+    assert main.HOOKS.peek("pr-3") is None
+
+
+def test_expired_timestamp_is_rejected():
+    body = json.dumps({"id": "pr-4", "status": "succeeded"}).encode()
+    r = asyncio.run(_post(body, ts=int(time.time()) - 3600))
+    assert r.status_code == 403
+    assert main.HOOKS.peek("pr-4") is None
+
+
+def test_early_webhook_is_delivered_to_later_waiter():
+    body = json.dumps({"id": "pr-5", "status": "succeeded", "output": ["https://x/1.png"]}).encode()
+
+    async def run():
+        r = await _post(body)
+        return r, await main.HOOKS.wait("pr-5", 0.1)
+
+    r, got = asyncio.run(run())
+    assert r.status_code == 200
+    assert got is not None and got["output"] == ["https://x/1.png"]
@@ -0,0 +1,32 @@
+# tests/test_writebehind.py
+import threading
+
+from userstore import SqliteUserStore, BufferedUserStore
+
+
+def test_read_during_flush_merges_inflight_and_pending(tmp_path):
+    inner = SqliteUserStore(str(tmp_path / "users.db"))
+    inner.put({"id": 1, "balance": 0, "gender_pref": None})
+    store = BufferedUserStore(inner, interval=0)
+
+    entered, release = threading.Event(), threading.Event()
+    put_many = inner.put_many
+
+    def slow_put_many(*a, **kw):
+        entered.set()
+        release.wait(5)
+        put_many(*a, **kw)
+
+    inner.put_many = slow_put_many
+    try:
+        store.update(1, {"balance": 7})          # уходит в сброс и зависает в нём
+        assert entered.wait(5)
+        store.update(1, {"gender_pref": "men"})  # новая частичная правка того же ключа
+        row = store.get(1)
+        assert row["balance"] == 7
+        assert row["gender_pref"] == "men"
+    finally:
+        release.set()
+    store.close()
+    row = SqliteUserStore(str(tmp_path / "users.db")).get(1)
+    assert (row["balance"], row["gender_pref"]) == (7, "men")
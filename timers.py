@@ -0,0 +1,120 @@
+# timers.py
+import time
+import heapq
+import asyncio
+import logging
+from typing import Dict, Any, Optional, List, Tuple, Callable, Awaitable
+
+log = logging.getLogger("timers")
+
+Handler = Callable[[int, Dict[str, Any]], Awaitable[None]]
+SEEDED = ":seeded"  # строка-маркер "<kind>:seeded" в таблице таймеров: разовое заполнение kind выполнено
+
+
+class DeferredScheduler:
+    """
+    Отложенные действия по пользователям (акции, напоминания).
+    Один таймер на (kind, user_id); min-heap по времени срабатывания, одна корутина
+    спит ровно до ближайшего. Записи хранятся в хранилище и переживают рестарт.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._entries: Dict[Tuple[str, int], Tuple[float, int, Dict[str, Any]]] = {}
+        self._handlers: Dict[str, Handler] = {}
+        self._seeded: set = set()
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"scheduled": 0, "fired": 0, "errors": 0}
+
+    def register(self, kind: str, handler: Handler) -> None:
+        self._handlers[kind] = handler
+
+    def load(self) -> int:
+        for t in self.store.load_timers():
+            if t["kind"].endswith(SEEDED):
+                self._seeded.add(t["kind"][:-len(SEEDED)])
+                continue
+            self._push(t["kind"], t["user_id"], t["due_ts"], t["payload"])
+        return len(self._entries)
+
+    def seeded(self, kind: str) -> bool:
+        return kind in self._seeded
+
+    def mark_seeded(self, kind: str) -> None:
+        """Разовое заполнение таймеров kind из хранилища сделано — на следующих стартах не повторять."""
+        self._seeded.add(kind)
+        self.store.put_timer(kind + SEEDED, 0, 0.0)
+
+    def has(self, kind: str, uid: int) -> bool:
+        return (kind, int(uid)) in self._entries
+
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def schedule(self, kind: str, uid: int, due_ts: float, payload: Optional[Dict[str, Any]] = None) -> None:
+        """Поставить/перенести таймер (kind, uid)."""
+        self._push(kind, int(uid), float(due_ts), payload or {})
+        self.store.put_timer(kind, int(uid), float(due_ts), payload or {})
+        self.stats["scheduled"] += 1
+
+    def cancel(self, kind: str, uid: int) -> None:
+        if self._entries.pop((kind, int(uid)), None) is not None:
+            self.store.put_timer(kind, int(uid), None)
+
+    def _push(self, kind: str, uid: int, due_ts: float, payload: Dict[str, Any]) -> None:
+        self._seq += 1
+        # старые записи в куче не удаляем — они отбрасываются по несовпадению seq
+        self._entries[(kind, uid)] = (due_ts, self._seq, payload)
+        heapq.heappush(self._heap, (due_ts, self._seq, kind, uid))
+        if self._heap[0][1] == self._seq:
+            self._wake.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due_ts, seq, kind, uid = heapq.heappop(self._heap)
+                cur = self._entries.get((kind, uid))
+                if not cur or cur[1] != seq:
+                    continue
+                await self._fire(kind, uid, cur[2])
+                # снимаем после выполнения (если за это время не перепланировали)
+                cur2 = self._entries.get((kind, uid))
+                if cur2 and cur2[1] == seq:
+                    del self._entries[(kind, uid)]
+                    self.store.put_timer(kind, uid, None)
+                now = time.time()
+            timeout = (self._heap[0][0] - now) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, kind: str, uid: int, payload: Dict[str, Any]) -> None:
+        h = self._handlers.get(kind)
+        if not h:
+            log.warning("no handler for timer kind=%s uid=%s", kind, uid)
+            return
+        try:
+            await h(uid, payload)
+            self.stats["fired"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            log.exception("timer %s for %s failed: %r", kind, uid, e)
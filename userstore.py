@@ -0,0 +1,672 @@
+# userstore.py
+import os
+import json
+import sqlite3
+import threading
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Any, Optional, List, Iterator, Tuple
+
+from writebehind import WriteBehind, MISSING
+
+log = logging.getLogger("userstore")
+
+# Колонки таблицы users: имя -> SQL-тип. Порядок = порядок полей UserState.
+USER_COLUMNS: Dict[str, str] = {
+    "id": "INTEGER PRIMARY KEY",
+    "balance": "INTEGER NOT NULL DEFAULT 0",
+    "has_model": "INTEGER NOT NULL DEFAULT 0",
+    "job_id": "TEXT",
+    "model_id": "TEXT",
+    "model_version": "TEXT",
+    "referred_by": "INTEGER",
+    "ref_code": "TEXT",
+    "ref_earn_total": "REAL NOT NULL DEFAULT 0",
+    "ref_earn_ready": "REAL NOT NULL DEFAULT 0",
+    "first_seen_ts": "REAL NOT NULL DEFAULT 0",
+    "flash_sent": "INTEGER NOT NULL DEFAULT 0",
+    "paid_any": "INTEGER NOT NULL DEFAULT 0",
+    "gender_pref": "TEXT",
+    "bought_spec1": "INTEGER NOT NULL DEFAULT 0",
+    "bought_spec2": "INTEGER NOT NULL DEFAULT 0",
+    "purchases": "TEXT NOT NULL DEFAULT '{}'",
+}
+BOOL_COLUMNS = ("has_model", "flash_sent", "paid_any", "bought_spec1", "bought_spec2")
+JSON_COLUMNS = ("purchases",)
+
+# Реферальные начисления: одна строка на оплату приглашённого (payment_id уникален)
+ACCRUAL_COLUMNS: Dict[str, str] = {
+    "payment_id": "TEXT PRIMARY KEY",
+    "referrer_id": "INTEGER NOT NULL",
+    "referee_id": "INTEGER NOT NULL",
+    "amount": "INTEGER NOT NULL",
+    "rate": "REAL NOT NULL",
+    "commission": "REAL NOT NULL",
+    "ts": "REAL NOT NULL",
+}
+
+# ref_earn_total, накопленный до журнала начислений, — одна строка на реферера
+# (payment_id "legacy:<id>", referee_id 0), чтобы сумма журнала сходилась с ref_earn_total
+LEGACY_ACCRUAL_PREFIX = "legacy:"
+SCHEMA_VERSION = 1  # PRAGMA user_version: 1 — перенесены legacy-начисления
+
+# Платежи в той же базе: отметка credited пишется одной транзакцией с балансом
+# (повтор вебхука после сбоя видит её, а не только журнал payments.log)
+PAYMENT_COLUMNS: Dict[str, str] = {
+    "payment_id": "TEXT PRIMARY KEY",
+    "user_id": "INTEGER NOT NULL DEFAULT 0",
+    "qty": "INTEGER NOT NULL DEFAULT 0",
+    "amount": "INTEGER NOT NULL DEFAULT 0",
+    "status": "TEXT NOT NULL DEFAULT 'created'",
+    "created_at": "REAL NOT NULL DEFAULT 0",
+    "updated_at": "REAL NOT NULL DEFAULT 0",
+    "credited": "INTEGER NOT NULL DEFAULT 0",
+}
+
+INDEXES = {
+    "idx_users_referred_by": "referred_by",
+    "idx_users_first_seen": "first_seen_ts",
+    "idx_users_flash_sent": "flash_sent",
+    "idx_users_paid_any": "paid_any",
+}
+
+
+def _to_db(row: Dict[str, Any]) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for k in USER_COLUMNS:
+        if k not in row:
+            continue
+        v = row[k]
+        if k in BOOL_COLUMNS:
+            v = 1 if v else 0
+        elif k in JSON_COLUMNS:
+            v = json.dumps(v or {}, ensure_ascii=False)
+        out[k] = v
+    return out
+
+
+def _from_db(r: sqlite3.Row) -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for k in r.keys():
+        v = r[k]
+        if k in BOOL_COLUMNS:
+            v = bool(v)
+        elif k in JSON_COLUMNS:
+            try:
+                v = json.loads(v or "{}")
+            except Exception:
+                v = {}
+        out[k] = v
+    return out
+
+
+def _payment_row(r: sqlite3.Row) -> Dict[str, Any]:
+    d = dict(r)
+    d["credited"] = bool(d["credited"])
+    return d
+
+
+class UserStore(ABC):
+    """Интерфейс хранилища пользователей. Строка — dict с полями UserState."""
+
+    @abstractmethod
+    def get(self, uid: int) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put(self, row: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def update(self, uid: int, changes: Dict[str, Any]) -> None:
+        """Записать только изменённые поля."""
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    @abstractmethod
+    def iter_rows(self, batch: int = 500) -> Iterator[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def get_many(self, uids: List[int]) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def referral_pairs(self) -> Iterator[Tuple[int, int]]:
+        ...
+
+    @abstractmethod
+    def add_accrual(self, acc: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def accruals(self, referrer_id: int) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def accrual_totals(self, referrer_id: int) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def get_payment(self, payment_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put_payment(self, row: Dict[str, Any]) -> None:
+        """Неполная строка: пишутся только переданные поля; credited только 0 -> 1."""
+
+    @abstractmethod
+    def flash_candidates(self, seen_before_ts: float) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def load_timers(self) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    def put_timer(self, kind: str, uid: int, due_ts: Optional[float], payload: Optional[Dict[str, Any]] = None) -> None:
+        """due_ts=None — удалить таймер."""
+
+    @abstractmethod
+    def summary(self) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def page_users(self, after: Optional[Tuple[float, int]], limit: int, paid_only: bool = False,
+                   since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Keyset-страница по (first_seen_ts, id) по убыванию; after — последний ключ прошлой страницы."""
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteUserStore(UserStore):
+    """SQLite (WAL) — построчные чтения/записи вместо перезаписи users.json целиком."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._init_schema()
+        # отдельное соединение для чтений: в WAL читатели не ждут писателя
+        self._rlock = threading.RLock()
+        self._rconn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._rconn.row_factory = sqlite3.Row
+
+    def _init_schema(self) -> None:
+        cols = ", ".join(f"{k} {t}" for k, t in USER_COLUMNS.items())
+        with self._lock:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS users ({cols})")
+            # новые поля UserState в существующей базе — ALTER TABLE ADD COLUMN
+            have = {r[1] for r in self._conn.execute("PRAGMA table_info(users)").fetchall()}
+            for k, t in USER_COLUMNS.items():
+                if k not in have:
+                    self._conn.execute(f"ALTER TABLE users ADD COLUMN {k} {t}")
+                    log.info("users: added column %s", k)
+            for name, col in INDEXES.items():
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON users({col})")
+            acols = ", ".join(f"{k} {t}" for k, t in ACCRUAL_COLUMNS.items())
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS ref_accruals ({acols})")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accruals_referrer ON ref_accruals(referrer_id, ts)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS timers (kind TEXT NOT NULL, user_id INTEGER NOT NULL, "
+                "due_ts REAL NOT NULL, payload TEXT NOT NULL DEFAULT '{}', PRIMARY KEY (kind, user_id))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_timers_due ON timers(due_ts)")
+            pcols = ", ".join(f"{k} {t}" for k, t in PAYMENT_COLUMNS.items())
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS payments ({pcols})")
+            # архив журнала платежей: страницы админки и поиск по пользователю
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_created ON payments(created_at, payment_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)")
+
+    # ---- чтение ----
+    def get(self, uid: int) -> Optional[Dict[str, Any]]:
+        with self._rlock:
+            r = self._rconn.execute("SELECT * FROM users WHERE id = ?", (int(uid),)).fetchone()
+        return _from_db(r) if r else None
+
+    def count(self) -> int:
+        with self._rlock:
+            return int(self._rconn.execute("SELECT COUNT(*) FROM users").fetchone()[0])
+
+    def iter_rows(self, batch: int = 500) -> Iterator[Dict[str, Any]]:
+        last = None
+        while True:
+            with self._rlock:
+                if last is None:
+                    rows = self._rconn.execute("SELECT * FROM users ORDER BY id LIMIT ?", (batch,)).fetchall()
+                else:
+                    rows = self._rconn.execute("SELECT * FROM users WHERE id > ? ORDER BY id LIMIT ?", (last, batch)).fetchall()
+            if not rows:
+                return
+            for r in rows:
+                yield _from_db(r)
+            last = rows[-1]["id"]
+
+    def get_many(self, uids: List[int]) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        ids = [int(u) for u in uids]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            with self._rlock:
+                rows = self._rconn.execute(
+                    f"SELECT * FROM users WHERE id IN ({', '.join('?' for _ in chunk)})", chunk
+                ).fetchall()
+            out.extend(_from_db(r) for r in rows)
+        return out
+
+    def referral_pairs(self) -> Iterator[Tuple[int, int]]:
+        with self._rlock:
+            rows = self._rconn.execute(
+                "SELECT referred_by, id FROM users WHERE referred_by IS NOT NULL"
+            ).fetchall()
+        for r in rows:
+            yield int(r[0]), int(r[1])
+
+    def accruals(self, referrer_id: int) -> List[Dict[str, Any]]:
+        with self._rlock:
+            rows = self._rconn.execute(
+                "SELECT * FROM ref_accruals WHERE referrer_id = ? ORDER BY ts DESC", (int(referrer_id),)
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def accrual_totals(self, referrer_id: int) -> Dict[str, Any]:
+        with self._rlock:
+            r = self._rconn.execute(
+                "SELECT COUNT(NULLIF(referee_id, 0)) AS payments, COALESCE(SUM(amount), 0) AS turnover, "
+                "COALESCE(SUM(commission), 0) AS commission FROM ref_accruals WHERE referrer_id = ?",
+                (int(referrer_id),),
+            ).fetchone()
+        return dict(r)
+
+    def get_payment(self, payment_id: str) -> Optional[Dict[str, Any]]:
+        with self._rlock:
+            r = self._rconn.execute("SELECT * FROM payments WHERE payment_id = ?", (str(payment_id),)).fetchone()
+        if r is None:
+            return None
+        return _payment_row(r)
+
+    def user_payments(self, uid: int) -> List[Dict[str, Any]]:
+        with self._rlock:
+            rows = self._rconn.execute(
+                "SELECT * FROM payments WHERE user_id = ? ORDER BY created_at, payment_id", (int(uid),)
+            ).fetchall()
+        return [_payment_row(r) for r in rows]
+
+    def page_payments(self, after: Optional[Tuple[float, str]], limit: int, status: Optional[str] = None,
+                      since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Keyset-страница по (created_at, payment_id) по убыванию — как PaymentLedger.page."""
+        where, args = [], []
+        if after is not None:
+            where.append("(created_at, payment_id) < (?, ?)")
+            args += [float(after[0]), str(after[1])]
+        if until is not None:
+            where.append("created_at < ?")
+            args.append(float(until))
+        if since is not None:
+            where.append("created_at >= ?")
+            args.append(float(since))
+        if status is not None:
+            where.append("status = ?")
+            args.append(status)
+        sql = "SELECT * FROM payments"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC, payment_id DESC LIMIT ?"
+        with self._rlock:
+            rows = self._rconn.execute(sql, args + [int(limit)]).fetchall()
+        return [_payment_row(r) for r in rows]
+
+    def iter_payments(self, batch: int = 1000) -> Iterator[Dict[str, Any]]:
+        last = ""
+        while True:
+            with self._rlock:
+                rows = self._rconn.execute(
+                    "SELECT * FROM payments WHERE payment_id > ? ORDER BY payment_id LIMIT ?", (last, int(batch))
+                ).fetchall()
+            if not rows:
+                return
+            for r in rows:
+                yield _payment_row(r)
+            last = rows[-1]["payment_id"]
+
+    def payment_status_counts(self) -> Dict[str, int]:
+        with self._rlock:
+            rows = self._rconn.execute("SELECT status, COUNT(*) FROM payments GROUP BY status").fetchall()
+        return {str(r[0]): int(r[1]) for r in rows}
+
+    def flash_candidates(self, seen_before_ts: float) -> List[Dict[str, Any]]:
+        with self._rlock:
+            rows = self._rconn.execute(
+                "SELECT * FROM users WHERE flash_sent = 0 AND first_seen_ts <= ?", (float(seen_before_ts),)
+            ).fetchall()
+        return [_from_db(r) for r in rows]
+
+    def load_timers(self) -> List[Dict[str, Any]]:
+        with self._rlock:
+            rows = self._rconn.execute("SELECT kind, user_id, due_ts, payload FROM timers ORDER BY due_ts").fetchall()
+        out = []
+        for r in rows:
+            try:
+                payload = json.loads(r["payload"] or "{}")
+            except Exception:
+                payload = {}
+            out.append({"kind": r["kind"], "user_id": int(r["user_id"]), "due_ts": float(r["due_ts"]), "payload": payload})
+        return out
+
+    def summary(self) -> Dict[str, Any]:
+        with self._rlock:
+            r = self._rconn.execute(
+                "SELECT COUNT(*) AS users, COALESCE(SUM(balance), 0) AS balances, "
+                "COALESCE(SUM(has_model), 0) AS models, COALESCE(SUM(paid_any), 0) AS paid, "
+                "COALESCE(SUM(ref_earn_total), 0) AS ref_total, COALESCE(SUM(ref_earn_ready), 0) AS ref_ready, "
+                "MIN(first_seen_ts) AS oldest_ts FROM users"
+            ).fetchone()
+        return dict(r)
+
+    def page_users(self, after: Optional[Tuple[float, int]], limit: int, paid_only: bool = False,
+                   since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        where: List[str] = []
+        args: List[Any] = []
+        if after is not None:
+            where.append("(first_seen_ts < ? OR (first_seen_ts = ? AND id < ?))")
+            args += [float(after[0]), float(after[0]), int(after[1])]
+        if paid_only:
+            where.append("paid_any = 1")
+        if since is not None:
+            where.append("first_seen_ts >= ?")
+            args.append(float(since))
+        if until is not None:
+            where.append("first_seen_ts < ?")
+            args.append(float(until))
+        sql = "SELECT * FROM users"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY first_seen_ts DESC, id DESC LIMIT ?"
+        args.append(int(limit))
+        with self._rlock:
+            rows = self._rconn.execute(sql, args).fetchall()
+        return [_from_db(r) for r in rows]
+
+    # ---- запись ----
+    def put(self, row: Dict[str, Any]) -> None:
+        self.put_many([row])
+
+    def update(self, uid: int, changes: Dict[str, Any]) -> None:
+        # неполная строка: upsert трогает только переданные колонки
+        self.put_many([{**changes, "id": int(uid)}])
+
+    def add_accrual(self, acc: Dict[str, Any]) -> None:
+        self.put_many([], accruals=[acc])
+
+    def put_timer(self, kind: str, uid: int, due_ts: Optional[float], payload: Optional[Dict[str, Any]] = None) -> None:
+        self.put_many([], timers=[{"kind": kind, "user_id": int(uid), "due_ts": due_ts, "payload": payload or {}}])
+
+    def put_payment(self, row: Dict[str, Any]) -> None:
+        self.put_many([], payments=[row])
+
+    def put_payments(self, rows: List[Dict[str, Any]], durable: bool = False) -> None:
+        self.put_many([], durable=durable, payments=rows)
+
+    def put_many(self, rows: List[Dict[str, Any]], durable: bool = False,
+                 accruals: Optional[List[Dict[str, Any]]] = None,
+                 timers: Optional[List[Dict[str, Any]]] = None,
+                 payments: Optional[List[Dict[str, Any]]] = None) -> None:
+        with self._lock:
+            if durable:
+                self._conn.execute("PRAGMA synchronous=FULL")
+            try:
+                self._write_rows(rows, accruals or [], timers or [], payments or [])
+                if durable and not rows and not accruals and not timers and not payments:
+                    self._conn.execute("PRAGMA wal_checkpoint(FULL)")
+            finally:
+                if durable:
+                    self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def _write_rows(self, rows: List[Dict[str, Any]], accruals: List[Dict[str, Any]],
+                    timers: List[Dict[str, Any]], payments: List[Dict[str, Any]] = ()) -> None:
+        if not rows and not accruals and not timers and not payments:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for row in rows:
+                    d = _to_db(row)
+                    keys = list(d.keys())
+                    upd = ", ".join(f"{k} = excluded.{k}" for k in keys if k != "id")
+                    sql = (
+                        f"INSERT INTO users ({', '.join(keys)}) VALUES ({', '.join('?' for _ in keys)}) "
+                        f"ON CONFLICT(id) DO UPDATE SET {upd}"
+                    )
+                    self._conn.execute(sql, [d[k] for k in keys])
+                akeys = list(ACCRUAL_COLUMNS.keys())
+                for acc in accruals:
+                    # повтор того же payment_id игнорируется — начисление ровно одно
+                    self._conn.execute(
+                        f"INSERT OR IGNORE INTO ref_accruals ({', '.join(akeys)}) VALUES ({', '.join('?' for _ in akeys)})",
+                        [acc[k] for k in akeys],
+                    )
+                for t in timers:
+                    if t["due_ts"] is None:
+                        self._conn.execute("DELETE FROM timers WHERE kind = ? AND user_id = ?", (t["kind"], t["user_id"]))
+                    else:
+                        self._conn.execute(
+                            "INSERT INTO timers (kind, user_id, due_ts, payload) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT(kind, user_id) DO UPDATE SET due_ts = excluded.due_ts, payload = excluded.payload",
+                            (t["kind"], t["user_id"], float(t["due_ts"]), json.dumps(t["payload"] or {}, ensure_ascii=False)),
+                        )
+                for p in payments:
+                    d = {k: p[k] for k in PAYMENT_COLUMNS if k in p and p[k] is not None}
+                    if "credited" in d:
+                        d["credited"] = 1 if d["credited"] else 0
+                    keys = list(d.keys())
+                    upd = ", ".join(
+                        "credited = MAX(credited, excluded.credited)" if k == "credited" else f"{k} = excluded.{k}"
+                        for k in keys if k != "payment_id"
+                    ) or "payment_id = payment_id"
+                    self._conn.execute(
+                        f"INSERT INTO payments ({', '.join(keys)}) VALUES ({', '.join('?' for _ in keys)}) "
+                        f"ON CONFLICT(payment_id) DO UPDATE SET {upd}",
+                        [d[k] for k in keys],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def migrate_from_json(self, json_path: str) -> int:
+        """Разовый перенос users.json → SQLite. Файл переименовывается в *.migrated."""
+        if not os.path.exists(json_path):
+            return 0
+        if self.count() > 0:
+            log.warning("users table is not empty, skip migration of %s", json_path)
+            return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            log.error("users.json migration failed: %r", e)
+            return 0
+        rows = []
+        for k, v in (data or {}).items():
+            try:
+                rows.append({**v, "id": int(v.get("id") or k)})
+            except Exception:
+                continue
+        self.put_many(rows, durable=True)
+        os.replace(json_path, json_path + ".migrated")
+        log.info("migrated %d users from %s", len(rows), json_path)
+        return len(rows)
+
+    def upgrade(self) -> None:
+        """Разовые переносы данных после migrate_from_json; версия — в PRAGMA user_version."""
+        with self._lock:
+            ver = int(self._conn.execute("PRAGMA user_version").fetchone()[0])
+            if ver >= SCHEMA_VERSION:
+                return
+            self._conn.execute("BEGIN")
+            try:
+                # ref_earn_total без строк журнала → одно синтетическое начисление на разницу
+                cur = self._conn.execute(
+                    "INSERT OR IGNORE INTO ref_accruals (payment_id, referrer_id, referee_id, amount, rate, commission, ts) "
+                    "SELECT ? || u.id, u.id, 0, 0, 0, u.ref_earn_total - COALESCE(a.s, 0), 0 FROM users u "
+                    "LEFT JOIN (SELECT referrer_id, SUM(commission) AS s FROM ref_accruals GROUP BY referrer_id) a "
+                    "ON a.referrer_id = u.id WHERE u.ref_earn_total - COALESCE(a.s, 0) >= 0.01",
+                    (LEGACY_ACCRUAL_PREFIX,),
+                )
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if cur.rowcount:
+            log.info("users: backfilled %d legacy referral accruals", cur.rowcount)
+
+    def close(self) -> None:
+        with self._rlock:
+            self._rconn.close()
+        with self._lock:
+            self._conn.close()
+
+
+def _merge_rows(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    return {**old, **new}
+
+
+class BufferedUserStore(UserStore):
+    """
+    Обёртка с отложенной записью: put() не трогает диск на event loop,
+    строки сбрасываются пачкой потоком-писателем. Чтения по ключу (get, get_many, страницы,
+    платежи) видят ещё не записанное; агрегаты и журналы (count, summary, referral_pairs,
+    accruals, accrual_totals) читают только базу и отстают до interval — где нужна свежесть,
+    перед ними await async_flush().
+    """
+
+    def __init__(self, inner: SqliteUserStore, interval: float = 0.5):
+        self.inner = inner
+        # частичные изменения одной строки между сбросами склеиваются в один dict
+        self.wb = WriteBehind("users", self._flush, interval=interval, merge=_merge_rows)
+
+    # ключи пачки: ("u", user_id) — строка users, ("a", payment_id) — начисление,
+    # ("t", kind, user_id) — таймер, ("p", payment_id) — платёж; пачка — одна транзакция
+    def _flush(self, batch: Dict[Any, Any], durable: bool) -> None:
+        rows = [v for k, v in batch.items() if k[0] == "u"]
+        accruals = [v for k, v in batch.items() if k[0] == "a"]
+        timers = [v for k, v in batch.items() if k[0] == "t"]
+        payments = [v for k, v in batch.items() if k[0] == "p"]
+        self.inner.put_many(rows, durable=durable, accruals=accruals, timers=timers, payments=payments)
+
+    def atomic(self):
+        """with store.atomic(): записи внутри попадут в одну пачку — одну транзакцию SQLite (без await внутри)."""
+        return self.wb.atomic()
+
+    def _overlay(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        out = []
+        for r in rows:
+            p = self.wb.peek(("u", int(r["id"])))
+            out.append({**r, **p} if p is not MISSING else r)
+        return out
+
+    def get(self, uid: int) -> Optional[Dict[str, Any]]:
+        p = self.wb.peek(("u", int(uid)))
+        if p is MISSING:
+            return self.inner.get(uid)
+        if len(p) >= len(USER_COLUMNS):
+            return dict(p)
+        base = self.inner.get(uid)
+        return {**base, **p} if base else dict(p)
+
+    def get_many(self, uids: List[int]) -> List[Dict[str, Any]]:
+        found = {int(r["id"]): r for r in self._overlay(self.inner.get_many(uids))}
+        for u in uids:
+            if int(u) not in found:
+                p = self.wb.peek(("u", int(u)))
+                if p is not MISSING:
+                    found[int(u)] = dict(p)
+        return [found[int(u)] for u in uids if int(u) in found]
+
+    def put(self, row: Dict[str, Any]) -> None:
+        self.wb.put(("u", int(row["id"])), dict(row))
+
+    def update(self, uid: int, changes: Dict[str, Any]) -> None:
+        self.wb.put(("u", int(uid)), {**changes, "id": int(uid)})
+
+    def referral_pairs(self) -> Iterator[Tuple[int, int]]:
+        # только база: зовётся на старте, до первых записей; дальше REFS ведёт save_user
+        return self.inner.referral_pairs()
+
+    def add_accrual(self, acc: Dict[str, Any]) -> None:
+        self.wb.put(("a", str(acc["payment_id"])), dict(acc))
+
+    def accruals(self, referrer_id: int) -> List[Dict[str, Any]]:
+        return self.inner.accruals(referrer_id)
+
+    def load_timers(self) -> List[Dict[str, Any]]:
+        return self.inner.load_timers()
+
+    def put_timer(self, kind: str, uid: int, due_ts: Optional[float], payload: Optional[Dict[str, Any]] = None) -> None:
+        self.wb.put(("t", kind, int(uid)), {"kind": kind, "user_id": int(uid), "due_ts": due_ts, "payload": payload or {}})
+
+    def accrual_totals(self, referrer_id: int) -> Dict[str, Any]:
+        return self.inner.accrual_totals(referrer_id)
+
+    def get_payment(self, payment_id: str) -> Optional[Dict[str, Any]]:
+        p = self.wb.peek(("p", str(payment_id)))
+        base = self.inner.get_payment(payment_id)
+        if p is MISSING:
+            return base
+        out = {**(base or {}), **p}
+        out["credited"] = bool((base or {}).get("credited") or p.get("credited"))
+        return out
+
+    def put_payment(self, row: Dict[str, Any]) -> None:
+        self.wb.put(("p", str(row["payment_id"])), dict(row))
+
+    def count(self) -> int:
+        return self.inner.count()
+
+    def iter_rows(self, batch: int = 500) -> Iterator[Dict[str, Any]]:
+        for r in self.inner.iter_rows(batch):
+            yield self._overlay([r])[0]
+
+    def flash_candidates(self, seen_before_ts: float) -> List[Dict[str, Any]]:
+        return [r for r in self._overlay(self.inner.flash_candidates(seen_before_ts)) if not r.get("flash_sent")]
+
+    def summary(self) -> Dict[str, Any]:
+        return self.inner.summary()
+
+    def page_users(self, after: Optional[Tuple[float, int]], limit: int, paid_only: bool = False,
+                   since: Optional[float] = None, until: Optional[float] = None) -> List[Dict[str, Any]]:
+        return self._overlay(self.inner.page_users(after, limit, paid_only, since, until))
+
+    def sync(self, timeout: Optional[float] = None) -> bool:
+        """Барьер: всё сохранённое до вызова — на диске (fsync)."""
+        return self.wb.barrier(durable=True, timeout=timeout)
+
+    async def async_sync(self, timeout: Optional[float] = None) -> bool:
+        return await self.wb.abarrier(durable=True, timeout=timeout)
+
+    async def async_flush(self, timeout: Optional[float] = None) -> bool:
+        """Записанное до вызова — в базе (без fsync): после него агрегаты видят свежие данные."""
+        return await self.wb.abarrier(durable=False, timeout=timeout)
+
+    def close(self) -> None:
+        self.wb.close()
+        self.inner.close()
+
+
+def open_user_store(data_dir: str) -> BufferedUserStore:
+    """Бэкенд выбирается через USER_STORE (пока только sqlite)."""
+    kind = (os.getenv("USER_STORE") or "sqlite").strip().lower()
+    if kind != "sqlite":
+        raise RuntimeError(f"unknown USER_STORE: {kind}")
+    path = os.getenv("USER_DB_PATH") or os.path.join(data_dir, "users.sqlite3")
+    store = SqliteUserStore(path)
+    store.migrate_from_json(os.path.join(data_dir, "users.json"))
+    store.upgrade()
+    return BufferedUserStore(store, interval=float(os.getenv("USER_FLUSH_INTERVAL", "0.5")))
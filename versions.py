@@ -0,0 +1,102 @@
+# versions.py
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional, Hashable, Callable, Awaitable, Tuple
+
+from singleflight import SingleFlight
+
+log = logging.getLogger("versions")
+
+VERSION_TTL = float(os.getenv("REPLICATE_VERSION_TTL", "600"))
+VERSION_NEG_TTL = float(os.getenv("REPLICATE_VERSION_NEG_TTL", "30"))
+VERSION_MAX_STALE = float(os.getenv("REPLICATE_VERSION_MAX_STALE", "3600"))
+
+
+class VersionCache:
+    """
+    Кэш «модель → версия» для Replicate.
+    - свежая запись (ttl) отдаётся без запроса;
+    - устаревшая (до max_stale) отдаётся сразу, обновление — в фоне, одно на ключ;
+    - ошибка/пустой ответ кэшируется на negative_ttl (повторно выбрасывается то же исключение);
+    - одновременные промахи по ключу делают один запрос (single-flight).
+    """
+
+    def __init__(self, ttl: float = VERSION_TTL, negative_ttl: float = VERSION_NEG_TTL, max_stale: float = VERSION_MAX_STALE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self._entries: Dict[Hashable, Tuple[float, Any, Optional[BaseException]]] = {}  # key -> (ts, value, error)
+        self._flight = SingleFlight()
+        self._bg: Dict[Hashable, asyncio.Task] = {}
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "negative_hits": 0, "fetches": 0, "errors": 0}
+
+    async def resolve(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        now = time.time()
+        ent = self._entries.get(key)
+        if ent is not None:
+            ts, value, err = ent
+            age = now - ts
+            if err is not None or value is None:
+                if age < self.negative_ttl:
+                    self.stats["negative_hits"] += 1
+                    if err is not None:
+                        raise err
+                    return None
+            elif age < self.ttl:
+                self.stats["hits"] += 1
+                return value
+            elif age < self.ttl + self.max_stale:
+                self.stats["stale"] += 1
+                if key not in self._bg and not self._flight.inflight(key):
+                    self._bg[key] = asyncio.create_task(self._refresh_bg(key, fetch))
+                return value
+        self.stats["misses"] += 1
+        return await self._flight.do(key, lambda: self._fetch(key, fetch))
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        self.stats["fetches"] += 1
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            self._entries[key] = (time.time(), None, e)
+            raise
+        self._entries[key] = (time.time(), value, None)
+        return value
+
+    async def _refresh_bg(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            await self._flight.do(key, lambda: self._fetch_keep_stale(key, fetch))
+        except Exception as e:
+            log.warning("version refresh for %s failed, keeping stale: %r", key, e)
+        finally:
+            self._bg.pop(key, None)
+
+    async def _fetch_keep_stale(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        # фоновое обновление не затирает рабочую версию ошибкой
+        self.stats["fetches"] += 1
+        try:
+            value = await fetch()
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        if value is not None:
+            self._entries[key] = (time.time(), value, None)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (time.time(), value, None)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "entries": len(self._entries), "shared": self._flight.stats["shared"]}
+
+
+# общий кэш на процесс: main.py, api.py, replicate_api.py
+VERSIONS = VersionCache()
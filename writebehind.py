@@ -0,0 +1,194 @@
+# writebehind.py
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+from typing import Dict, Any, Callable, Optional
+
+log = logging.getLogger("writebehind")
+
+MISSING = object()
+
+
+class WriteBehind:
+    """
+    Отложенная запись на отдельном потоке.
+    put() только помечает ключ грязным; поток-писатель раз в interval забирает
+    накопившуюся пачку и вызывает flush_fn(batch, durable). Повторные put() одного
+    ключа между сбросами схлопываются (merge, по умолчанию — последнее значение).
+    barrier() ждёт, пока всё записанное до вызова окажется на диске (durable → fsync).
+    flush_fn должен понимать пустую пачку с durable=True как «только fsync».
+    """
+
+    def __init__(self, name: str, flush_fn: Callable[[Dict[Any, Any], bool], None],
+                 interval: float = 0.5, merge: Optional[Callable[[Any, Any], Any]] = None,
+                 stop_retries: int = 5):
+        self.name = name
+        self.interval = float(interval)
+        self.stop_retries = int(stop_retries)  # на остановке: столько неудачных сбросов подряд — и сдаёмся
+        self._flush_fn = flush_fn
+        self._merge = merge
+        self._cond = threading.Condition()
+        self._pending: Dict[Any, Any] = {}
+        self._inflight: Dict[Any, Any] = {}
+        self._seq = 0            # номер последнего put()
+        self._flushed_seq = 0    # всё до этого номера записано
+        self._durable_seq = 0    # ... и синхронизировано на диск
+        self._durable_req = 0    # запрошенный durable-барьер
+        self._urgent = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"puts": 0, "flushes": 0, "rows": 0, "durable_flushes": 0, "errors": 0, "dropped": 0}
+
+    # ---- API ----
+    def put(self, key: Any, value: Any) -> None:
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError(f"writer {self.name} is stopped")
+            old = self._pending.get(key, MISSING)
+            if old is not MISSING and self._merge:
+                value = self._merge(old, value)
+            self._pending[key] = value
+            self._seq += 1
+            self.stats["puts"] += 1
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def atomic(self):
+        """put() внутри блока попадают в одну пачку: поток-писатель не заберёт её посередине."""
+        with self._cond:  # Condition на RLock — put() внутри берёт его повторно
+            yield
+
+    def peek(self, key: Any) -> Any:
+        """
+        Значение, ещё не дошедшее до диска (или MISSING). Во время сброса ключ может быть
+        и в пишущейся пачке, и в новых put(): при merge они склеиваются (новые поверх).
+        """
+        with self._cond:
+            v = self._pending.get(key, MISSING)
+            inflight = self._inflight.get(key, MISSING)
+            if v is MISSING:
+                return inflight
+            if inflight is not MISSING and self._merge:
+                return self._merge(inflight, v)
+            return v
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return len(self._pending) + len(self._inflight)
+
+    def barrier(self, durable: bool = True, timeout: Optional[float] = None) -> bool:
+        """Блокирующе дождаться сброса всех put(), сделанных до вызова."""
+        with self._cond:
+            target = self._seq
+            if durable:
+                self._durable_req = max(self._durable_req, target)
+            done = (lambda: self._durable_seq >= target) if durable else (lambda: self._flushed_seq >= target)
+            if done():
+                return True
+            self._urgent = True
+            self._ensure_thread()
+            self._cond.notify_all()
+            return self._cond.wait_for(done, timeout=timeout)
+
+    async def abarrier(self, durable: bool = True, timeout: Optional[float] = None) -> bool:
+        return await asyncio.to_thread(self.barrier, durable, timeout)
+
+    def close(self) -> None:
+        """
+        Сбросить всё и остановить поток (вызывать на shutdown). Если сброс так и не удаётся
+        (диск только для чтения, БД заблокирована) — после stop_retries попыток несброшенное
+        отбрасывается с записью в лог, чтобы не держать остановку процесса.
+        """
+        with self._cond:
+            self._stopping = True
+            self._durable_req = self._seq
+            self._cond.notify_all()
+            t = self._thread
+        if t:
+            t.join()
+        else:
+            for _ in range(max(1, self.stop_retries)):
+                if self._flush_once():
+                    return
+            self._drop_pending()
+
+    # ---- поток-писатель ----
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"wb-{self.name}", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        failures = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopping or self._needs_sync())
+                if not self._pending and not self._needs_sync() and self._stopping:
+                    return
+                # окно склейки: ждём interval, если никто не просит барьер
+                if not self._urgent and not self._stopping:
+                    self._cond.wait_for(lambda: self._urgent or self._stopping, timeout=self.interval)
+            if self._flush_once():
+                failures = 0
+                continue
+            failures += 1
+            with self._cond:
+                stopping = self._stopping
+            if stopping and failures >= self.stop_retries:
+                self._drop_pending()
+                return
+            time.sleep(min(5.0, self.interval * 4) if not stopping else min(1.0, self.interval * 4 + 0.1))
+
+    def _drop_pending(self) -> None:
+        """Остановка при неустранимой ошибке записи: отбросить несброшенное и отпустить барьеры."""
+        with self._cond:
+            keys = list(self._pending.keys())
+            self.stats["dropped"] += len(keys)
+            self._pending = {}
+            self._flushed_seq = self._durable_seq = self._seq
+            self._durable_req = self._seq
+            self._cond.notify_all()
+        if keys:
+            log.error("writer %s stopped with failing flush: dropped %d rows: %s",
+                      self.name, len(keys), keys[:50])
+
+    def _needs_sync(self) -> bool:
+        return self._durable_req > self._durable_seq
+
+    def _flush_once(self) -> bool:
+        with self._cond:
+            if not self._pending and not self._needs_sync():
+                return True
+            # пустая пачка с durable=True — данные уже записаны, нужен только fsync
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            upto = self._seq
+            durable = self._needs_sync()
+            self._urgent = False
+        try:
+            self._flush_fn(batch, durable)
+        except Exception as e:
+            log.exception("writer %s flush failed: %r", self.name, e)
+            with self._cond:
+                self.stats["errors"] += 1
+                # вернуть пачку, не затирая более свежие put()
+                for k, v in batch.items():
+                    if k not in self._pending:
+                        self._pending[k] = v
+                    elif self._merge:
+                        self._pending[k] = self._merge(v, self._pending[k])
+                self._inflight = {}
+            return False
+        with self._cond:
+            self._inflight = {}
+            self._flushed_seq = max(self._flushed_seq, upto)
+            if durable:
+                self._durable_seq = max(self._durable_seq, upto)
+                self.stats["durable_flushes"] += 1
+            self.stats["flushes"] += 1
+            self.stats["rows"] += len(batch)
+            self._cond.notify_all()
+        return True